@@ -7,9 +7,13 @@ import pylab
 from mpl_toolkits.mplot3d import Axes3D
 #from scipy.interpolate import Rbf
 import pickle
+import re
+from array import array
 from scipy.sparse import csr_matrix
+from scipy.sparse import coo_matrix
 from scipy.sparse import lil_matrix
 from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import splu
 from EnergyClass import Energy
 import matplotlib.pyplot as plt
 
@@ -131,30 +135,77 @@ def Poly(x,y):
 #MeshRetrievalFunctions
 
 
+#The Mathematica exports are three lists written one after the other:
+#{{x1,y1},...}, {Line[{i,j}],...} and {Polygon[{i,j,k,...}],...}
+#Reals may carry Mathematica exponents, e.g. 1.5*^-6.
+MathematicaToken = re.compile(r'Line\[|Polygon\[|[{}\]]|[-+]?(?:\d+\.?\d*|\.\d+)(?:\*\^[-+]?\d+)?')
+
+def MathematicaTokens(file,chunksize=1<<20):
+    #This generator reads the file in chunks and yields its tokens one at a time.
+    #A token cut by the end of a chunk is carried over to the next chunk.
+    with open(file) as fp:
+        tail = ''
+        while True:
+            chunk = fp.read(chunksize)
+            text  = tail+chunk
+            if not chunk:
+                for tok in MathematicaToken.finditer(text):
+                    yield tok.group()
+                return
+            cut  = max(text.rfind(','),text.rfind('}'),text.rfind(']'))+1
+            tail = text[cut:]
+            for tok in MathematicaToken.finditer(text,0,cut):
+                yield tok.group()
+
+def ReadMathematicaMesh(file,chunksize=1<<20):
+    #This function parses a mesh exported from Mathematica without evaluating it.
+    #It returns the coordinates of the nodes as a (NumNodes,2) float array, the
+    #nodes of each edge as a (NumEdges,2) int array and the nodes of the elements
+    #in compressed form: the nodes of element i are ElementNodes[ElementPtr[i]:ElementPtr[i+1]].
+    #Positions are shifted to start at 0 (lists in Mathematica begin with 1).
+    Coords   = array('d')
+    Edges    = array('q')
+    ElNodes  = array('q')
+    ElPtr    = array('q',[0])
+    Head     = None #None while reading the nodes, otherwise 'Line[' or 'Polygon['
+    InHead   = False
+    for tok in MathematicaTokens(file,chunksize):
+        if tok == 'Line[' or tok == 'Polygon[':
+            Head, InHead = tok, True
+        elif tok == ']':
+            if Head == 'Polygon[' and InHead:
+                ElPtr.append(len(ElNodes))
+            InHead = False
+        elif tok == '{' or tok == '}':
+            continue
+        elif Head is None:
+            Coords.append(float(tok.replace('*^','e')))
+        elif Head == 'Line[':
+            Edges.append(int(tok)-1)
+        else:
+            ElNodes.append(int(tok)-1)
+    Nodes        = np.frombuffer(Coords,dtype=np.float64).reshape(-1,2)
+    EdgeNodes    = np.frombuffer(Edges,dtype=np.int64).reshape(-1,2)
+    ElementPtr   = np.frombuffer(ElPtr,dtype=np.int64)
+    ElementNodes = np.frombuffer(ElNodes,dtype=np.int64)
+    return Nodes,EdgeNodes,ElementPtr,ElementNodes
+
 def GetMesh(file):
     #This function will, provided a text file in the format of meshes in Mathematica,
     #return the coordinates of the nodes, the Edge Nodes and the Nodes of each element
-    UnprocessedMesh = open(file).read()
-    FirstCut        = UnprocessedMesh.split('}}')
-    Nodes           = FirstCut[0]+'}'
-    EdgeNodes,Elements,trash = FirstCut[1].split(']}')
-    for rep in (('{','['),('}',']'),('*^','*10**'),('Line[',''),('Polygon[',''),(']]',']')):
-        Nodes     = Nodes.replace(rep[0],rep[1])
-        EdgeNodes = EdgeNodes.replace(rep[0],rep[1])  #Replace the characters in the first position of the
-        Elements  = Elements.replace(rep[0],rep[1])     #parenthesis with the second character
-                                                    
-
-    Nodes=Nodes+']'
-    EdgeNodes = EdgeNodes+']'
-    Elements  = Elements+']' #add the last ]
-    Nodes     = eval(Nodes)
-    EdgeNodes = eval(EdgeNodes)# turn string to list
-    Elements  = eval(Elements)
-    EdgeNodes = [(np.array(y)-1).tolist() for y in EdgeNodes]
-    Elements  = [(np.array(y)-1).tolist() for y in Elements]
-    #EdgeNodes=np.array(EdgeNodes)-1
-    #Elements=np.array(Elements)-1 #subtract one from each position in the array(lists in mathematica begin with 1)
-    return Nodes,EdgeNodes,Elements
+    Nodes,EdgeNodes,ElementPtr,ElementNodes = ReadMathematicaMesh(file)
+    Elements = [ElementNodes[ElementPtr[i]:ElementPtr[i+1]].tolist() for i in range(len(ElementPtr)-1)]
+    return Nodes.tolist(),EdgeNodes.tolist(),Elements
+
+def ProcessMathematicaMesh(file,Pfile=None):
+    #This function reads a Mathematica mesh and runs it through the element/edge pipeline.
+    #If Pfile is provided the result is pickled in the format read by ProcessedMesh.
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes = Mesh(file)
+    Orientations = [Orientation(Element,EdgeNodes,Nodes) for Element in ElementEdges]
+    if Pfile is not None:
+        with open(Pfile, "wb") as fp:   #Pickling
+            pickle.dump((Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations),fp)
+    return Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations
 
 
 #def EdgesElement(EdgeNodes,Elements):
@@ -186,6 +237,9 @@ def EdgesElement(EdgeNodes,Elements):
     NumberElements = len(Elements)
     NumberEdges = len(EdgeNodes)
     ElementEdges = [0]*NumberElements
+    EdgeIndex = {}
+    for ell in range(NumberEdges-1,-1,-1): #the first appearance of an edge is the one kept
+        EdgeIndex[tuple(EdgeNodes[ell])] = ell
     for i in range(NumberElements): #loop over elements
         NumberNodesEdges = len(Elements[i]) #keep in mind there are the same number of Edges as there a
                                      #of nodes
@@ -195,12 +249,11 @@ def EdgesElement(EdgeNodes,Elements):
         
         Element[NumberNodesEdges] = Element[0] # add the first vertex as the last vertex (so that edges become every pair)
         for j in range(NumberNodesEdges): #run over every pair of vertices(edges)
-            Edge = [Element[j],Element[j+1]]
-            if Edge in EdgeNodes:
-                ElementEdge[j] = EdgeNodes.index(Edge)
+            Edge = (Element[j],Element[j+1])
+            if Edge in EdgeIndex:
+                ElementEdge[j] = EdgeIndex[Edge]
             else:
-                Edge = [Element[j+1],Element[j]]
-                ElementEdge[j] = EdgeNodes.index(Edge)
+                ElementEdge[j] = EdgeIndex[(Element[j+1],Element[j])]
         ElementEdges[i]=ElementEdge
     return ElementEdges  
 
@@ -1060,244 +1113,69 @@ def PieceWiseLocalMEWEMVWV(J,Basis,Element,EdgeNodes,Nodes,Ori):
     MJ = MV.dot(MJ)
     return ME,MV,MJ,Edges
 
-def MFDAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations):
-    #This routine takes a mesh and assembles the global mass matrices and their inverses
+def TripletAssembly(LocalMatrices,J,Nodes,EdgeNodes,ElementEdges,Orientations):
+    #This routine assembles the global matrices ME, MV and MJ from the local matrices computed by
+    #LocalMatrices (MFDMEWEMVWV, NewLocalMEWEMVWV, LeastSquaresLocalMEWEMVWV or
+    #PieceWiseLocalMEWEMVWV). The entries of every element are stored as (row,col,value) triplets
+    #in buffers allocated once from the sizes of the elements, and the duplicates are summed when
+    #the triplets are converted to CSR.
     Basis          = [Poly1,Poly2,Poly]
-    
-    NumberElements = len(ElementEdges)
     NumberEdges    = len(EdgeNodes)
     NumberNodes    = len(Nodes)
     
-    
-    ME = lil_matrix((NumberEdges,NumberEdges))
-    #ME = np.zeros((NumberEdges,NumberEdges))
-    #WE=np.zeros((NumberEdges,NumberEdges))
-    MV = lil_matrix((NumberNodes,NumberNodes))
-    #MV = np.zeros((NumberNodes,NumberNodes))
-    #WV=np.zeros((NumberNodes,NumberNodes))
-    MJ = lil_matrix((NumberNodes,NumberEdges))
-    #MJ = np.zeros((NumberNodes,NumberEdges))
+    Sizes  = np.array([len(Element) for Element in ElementEdges],dtype=int)
+    Ptr    = np.concatenate(([0],np.cumsum(Sizes**2)))
+    EdgeRows = np.zeros(Ptr[-1],dtype=int)
+    EdgeCols = np.zeros(Ptr[-1],dtype=int)
+    NodeRows = np.zeros(Ptr[-1],dtype=int)
+    NodeCols = np.zeros(Ptr[-1],dtype=int)
+    ValsME = np.zeros(Ptr[-1])
+    ValsMV = np.zeros(Ptr[-1])
+    ValsMJ = np.zeros(Ptr[-1])
     
     #loop over the elements
     k = 0
     for Element in ElementEdges: 
-        #Compute the local mass and stiffness matrices
-        #LocME,LocWE,LocMV,LocWV,Edges=LocalMEWEMVWV(Element,EdgeNodes,Nodes) 
-        Ori = Orientations[k]
+        #Compute the local mass matrices
+        LocME,LocMV,LocMJ,Edges = LocalMatrices(J,Basis,Element,EdgeNodes,Nodes,Orientations[k]) 
+        
+        #The edge-based functions are assembled in the order of Element and the node-based
+        #functions in the order of the first vertices of the edges
+        n               = len(Element)
+        Local           = slice(Ptr[k],Ptr[k+1])
+        Element         = np.asarray(Element,dtype=int)
+        ElementVertices = np.array([Edges[i][0] for i in range(n)],dtype=int)
+        EdgeRows[Local] = np.repeat(Element,n)
+        EdgeCols[Local] = np.tile(Element,n)
+        NodeRows[Local] = np.repeat(ElementVertices,n)
+        NodeCols[Local] = np.tile(ElementVertices,n)
+        ValsME[Local]   = np.asarray(LocME,dtype=float).ravel()
+        ValsMV[Local]   = np.asarray(LocMV,dtype=float).ravel()
+        ValsMJ[Local]   = np.asarray(LocMJ,dtype=float).ravel()
         k = k+1
-        LocME,LocMV,LocMJ,Edges = MFDMEWEMVWV(J,Basis,Element,EdgeNodes,Nodes,Ori) 
-        
-        #The assembly of the edge-based functions is easier since Element
-        #Contains the order in which the edges ought to be assembled
-       
-        for j in range(len(Element)):
-            ME[Element[j],Element] = ME[Element[j],Element] + LocME[j]
-            #WE[Element[j],Element] = WE[Element[j],Element] + LocWE[j]
-        n=len(Edges)-1
-        ElementVertices = [0]*n
-        
-        for i in range(n):
-            ElementVertices[i] = Edges[i][0]
-         
-        for j in range(len(Element)):
-            MV[ElementVertices[j],ElementVertices] = MV[ElementVertices[j],ElementVertices]+LocMV[j]
-            MJ[ElementVertices[j],Element] = MJ[ElementVertices[j],Element]+LocMJ[j]
-            #WV[ElementVertices[j],ElementVertices]=WV[ElementVertices[j],ElementVertices]+LocWV[j]
-        
-        #print(MJ)
-        #i = 0
-        #print(np.linalg.norm(LocMJ))
-        #for Edge in Element:
-        #    MJ[Edge,ElementVertices] = MJ[Edge,ElementVertices]+LocMJ[i]
-        #    i = i+1
-        #for j in range(len(Element)):
-            #MJ[ElementVertices[j],Element] = MJ[ElementVertices[j],Element]+LocMJ[j]
-    #return ME,WE,MV,WV
-    
-    ME = ME.tocsr()
-    MV = MV.tocsr()
-    MJ = MJ.tocsr()
+    
+    ME = coo_matrix((ValsME,(EdgeRows,EdgeCols)),shape=(NumberEdges,NumberEdges)).tocsr()
+    MV = coo_matrix((ValsMV,(NodeRows,NodeCols)),shape=(NumberNodes,NumberNodes)).tocsr()
+    MJ = coo_matrix((ValsMJ,(NodeRows,EdgeCols)),shape=(NumberNodes,NumberEdges)).tocsr()
     
     return ME,MV,MJ
 
+def MFDAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations):
+    #This routine takes a mesh and assembles the global mass matrices and their inverses
+    return TripletAssembly(MFDMEWEMVWV,J,Nodes,EdgeNodes,ElementEdges,Orientations)
+
 def EAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations):
     #This routine takes a mesh and assembles the global mass matrices and their inverses
-    Basis          = [Poly1,Poly2,Poly]
-    
-    NumberElements = len(ElementEdges)
-    NumberEdges    = len(EdgeNodes)
-    NumberNodes    = len(Nodes)
-    
-    
-    ME = lil_matrix((NumberEdges,NumberEdges))
-    #ME = np.zeros((NumberEdges,NumberEdges))
-    #WE=np.zeros((NumberEdges,NumberEdges))
-    MV = lil_matrix((NumberNodes,NumberNodes))
-    #MV = np.zeros((NumberNodes,NumberNodes))
-    #WV=np.zeros((NumberNodes,NumberNodes))
-    MJ = lil_matrix((NumberNodes,NumberEdges))
-    #MJ = np.zeros((NumberNodes,NumberEdges))
-    
-    #loop over the elements
-    k = 0
-    for Element in ElementEdges: 
-        #Compute the local mass and stiffness matrices
-        #LocME,LocWE,LocMV,LocWV,Edges=LocalMEWEMVWV(Element,EdgeNodes,Nodes) 
-        Ori = Orientations[k]
-        k = k+1
-        LocME,LocMV,LocMJ,Edges = NewLocalMEWEMVWV(J,Basis,Element,EdgeNodes,Nodes,Ori) 
-        
-        #The assembly of the edge-based functions is easier since Element
-        #Contains the order in which the edges ought to be assembled
-       
-        for j in range(len(Element)):
-            ME[Element[j],Element] = ME[Element[j],Element] + LocME[j]
-            #WE[Element[j],Element] = WE[Element[j],Element] + LocWE[j]
-        n=len(Edges)-1
-        ElementVertices = [0]*n
-        
-        for i in range(n):
-            ElementVertices[i] = Edges[i][0]
-         
-        for j in range(len(Element)):
-            MV[ElementVertices[j],ElementVertices] = MV[ElementVertices[j],ElementVertices]+LocMV[j]
-            MJ[ElementVertices[j],Element] = MJ[ElementVertices[j],Element]+LocMJ[j]
-            #WV[ElementVertices[j],ElementVertices]=WV[ElementVertices[j],ElementVertices]+LocWV[j]
-        
-        #print(MJ)
-        #i = 0
-        #print(np.linalg.norm(LocMJ))
-        #for Edge in Element:
-        #    MJ[Edge,ElementVertices] = MJ[Edge,ElementVertices]+LocMJ[i]
-        #    i = i+1
-        #for j in range(len(Element)):
-            #MJ[ElementVertices[j],Element] = MJ[ElementVertices[j],Element]+LocMJ[j]
-    #return ME,WE,MV,WV
-    
-    ME = ME.tocsr()
-    MV = MV.tocsr()
-    MJ = MJ.tocsr()
-    
-    return ME,MV,MJ
+    return TripletAssembly(NewLocalMEWEMVWV,J,Nodes,EdgeNodes,ElementEdges,Orientations)
 
 def LSAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations):
     #This routine takes a mesh and assembles the global mass matrices and their inverses
-    
-    Basis  = [Poly1,Poly2,Poly]
-    NumberElements = len(ElementEdges)
-    NumberEdges = len(EdgeNodes)
-    NumberNodes = len(Nodes)
-    
-    
-    ME = lil_matrix((NumberEdges,NumberEdges))
-    #ME = np.zeros((NumberEdges,NumberEdges))
-    #WE=np.zeros((NumberEdges,NumberEdges))
-    MV = lil_matrix((NumberNodes,NumberNodes))
-    #MV = np.zeros((NumberNodes,NumberNodes))
-    #WV=np.zeros((NumberNodes,NumberNodes))
-    MJ = lil_matrix((NumberNodes,NumberEdges))
-    #MJ = np.zeros((NumberNodes,NumberEdges))
-    
-    #loop over the elements
-    k = 0
-    for Element in ElementEdges: 
-        #Compute the local mass and stiffness matrices
-        #LocME,LocWE,LocMV,LocWV,Edges=LocalMEWEMVWV(Element,EdgeNodes,Nodes) 
-        Ori = Orientations[k]
-        k = k+1
-        LocME,LocMV,LocMJ,Edges = LeastSquaresLocalMEWEMVWV(J,Basis,Element,EdgeNodes,Nodes,Ori) 
-        
-        #The assembly of the edge-based functions is easier since Element
-        #Contains the order in which the edges ought to be assembled
-       
-        for j in range(len(Element)):
-            ME[Element[j],Element] = ME[Element[j],Element] + LocME[j]
-            #WE[Element[j],Element] = WE[Element[j],Element] + LocWE[j]
-        n=len(Edges)-1
-        ElementVertices = [0]*n
-        
-        for i in range(n):
-            ElementVertices[i] = Edges[i][0]
-         
-        for j in range(len(Element)):
-            MV[ElementVertices[j],ElementVertices] = MV[ElementVertices[j],ElementVertices]+LocMV[j]
-            MJ[ElementVertices[j],Element] = MJ[ElementVertices[j],Element]+LocMJ[j]
-            #WV[ElementVertices[j],ElementVertices]=WV[ElementVertices[j],ElementVertices]+LocWV[j]
-        
-        #print(MJ)
-        #i = 0
-        #print(np.linalg.norm(LocMJ))
-        #for Edge in Element:
-        #    MJ[Edge,ElementVertices] = MJ[Edge,ElementVertices]+LocMJ[i]
-        #    i = i+1
-        #for j in range(len(Element)):
-            #MJ[ElementVertices[j],Element] = MJ[ElementVertices[j],Element]+LocMJ[j]
-    #return ME,WE,MV,WV
-    
-    ME = ME.tocsr()
-    MV = MV.tocsr()
-    MJ = MJ.tocsr()
-    
-    return ME,MV,MJ
+    return TripletAssembly(LeastSquaresLocalMEWEMVWV,J,Nodes,EdgeNodes,ElementEdges,Orientations)
+
 def GIAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations):
     #This routine takes a mesh and assembles the global mass matrices and their inverses
-    
-    Basis  = [Poly1,Poly2,Poly]
-    NumberElements = len(ElementEdges)
-    NumberEdges = len(EdgeNodes)
-    NumberNodes = len(Nodes)
-    
-    
-    ME = lil_matrix((NumberEdges,NumberEdges))
-    #ME = np.zeros((NumberEdges,NumberEdges))
-    #WE=np.zeros((NumberEdges,NumberEdges))
-    MV = lil_matrix((NumberNodes,NumberNodes))
-    #MV = np.zeros((NumberNodes,NumberNodes))
-    #WV=np.zeros((NumberNodes,NumberNodes))
-    MJ = lil_matrix((NumberNodes,NumberEdges))
-    #MJ = np.zeros((NumberNodes,NumberEdges))
-    
-    #loop over the elements
-    k = 0
-    for Element in ElementEdges: 
-        #Compute the local mass and stiffness matrices
-        #LocME,LocWE,LocMV,LocWV,Edges=LocalMEWEMVWV(Element,EdgeNodes,Nodes) 
-        Ori = Orientations[k]
-        k = k+1
-        LocME,LocMV,LocMJ,Edges = PieceWiseLocalMEWEMVWV(J,Basis,Element,EdgeNodes,Nodes,Ori) 
-        
-        #The assembly of the edge-based functions is easier since Element
-        #Contains the order in which the edges ought to be assembled
-       
-        for j in range(len(Element)):
-            ME[Element[j],Element] = ME[Element[j],Element] + LocME[j]
-            #WE[Element[j],Element] = WE[Element[j],Element] + LocWE[j]
-        n=len(Edges)-1
-        ElementVertices = [0]*n
-        
-        for i in range(n):
-            ElementVertices[i] = Edges[i][0]
-         
-        for j in range(len(Element)):
-            MV[ElementVertices[j],ElementVertices] = MV[ElementVertices[j],ElementVertices]+LocMV[j]
-            MJ[ElementVertices[j],Element] = MJ[ElementVertices[j],Element]+LocMJ[j]
-            #WV[ElementVertices[j],ElementVertices]=WV[ElementVertices[j],ElementVertices]+LocWV[j]
-        
-        #print(MJ)
-        #i = 0
-        #print(np.linalg.norm(LocMJ))
-        #for Edge in Element:
-        #    MJ[Edge,ElementVertices] = MJ[Edge,ElementVertices]+LocMJ[i]
-        #    i = i+1
-        #for j in range(len(Element)):
-            #MJ[ElementVertices[j],Element] = MJ[ElementVertices[j],Element]+LocMJ[j]
-    #return ME,WE,MV,WV
-    
-    ME = ME.tocsr()
-    MV = MV.tocsr()
-    MJ = MJ.tocsr()
-    
-    return ME,MV,MJ
+    return TripletAssembly(PieceWiseLocalMEWEMVWV,J,Nodes,EdgeNodes,ElementEdges,Orientations)
+
 #Interpolators 
 
 def projV(func,Nodes):
@@ -1435,120 +1313,86 @@ def HighOrder7projE(Func,EdgeNodes,Nodes):
 
 def primcurl(EdgeNodes,Nodes):
     #This routine computes the primary curl as a matrix
-    nN = len(Nodes)
-    nE = len(EdgeNodes)
-    #curl = np.zeros((nE,nN))
-    curl = lil_matrix((nE,nN))
-    for i in range(nE):
-        Node1 = EdgeNodes[i][0]
-        Node2 = EdgeNodes[i][1]
-        x1 = Nodes[Node1][0]
-        y1 = Nodes[Node1][1]
-        x2 = Nodes[Node2][0]
-        y2 = Nodes[Node2][1]
-        lengthe = math.sqrt((x2-x1)**2+(y2-y1)**2)
-        
-        curl[i,Node2] = 1/lengthe #These formulas are derived in the pdf document
-        curl[i,Node1] = -1/lengthe
-    curl = curl.tocsr()
+    #The (row,col,value) triplets are built at once and summed into a csr matrix.
+    X       = np.asarray(Nodes,dtype=float)
+    EN      = np.asarray(EdgeNodes,dtype=int)
+    nN, nE  = len(X), len(EN)
+    lengthe = np.sqrt(np.sum((X[EN[:,1]]-X[EN[:,0]])**2,axis=1))
+    rows    = np.repeat(np.arange(nE),2)
+    vals    = (np.array([[-1.0,1.0]])/lengthe[:,None]).ravel() #These formulas are derived in the pdf document
+    curl    = coo_matrix((vals,(rows,EN.ravel())),shape=(nE,nN)).tocsr()
     return curl
 
 def primdiv(ElementEdges,EdgeNodes,Nodes,Orientations):
     #this routine computes the primary divergence matrix
-    NEl = len(ElementEdges)
-    NE  = len(EdgeNodes)
-    div = np.zeros((NEl,NE))
-    for i in range(NEl):
-        Element = ElementEdges[i]
-        N       = len(Element)
-        Ori     = Orientations[i]
-        for j in range(N):
-            Node1 = EdgeNodes[Element[j]][0]
-            Node2 = EdgeNodes[Element[j]][1]
-
-            x1    = Nodes[Node1][0]
-            y1    = Nodes[Node1][1] #these formulas are derived in the pdf document
-            x2    = Nodes[Node2][0]
-            y2    = Nodes[Node2][1]
-
-            lengthe                = math.sqrt((x2-x1)**2+(y2-y1)**2)
-            xP,yP,A,Vertices,Edges = Centroid(Element,EdgeNodes,Nodes,Ori)
-            div[i,Element[j]]      = Ori[j]*lengthe/A
+    #The entries are Ori*length/Area, the areas are computed once per element.
+    X       = np.asarray(Nodes,dtype=float)
+    EN      = np.asarray(EdgeNodes,dtype=int)
+    NEl     = len(ElementEdges)
+    NE      = len(EN)
+    Sizes   = np.array([len(Element) for Element in ElementEdges],dtype=int)
+    Edges   = np.concatenate([np.asarray(Element,dtype=int) for Element in ElementEdges])
+    Ori     = np.concatenate([np.asarray(Orientations[i][0:Sizes[i]],dtype=float) for i in range(NEl)])
+    Els     = np.repeat(np.arange(NEl),Sizes)
+    Start   = np.where(Ori>0,EN[Edges,0],EN[Edges,1])
+    End     = np.where(Ori>0,EN[Edges,1],EN[Edges,0])
+    A       = 0.5*np.bincount(Els,weights=X[Start,0]*X[End,1]-X[End,0]*X[Start,1],minlength=NEl)
+    lengthe = np.sqrt(np.sum((X[EN[:,1]]-X[EN[:,0]])**2,axis=1))
+    div     = coo_matrix((Ori*lengthe[Edges]/A[Els],(Els,Edges)),shape=(NEl,NE)).tocsr()
     return div
 
 
 #Solver
-def MFDSolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
-    #This routine will, provided a mesh, final time and time step, return the values of the electric and magnetic field at
-    #the given time.
-    #The boundary conditions are given above 
+def BoundaryValues(Func,X,Y,t):
+    #This routine evaluates the boundary condition Func at the points (X,Y) at time t. Func is
+    #called once on the arrays when it accepts them and point by point otherwise (e.g. when it
+    #is written with math functions).
+    try:
+        return np.broadcast_to(np.asarray(Func(X,Y,t),dtype=float),np.shape(X)).copy()
+    except (TypeError,ValueError):
+        return np.array([Func(x,y,t) for x,y in zip(X,Y)],dtype=float)
+
+def ThetaSolver(Assembly,J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
+    #This routine is the time stepping shared by MFDSolver, ESolver, LSSolver and GISolver, which
+    #only differ in the Assembly of the mass matrices. At every step
+    #(MV+theta*dt*(curl^T ME+MJ) curl) Eh = (curl^T ME+MJ) Bh
+    #is solved for the internal values of Eh and Bh = Bh-dt*curl Eh. The matrix of the internal
+    #nodes does not change in time, it is factorized once and every step is a back substitution.
+    #It returns the fields at the final time, the relative errors, MV and the last time.
     time = np.arange(0,T,dt)
     InternalNodes,NumberInternalNodes = InternalObjects(BoundaryNodes,Nodes)
-    ME,MV,MJ = MFDAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations) #compute the mass matrices
-    
+    BoundaryNodes = np.asarray(BoundaryNodes,dtype=int)
+    ME,MV,MJ = Assembly(J,Nodes,EdgeNodes,ElementEdges,Orientations) #compute the mass matrices
     
     #Let us construct the required matrices
-    
-    curl = primcurl(EdgeNodes,Nodes) #the primary curl
-    #D = np.zeros((len(Nodes),len(Nodes))) #this matrix will is explained in the pdf
-    D = lil_matrix((len(Nodes),len(Nodes)))
-    for i in InternalNodes:
-        D[i,i]=1
-    D = D.tocsr()
-   
-    Aprime = MV+theta*dt*( ( np.transpose(curl) ).dot(ME)+MJ ).dot(curl)#MV.dot(MJ) ).dot(curl)
-    Aprime = D.dot(Aprime)
-    #A = np.zeros((NumberInternalNodes,NumberInternalNodes))
-    A = lil_matrix((NumberInternalNodes,NumberInternalNodes))
-    
-
-    for i in range(NumberInternalNodes):
-        A[i,:] = Aprime[InternalNodes[i],InternalNodes]
-    A = A.tocsr()
-    
-    b = np.transpose(curl).dot(ME)+MJ#+MV.dot(MJ)
-    b = D.dot(b)
-    
-    #Bh = projE(InitialCond,EdgeNodes,Nodes)
-    #Bh = HighOrder3projE(InitialCond,EdgeNodes,Nodes)
-    #Bh = HighOrder5projE(InitialCond,EdgeNodes,Nodes)
+    curl   = primcurl(EdgeNodes,Nodes) #the primary curl
+    b      = ( np.transpose(curl).dot(ME)+MJ ).tocsr()
+    Aprime = ( MV+theta*dt*b.dot(curl) ).tocsr()
+    A      = Aprime[InternalNodes][:,InternalNodes].tocsc()
+    AB     = Aprime[InternalNodes][:,BoundaryNodes] #couples the internal and boundary values
+    b      = b[InternalNodes]
+    LU     = splu(A) #A is not symmetric when J is not zero
+    
+    X  = np.asarray(Nodes,dtype=float)[BoundaryNodes]
     Bh = HighOrder7projE(InitialCond,EdgeNodes,Nodes)
     Bh = np.transpose(Bh)[0]
   
     Eh = np.zeros(len(Nodes))
-    
-    
     EhInterior = np.zeros(len(Nodes)) #This is Eh in the interior
-    
-    EhBoundary = np.zeros(len(Nodes))   #This is Eh on the boundary
+    EhBoundary = np.zeros(len(Nodes)) #This is Eh on the boundary
    
+    t = None
     for t in time:
-        
         #We update the time dependant boundary conditions
         #i.e. The boundary values of the electric field
-        for NodeNumber in BoundaryNodes:
-            Node = Nodes[NodeNumber]
-            EhBoundary[NodeNumber] = EssentialBoundaryCond(Node[0],Node[1],t+theta*dt)
-        
-        #Solve  for the internal values of the electric field
-        
-        W1 = b.dot(Bh)
-        W2 = Aprime.dot(EhBoundary)
-        
-        #EhInterior[InternalNodes] = np.linalg.solve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        
-        #EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        #f = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        #EhInterior[InternalNodes] = f
-        
-        EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
+        EhBoundary[BoundaryNodes] = BoundaryValues(EssentialBoundaryCond,X[:,0],X[:,1],t+theta*dt)
         
+        #Solve for the internal values of the electric field
+        EhInterior[InternalNodes] = LU.solve(b.dot(Bh)-AB.dot(EhBoundary[BoundaryNodes]))
         Eh = EhInterior+EhBoundary
         
-        
         #Update the magnetic field
         Bh = Bh-dt*curl.dot(Eh) 
-          
      
     #Now we compute the error
     def ContB(x,y):
@@ -1564,344 +1408,51 @@ def MFDSolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,Essentia
     
     B = Bh-Bex
     E = Eh-Eex
-    #Eintex = projV(InteriorCond,Nodes)
-    #Eintex = np.transpose(Eintex)[0]
-    #EI = EhInterior - Eintex
-    #InteriorError = (MV.dot(EI).dot(EI))/(MV.dot(Eintex).dot(Eintex))
-    #InteriorError = math.sqrt(InteriorError)  
-    #MagneticError = np.transpose(B).dot(ME).dot(B)
-    #ElectricError = np.transpose(E).dot(MV).dot(E)
     
     MagneticError = (ME.dot(B).dot(B))/(ME.dot(Bex).dot(Bex))
     ElectricError = (MV.dot(E).dot(E))/(MV.dot(Eex).dot(Eex))
     
-    #MagneticError = math.sqrt(MagneticError[0,0])
-    #ElectricError = math.sqrt(ElectricError[0,0])
-    
     MagneticError = math.sqrt(MagneticError)
     ElectricError = math.sqrt(ElectricError)
     
-    return Bh,Eh,MagneticError,ElectricError
+    return Bh,Eh,EhInterior,MagneticError,ElectricError,MV,t
 
-def ESolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
-    #This routine will, provided a mesh, final time and time step, return the values of the electric and magnetic field at
-    #the given time.
-    #The boundary conditions are given above 
-    time = np.arange(0,T,dt)
-    InternalNodes,NumberInternalNodes = InternalObjects(BoundaryNodes,Nodes)
-    ME,MV,MJ = EAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations) #compute the mass matrices
-    
-    
-    #Let us construct the required matrices
-    
-    curl = primcurl(EdgeNodes,Nodes) #the primary curl
-    #D = np.zeros((len(Nodes),len(Nodes))) #this matrix will is explained in the pdf
-    D = lil_matrix((len(Nodes),len(Nodes)))
-    for i in InternalNodes:
-        D[i,i]=1
-    D = D.tocsr()
-   
-    Aprime = MV+theta*dt*( ( np.transpose(curl) ).dot(ME)+MJ ).dot(curl)#MV.dot(MJ) ).dot(curl)
-    Aprime = D.dot(Aprime)
-    #A = np.zeros((NumberInternalNodes,NumberInternalNodes))
-    A = lil_matrix((NumberInternalNodes,NumberInternalNodes))
-    
-
-    for i in range(NumberInternalNodes):
-        A[i,:] = Aprime[InternalNodes[i],InternalNodes]
-    A = A.tocsr()
-    
-    b = np.transpose(curl).dot(ME)+MJ#+MV.dot(MJ)
-    b = D.dot(b)
-    
-    #Bh = projE(InitialCond,EdgeNodes,Nodes)
-    #Bh = HighOrder3projE(InitialCond,EdgeNodes,Nodes)
-    #Bh = HighOrder5projE(InitialCond,EdgeNodes,Nodes)
-    Bh = HighOrder7projE(InitialCond,EdgeNodes,Nodes)
-    Bh = np.transpose(Bh)[0]
-  
-    Eh = np.zeros(len(Nodes))
-    
-    
-    EhInterior = np.zeros(len(Nodes)) #This is Eh in the interior
-    
-    EhBoundary = np.zeros(len(Nodes))   #This is Eh on the boundary
-   
-    
-    a = 0
-    for t in time:
-        
-        #We update the time dependant boundary conditions
-        #i.e. The boundary values of the electric field
-        for NodeNumber in BoundaryNodes:
-            Node = Nodes[NodeNumber]
-            EhBoundary[NodeNumber] = EssentialBoundaryCond(Node[0],Node[1],t+theta*dt)
-        
-        #Solve  for the internal values of the electric field
-        
-        W1 = b.dot(Bh)
-        W2 = Aprime.dot(EhBoundary)
-        
-        #EhInterior[InternalNodes] = np.linalg.solve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        
-        #EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        #f = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        #EhInterior[InternalNodes] = f
-        
-        EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        
-        Eh = EhInterior+EhBoundary
-        
-        
-        #Update the magnetic field
-        Bh = Bh-dt*curl.dot(Eh) 
-        a = a+1   
-    print(a)    
-    #Now we compute the error
-    def ContB(x,y):
-        return ExactB(x,y,T)
-    def ContE(x,y):
-        return ExactE(x,y,T-(1-theta)*dt)
-    
-    Bex = HighOrder7projE(ContB,EdgeNodes,Nodes)
-    Eex = projV(ContE,Nodes)
-    
-    Bex = np.transpose(Bex)[0]
-    Eex = np.transpose(Eex)[0]
-    
-    B = Bh-Bex
-    E = Eh-Eex
-    #Eintex = projV(InteriorCond,Nodes)
-    #Eintex = np.transpose(Eintex)[0]
-    #EI = EhInterior - Eintex
-    #InteriorError = (MV.dot(EI).dot(EI))/(MV.dot(Eintex).dot(Eintex))
-    #InteriorError = math.sqrt(InteriorError)  
-    #MagneticError = np.transpose(B).dot(ME).dot(B)
-    #ElectricError = np.transpose(E).dot(MV).dot(E)
-    
-    MagneticError = (ME.dot(B).dot(B))/(ME.dot(Bex).dot(Bex))
-    ElectricError = (MV.dot(E).dot(E))/(MV.dot(Eex).dot(Eex))
-    
-    #MagneticError = math.sqrt(MagneticError[0,0])
-    #ElectricError = math.sqrt(ElectricError[0,0])
-    
-    MagneticError = math.sqrt(MagneticError)
-    ElectricError = math.sqrt(ElectricError)
-    
-    return Bh,Eh,MagneticError,ElectricError
-
-def LSSolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
-    #This routine will, provided a mesh, final time and time step, return the values of the electric and magnetic field at
-    #the given time.
-    #The boundary conditions are given above 
-    time = np.arange(0,T,dt)
-    InternalNodes,NumberInternalNodes = InternalObjects(BoundaryNodes,Nodes)
-    ME,MV,MJ = LSAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations) #compute the mass matrices
-    
-    #Let us construct the required matrices
-    
-    curl = primcurl(EdgeNodes,Nodes) #the primary curl
-    #D = np.zeros((len(Nodes),len(Nodes))) #this matrix will is explained in the pdf
-    D = lil_matrix((len(Nodes),len(Nodes)))
-    for i in InternalNodes:
-        D[i,i]=1
-    D = D.tocsr()
-   
-    Aprime = MV+theta*dt*( ( np.transpose(curl) ).dot(ME)+MJ ).dot(curl)#MV.dot(MJ) ).dot(curl)
-    Aprime = D.dot(Aprime)
-    #A = np.zeros((NumberInternalNodes,NumberInternalNodes))
-    A = lil_matrix((NumberInternalNodes,NumberInternalNodes))
-    
-
-    for i in range(NumberInternalNodes):
-        A[i,:] = Aprime[InternalNodes[i],InternalNodes]
-    A = A.tocsr()
-    
-    b = np.transpose(curl).dot(ME)+MJ#+MV.dot(MJ)
-    b = D.dot(b)
-    
-    #Bh = projE(InitialCond,EdgeNodes,Nodes)
-    #Bh = HighOrder3projE(InitialCond,EdgeNodes,Nodes)
-    #Bh = HighOrder5projE(InitialCond,EdgeNodes,Nodes)
-    Bh = HighOrder7projE(InitialCond,EdgeNodes,Nodes)
-    Bh = np.transpose(Bh)[0]
-  
-    Eh = np.zeros(len(Nodes))
-    
-    
-    EhInterior = np.zeros(len(Nodes)) #This is Eh in the interior
-    
-    EhBoundary = np.zeros(len(Nodes))   #This is Eh on the boundary
-   
-    
-    a = 0 
-    for t in time:
-        
-        #We update the time dependant boundary conditions
-        #i.e. The boundary values of the electric field
-        for NodeNumber in BoundaryNodes:
-            Node = Nodes[NodeNumber]
-            EhBoundary[NodeNumber] = EssentialBoundaryCond(Node[0],Node[1],t+theta*dt)
-        
-        #Solve  for the internal values of the electric field
-        
-        W1 = b.dot(Bh)
-        W2 = Aprime.dot(EhBoundary)
-        
-        #EhInterior[InternalNodes] = np.linalg.solve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        
-        #EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        #f = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        #EhInterior[InternalNodes] = f
-        
-        EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        
-        Eh = EhInterior+EhBoundary
-        
-        
-        #Update the magnetic field
-        Bh = Bh-dt*curl.dot(Eh) 
-        a = a+1   
-    print(a)    
-    #Now we compute the error
-    def ContB(x,y):
-        return ExactB(x,y,T)
-    def ContE(x,y):
-        return ExactE(x,y,T-(1-theta)*dt)
-    
-    Bex = HighOrder7projE(ContB,EdgeNodes,Nodes)
-    Eex = projV(ContE,Nodes)
-    
-    Bex = np.transpose(Bex)[0]
-    Eex = np.transpose(Eex)[0]
-    
-    B = Bh-Bex
-    E = Eh-Eex
-    #MagneticError = np.transpose(B).dot(ME).dot(B)
-    #ElectricError = np.transpose(E).dot(MV).dot(E)
-    
-    MagneticError = (ME.dot(B).dot(B))/(ME.dot(Bex).dot(Bex))
-    ElectricError = (MV.dot(E).dot(E))/(MV.dot(Eex).dot(Eex))
-    
-    #MagneticError = math.sqrt(MagneticError[0,0])
-    #ElectricError = math.sqrt(ElectricError[0,0])
-    
-    MagneticError = math.sqrt(MagneticError)
-    ElectricError = math.sqrt(ElectricError)
-    
+def InteriorError(EhInterior,MV,Nodes):
+    #Relative error of the internal values of the electric field with respect to InteriorCond
     Eintex = projV(InteriorCond,Nodes)
     Eintex = np.transpose(Eintex)[0]
     EI = EhInterior - Eintex
-    InteriorError = (MV.dot(EI).dot(EI))/(MV.dot(Eintex).dot(Eintex))
-    InteriorError = math.sqrt(InteriorError)  
-    return Bh,Eh,EhInterior,MagneticError,ElectricError,InteriorError,t
+    return math.sqrt((MV.dot(EI).dot(EI))/(MV.dot(Eintex).dot(Eintex)))
 
-def GISolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
+def MFDSolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
     #This routine will, provided a mesh, final time and time step, return the values of the electric and magnetic field at
     #the given time.
     #The boundary conditions are given above 
-    time = np.arange(0,T,dt)
-    InternalNodes,NumberInternalNodes = InternalObjects(BoundaryNodes,Nodes)
-    ME,MV,MJ = GIAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations) #compute the mass matrices
-    
-    #Let us construct the required matrices
-    
-    curl = primcurl(EdgeNodes,Nodes) #the primary curl
-    #D = np.zeros((len(Nodes),len(Nodes))) #this matrix will is explained in the pdf
-    D = lil_matrix((len(Nodes),len(Nodes)))
-    for i in InternalNodes:
-        D[i,i]=1
-    D = D.tocsr()
-   
-    Aprime = MV+theta*dt*( ( np.transpose(curl) ).dot(ME)+MJ ).dot(curl)#MV.dot(MJ) ).dot(curl)
-    Aprime = D.dot(Aprime)
-    #A = np.zeros((NumberInternalNodes,NumberInternalNodes))
-    A = lil_matrix((NumberInternalNodes,NumberInternalNodes))
-    
+    Bh,Eh,EhInterior,MagneticError,ElectricError,MV,t = ThetaSolver(MFDAssembly,J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,\
+                                                                    Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta)
+    return Bh,Eh,MagneticError,ElectricError
 
-    for i in range(NumberInternalNodes):
-        A[i,:] = Aprime[InternalNodes[i],InternalNodes]
-    A = A.tocsr()
-    
-    b = np.transpose(curl).dot(ME)+MJ#+MV.dot(MJ)
-    b = D.dot(b)
-    
-    #Bh = projE(InitialCond,EdgeNodes,Nodes)
-    #Bh = HighOrder3projE(InitialCond,EdgeNodes,Nodes)
-    #Bh = HighOrder5projE(InitialCond,EdgeNodes,Nodes)
-    Bh = HighOrder7projE(InitialCond,EdgeNodes,Nodes)
-    Bh = np.transpose(Bh)[0]
-  
-    Eh = np.zeros(len(Nodes))
-    
-    
-    EhInterior = np.zeros(len(Nodes)) #This is Eh in the interior
-    
-    EhBoundary = np.zeros(len(Nodes))   #This is Eh on the boundary
-   
-    
-    a = 0
-    for t in time:
-        
-        #We update the time dependant boundary conditions
-        #i.e. The boundary values of the electric field
-        for NodeNumber in BoundaryNodes:
-            Node = Nodes[NodeNumber]
-            EhBoundary[NodeNumber] = EssentialBoundaryCond(Node[0],Node[1],t+theta*dt)
-        
-        #Solve  for the internal values of the electric field
-        
-        W1 = b.dot(Bh)
-        W2 = Aprime.dot(EhBoundary)
-        
-        #EhInterior[InternalNodes] = np.linalg.solve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        
-        #EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        #f = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        #EhInterior[InternalNodes] = f
-        
-        EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]-W2[InternalNodes]) 
-        
-        Eh = EhInterior+EhBoundary
-        
-        
-        #Update the magnetic field
-        Bh = Bh-dt*curl.dot(Eh) 
-        a = a+1   
-    print(a)    
-    #Now we compute the error
-    def ContB(x,y):
-        return ExactB(x,y,T)
-    def ContE(x,y):
-        return ExactE(x,y,T-(1-theta)*dt)
-    
-    Bex = HighOrder7projE(ContB,EdgeNodes,Nodes)
-    Eex = projV(ContE,Nodes)
-    
-    Bex = np.transpose(Bex)[0]
-    Eex = np.transpose(Eex)[0]
-    
-    B = Bh-Bex
-    E = Eh-Eex
-    #MagneticError = np.transpose(B).dot(ME).dot(B)
-    #ElectricError = np.transpose(E).dot(MV).dot(E)
-    
-    MagneticError = (ME.dot(B).dot(B))/(ME.dot(Bex).dot(Bex))
-    ElectricError = (MV.dot(E).dot(E))/(MV.dot(Eex).dot(Eex))
-    
-    #MagneticError = math.sqrt(MagneticError[0,0])
-    #ElectricError = math.sqrt(ElectricError[0,0])
-    
-    MagneticError = math.sqrt(MagneticError)
-    ElectricError = math.sqrt(ElectricError)
-    Eintex = projV(InteriorCond,Nodes)
-    Eintex = np.transpose(Eintex)[0]
-    EI = EhInterior - Eintex
-    InteriorError = (MV.dot(EI).dot(EI))/(MV.dot(Eintex).dot(Eintex)) 
-    InteriorError = math.sqrt(InteriorError)   
-    return Bh,Eh,EhInterior,MagneticError,ElectricError,InteriorError,t
+def ESolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
+    #As MFDSolver with the mass matrices of EAssembly, prints the number of time steps
+    Bh,Eh,EhInterior,MagneticError,ElectricError,MV,t = ThetaSolver(EAssembly,J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,\
+                                                                    Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta)
+    print(len(np.arange(0,T,dt)))
+    return Bh,Eh,MagneticError,ElectricError
 
+def LSSolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
+    #As MFDSolver with the mass matrices of LSAssembly, also returns the internal values of the
+    #electric field and their error
+    Bh,Eh,EhInterior,MagneticError,ElectricError,MV,t = ThetaSolver(LSAssembly,J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,\
+                                                                    Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta)
+    print(len(np.arange(0,T,dt)))
+    return Bh,Eh,EhInterior,MagneticError,ElectricError,InteriorError(EhInterior,MV,Nodes),t
 
+def GISolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
+    #As LSSolver with the mass matrices of GIAssembly
+    Bh,Eh,EhInterior,MagneticError,ElectricError,MV,t = ThetaSolver(GIAssembly,J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,\
+                                                                    Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta)
+    print(len(np.arange(0,T,dt)))
+    return Bh,Eh,EhInterior,MagneticError,ElectricError,InteriorError(EhInterior,MV,Nodes),t
 
 def SetEnergy(T,dt,theta,Pfile,task):
     #In this function we will compute and save the norms of the electric, magnetic fields
@@ -2090,66 +1641,55 @@ def SaveInmFile(name,aname,array):
         
         file.writelines('];')
 
-def tderivB(t,Bh,curl,A1,A,B,Nodes,BoundaryNodes,InternalNodes,EhBoundary,EhInterior):
-    #this function will compute the time derivative of B at t, Bh
-    for NodeNumber in BoundaryNodes:
-        Node                   = Nodes[NodeNumber]
-        EhBoundary[NodeNumber] = EssentialBoundaryCond(Node[0],Node[1],t)
-    
-    W1 = B.dot(Bh)
-    W2 = A1.dot(EhBoundary)
-    EhInterior[InternalNodes] = spsolve(A,W1[InternalNodes]+W2[InternalNodes]) 
-    
-    Eh = EhInterior+EhBoundary
+def tderivB(Bh,curl,B,LU,InternalNodes,Lift):
+    #this function will compute the time derivative of B at Bh. LU is the factorization of the
+    #internal nodal mass matrix and Lift the electric field due to the boundary values at the
+    #time of the stage (see BoundaryLifts), so only the internal values depending on Bh are solved for.
+    Eh = Lift.copy()
+    Eh[InternalNodes] = Eh[InternalNodes]+LU.solve(B.dot(Bh))
     return -curl.dot(Eh)
 
+def BoundaryLifts(EssentialBoundaryCond,Times,X,AB,LU,NumberNodes,BoundaryNodes,InternalNodes):
+    #The electric field due to the boundary values at each of the Times, as the columns of a
+    #matrix: the boundary values EssentialBoundaryCond on BoundaryNodes (at the points X) and the
+    #internal values they induce, solved for all the times in a single back substitution.
+    Lifts = np.zeros((NumberNodes,len(Times)))
+    for i in range(len(Times)):
+        Lifts[BoundaryNodes,i] = BoundaryValues(EssentialBoundaryCond,X[:,0],X[:,1],Times[i])
+    Lifts[InternalNodes] = LU.solve(AB.dot(Lifts[BoundaryNodes]))
+    return Lifts
+
 def HartSolver(J,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta):
     #This routine will, provided a mesh, final time and time step, return the values of the electric and magnetic field at
     #the given time.
     #The boundary conditions are given above 
+    #The internal nodal mass matrix is factorized once for all the stages and steps, and the three
+    #boundary lifts of every step (at t, t+dt/2 and t+dt) are computed together, as they do not
+    #depend on the stages.
     time = np.arange(0,T,dt)
     InternalNodes,NumberInternalNodes = InternalObjects(BoundaryNodes,Nodes)
+    BoundaryNodes = np.asarray(BoundaryNodes,dtype=int)
     ME,MV,MJ = EAssembly(J,Nodes,EdgeNodes,ElementEdges,Orientations) #compute the mass matrices
     
     #Let us construct the required matrices
-    
     curl = primcurl(EdgeNodes,Nodes) #the primary curl
-    #D = np.zeros((len(Nodes),len(Nodes))) #this matrix will is explained in the pdf
-    D = lil_matrix((len(Nodes),len(Nodes)))
-    for i in InternalNodes:
-        D[i,i]=1
-    D = D.tocsr()
-   
-    A1 = D.dot(MV)
-    A = lil_matrix((NumberInternalNodes,NumberInternalNodes))
-    for i in range(NumberInternalNodes):
-        A[i,:] = A1[InternalNodes[i],InternalNodes]
-    A = A.tocsr()
-    
-    B = np.transpose(curl).dot(ME)-MJ
-    B = D.dot(B)
+    MV   = MV.tocsr()
+    LU   = splu(MV[InternalNodes][:,InternalNodes].tocsc())
+    AB   = MV[InternalNodes][:,BoundaryNodes] #couples the internal and boundary values
+    B    = ( np.transpose(curl).dot(ME)-MJ ).tocsr()[InternalNodes]
+    X    = np.asarray(Nodes,dtype=float)[BoundaryNodes]
 
     Bh = HighOrder7projE(InitialCond,EdgeNodes,Nodes)
     Bh = np.transpose(Bh)[0]
-  
-    Eh = np.zeros(len(Nodes))
-    
-    
-    EhInterior = np.zeros(len(Nodes)) #This is Eh in the interior
-    
-    EhBoundary = np.zeros(len(Nodes))   #This is Eh on the boundary
-   
-    
     
     for t in time:
-        
-        k1 = tderivB(t,Bh,curl,A1,A,B,Nodes,BoundaryNodes,InternalNodes,EhBoundary,EhInterior)
-        k2 = tderivB(t+0.5*dt,Bh+0.5*k1,curl,A1,A,B,Nodes,BoundaryNodes,InternalNodes,EhBoundary,EhInterior)
-        k3 = tderivB(t+0.5*dt,Bh+0.5*k2,curl,A1,A,B,Nodes,BoundaryNodes,InternalNodes,EhBoundary,EhInterior)
-        k4 = tderivB(t+dt,Bh+k3,curl,A1,A,B,Nodes,BoundaryNodes,InternalNodes,EhBoundary,EhInterior)
+        Lifts = BoundaryLifts(EssentialBoundaryCond,[t,t+0.5*dt,t+dt],X,AB,LU,len(Nodes),BoundaryNodes,InternalNodes)
+        k1 = tderivB(Bh,curl,B,LU,InternalNodes,Lifts[:,0])
+        k2 = tderivB(Bh+0.5*k1,curl,B,LU,InternalNodes,Lifts[:,1])
+        k3 = tderivB(Bh+0.5*k2,curl,B,LU,InternalNodes,Lifts[:,1])
+        k4 = tderivB(Bh+k3,curl,B,LU,InternalNodes,Lifts[:,2])
         #Update the magnetic field
         Bh = Bh+(dt/6)*(k1+k2+k3+k4) 
-           
         
     #Now we compute the error
     def ContB(x,y):
@@ -0,0 +1,264 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from MeshHelios import HeliosMesh
+from Transfer import RTCoefficients
+from Transfer import TransferFields
+
+#Adaptive mesh refinement for PDEFullMHD: element-wise error indicators (ErrorIndicators),
+#Dorfler marking (DorflerMarking), refinement of the marked polygons (RefineMesh) and transfer
+#of the state to the refined mesh (TransferState), put together in AdaptiveLoop. The refined
+#polygons are split joining their centroid with the midpoints of their sides, as in a quadtree.
+#The midpoints are hanging nodes of the unrefined neighbours, which simply become polygons with
+#more vertices, as in the locally refined meshes of MarcosMeshGen (AMRmesh.txt, locrefs_quads).
+
+def EntityCells(Mesh,Kind):
+    #(NumEntities x NumElements) matrix sharing a quantity of every entity of Kind (see
+    #StateLayout) equally among the elements around it
+    if Kind == 'Cell':
+        n = len(Mesh.ElementEdges)
+        return coo_matrix((np.ones(n),(np.arange(n),np.arange(n))),shape=(n,n)).tocsr()
+    Cells = Mesh.NodestoCells if Kind in ('Node','AllNode') else Mesh.EdgestoCells
+    rows  = np.repeat(np.arange(len(Cells)),[len(c) for c in Cells])
+    cols  = np.concatenate([np.asarray(c,dtype=int) for c in Cells])
+    vals  = np.repeat([1/len(c) for c in Cells],[len(c) for c in Cells])
+    return coo_matrix((vals,(rows,cols)),shape=(len(Cells),len(Mesh.ElementEdges))).tocsr()
+
+def ResidualIndicators(PDE,Residual,Layout=None):
+    #Square of a residual of the vectors of Layout (MHDLayout by default), e.g. PDE.MHDG at the
+    #initial guess of a time step, on every element. The rows are weak residuals, tested with the
+    #basis function of an entity, and are shared among the elements around it.
+    Layout = PDE.MHDLayout if Layout is None else Layout
+    Eta2   = np.zeros(len(PDE.Mesh.ElementEdges),dtype=float)
+    for k in range(len(Layout.Kinds)):
+        r        = np.zeros(Layout.Sizes[k],dtype=float)
+        r[Layout.Interior[k]] = np.asarray(Residual)[Layout.Positions[k]]
+        Eta2    += EntityCells(PDE.Mesh,Layout.Kinds[k]).T.dot(r**2)
+    return Eta2
+
+def DivergenceIndicators(PDE):
+    #Square of the L2 norm of DIVu on every element
+    return PDE.Mesh.Areas*PDE.CellDivergence(PDE.unx,PDE.uny,PDE.umx,PDE.umy)**2
+
+def JumpIndicators(PDE):
+    #Jump of Pi_RT B across the internal edges, h_e times the square of its L2 norm on the edge
+    #(evaluated at the midpoint), shared equally by the two elements of the edge
+    Mesh     = PDE.Mesh
+    Coeffs   = RTCoefficients(PDE,PDE.B)
+    Internal = np.array([e for e in range(len(Mesh.EdgeNodes)) if len(Mesh.EdgestoCells[e]) == 2],dtype=int)
+    Cells    = np.array([Mesh.EdgestoCells[e] for e in Internal],dtype=int).reshape(-1,2)
+    X        = np.asarray(Mesh.MidNodes,dtype=float)[Internal]
+    C1, C2   = Coeffs[Cells[:,0]], Coeffs[Cells[:,1]]
+    Jump     = np.stack((C1[:,0]-C2[:,0]+(C1[:,2]-C2[:,2])*X[:,0],C1[:,1]-C2[:,1]+(C1[:,2]-C2[:,2])*X[:,1]),axis=1)
+    Local    = 0.5*Mesh.EdgeLengths[Internal]**2*np.sum(Jump**2,axis=1)
+    return np.bincount(Cells.ravel(),weights=np.repeat(Local,2),minlength=len(Mesh.ElementEdges))
+
+def ErrorIndicators(PDE,Residual=None,Weights=(1,1,1)):
+    #Squared element-wise indicators, the weighted sum of ResidualIndicators (if Residual is
+    #given), DivergenceIndicators and JumpIndicators
+    Eta2 = Weights[1]*DivergenceIndicators(PDE)+Weights[2]*JumpIndicators(PDE)
+    if Residual is not None:
+        Eta2 = Eta2+Weights[0]*ResidualIndicators(PDE,Residual)
+    return Eta2
+
+def DorflerMarking(Eta2,Theta=0.5):
+    #The fewest elements whose squared indicators add up to at least Theta times the total
+    Order  = np.argsort(Eta2)[::-1]
+    Total  = np.cumsum(Eta2[Order])
+    Count  = np.searchsorted(Total,Theta*Total[-1])+1
+    Marked = np.zeros(len(Eta2),dtype=bool)
+    Marked[Order[0:min(Count,len(Eta2))]] = True
+    return Marked
+
+class Refinement:
+    #A refined mesh and its relation to the mesh it comes from. Parent[c] is the old element
+    #holding element c. EdgeParent[e] is the old edge holding edge e (with the same direction),
+    #or -1 for the edges inside refined elements. Refined marks the old elements that were split.
+    def __init__(self,Mesh,Parent,EdgeParent,Refined):
+        self.Mesh, self.Parent         = Mesh, Parent
+        self.EdgeParent, self.Refined  = EdgeParent, Refined
+
+def Corners(X,Tol=1E-8):
+    #The vertices of the polygon X (counterclockwise) where its boundary turns. The others are
+    #hanging nodes, lying inside a side of the polygon.
+    D0, D1 = X-np.roll(X,1,axis=0), np.roll(X,-1,axis=0)-X
+    Cross  = D0[:,0]*D1[:,1]-D0[:,1]*D1[:,0]
+    return np.abs(Cross) > Tol*np.sqrt(np.sum(D0**2,axis=1)*np.sum(D1**2,axis=1))
+
+def SideMidpoints(Mesh,c):
+    #The corners of element c and the midpoints of its sides, as positions in its local edges
+    #(Mesh.ElementPtr[c]+k is local edge k, starting at vertex k). A midpoint is (k,None) if it is
+    #vertex k and (k,t) if it lies inside local edge k, at t times its length from the start.
+    Ptr    = Mesh.ElementPtr
+    X      = Mesh.NodeArray[Mesh.FlatStart[Ptr[c]:Ptr[c+1]]]
+    n      = len(X)
+    Corner = np.nonzero(Corners(X))[0]
+    Length = Mesh.EdgeLengths[Mesh.FlatEdges[Ptr[c]:Ptr[c+1]]]
+    Mids   = []
+    for i in range(len(Corner)):
+        Side = [(Corner[i]+j)%n for j in range((Corner[(i+1)%len(Corner)]-Corner[i]-1)%n+1)]
+        s    = np.concatenate(([0],np.cumsum(Length[Side])))
+        Half = s[-1]/2
+        j    = np.argmin(np.abs(s-Half))
+        if abs(s[j]-Half) <= 1E-8*s[-1]:
+            Mids.append((Side[j%len(Side)],None))
+        else:
+            j = np.searchsorted(s,Half)-1
+            Mids.append((Side[j],(Half-s[j])/Length[Side[j]]))
+    return Corner,Mids
+
+def SplitPoints(Mesh,Marked):
+    #The points where the sides of the marked elements are split, as the fractions of the
+    #length (from EdgeNodes[e][0]) of the edges e holding them
+    Split = {}
+    for c in np.nonzero(Marked)[0]:
+        for k, t in SideMidpoints(Mesh,c)[1]:
+            if t is not None:
+                f = Mesh.ElementPtr[c]+k
+                Split.setdefault(Mesh.FlatEdges[f],set()).add(round(t if Mesh.FlatOri[f] > 0 else 1-t,12))
+    return Split
+
+def RefinementClosure(Mesh,Marked,MaxVertices=8):
+    #Also marks the elements that would be left with more than MaxVertices vertices by the
+    #hanging nodes of their refined neighbours. Returns the marks and SplitPoints.
+    Marked = np.array(Marked,dtype=bool)
+    Sizes  = np.diff(Mesh.ElementPtr)
+    while True:
+        Split  = SplitPoints(Mesh,Marked)
+        Count  = np.zeros(len(Mesh.EdgeNodes))
+        for e, t in Split.items():
+            Count[e] = len(t)
+        Grown  = Sizes+np.bincount(Mesh.FlatElement,weights=Count[Mesh.FlatEdges],minlength=len(Sizes))
+        New    = (~Marked) & (Grown > MaxVertices)
+        if not New.any():
+            return Marked,Split
+        Marked = Marked | New
+
+def RefineMesh(Mesh,Marked,MaxVertices=8):
+    #Splits the marked elements (boolean array or indices) after RefinementClosure, see the top
+    #of the file. The sides of an element are the chains of its edges between its corners, each
+    #child holds one corner and goes from the midpoint of the side before it to that of the
+    #side after it, so that earlier hanging nodes stay where they are. Returns a Refinement.
+    if not hasattr(Mesh,'Areas'):
+        Mesh.MakeGeometry()
+    if np.asarray(Marked).dtype != bool:
+        Mask = np.zeros(len(Mesh.ElementEdges),dtype=bool)
+        Mask[np.asarray(Marked,dtype=int)] = True
+        Marked = Mask
+    Marked, Split = RefinementClosure(Mesh,Marked,MaxVertices)
+    Nodes     = [list(Node) for Node in Mesh.Nodes]
+    EdgeNodes, EdgeParent = [], []
+    def AddEdge(a,b,Parent):
+        EdgeNodes.append([a,b])
+        EdgeParent.append(Parent)
+        return len(EdgeNodes)-1
+    #Every old edge becomes a chain of new edges, stored as the list of (edge,start,end) in its
+    #direction. NewNode[(e,t)] is the node added at the split point t of edge e.
+    Pieces, NewNode = [], {}
+    X = Mesh.NodeArray
+    for e, (a,b) in enumerate(Mesh.EdgeNodes):
+        Chain = [a]
+        for t in sorted(Split.get(e,())):
+            Nodes.append(((1-t)*X[a]+t*X[b]).tolist())
+            NewNode[(e,t)] = len(Nodes)-1
+            Chain.append(len(Nodes)-1)
+        Chain.append(b)
+        Pieces.append([(AddEdge(p,q,e),p,q) for p,q in zip(Chain[0:-1],Chain[1:])])
+    def Boundary(Local):
+        #The new edges along the old local edge, counterclockwise, as (edge,orientation,start)
+        e, o = Mesh.FlatEdges[Local], Mesh.FlatOri[Local]
+        return [(p[0],1,p[1]) for p in Pieces[e]] if o > 0 else [(p[0],-1,p[2]) for p in reversed(Pieces[e])]
+    ElementEdges, Orientations, Parent = [], [], []
+    for c in range(len(Mesh.ElementEdges)):
+        Edges = [Edge for k in range(Mesh.ElementPtr[c],Mesh.ElementPtr[c+1]) for Edge in Boundary(k)]
+        if not Marked[c]:
+            ElementEdges.append([Edge[0] for Edge in Edges])
+            Orientations.append([Edge[1] for Edge in Edges])
+            Parent.append(c)
+            continue
+        #Positions of the side midpoints in the new boundary, child k goes from midpoint k-1 to k
+        Corner, Mids = SideMidpoints(Mesh,c)
+        Start        = [Edge[2] for Edge in Edges]
+        Position     = []
+        for k, t in Mids:
+            f = Mesh.ElementPtr[c]+k
+            if t is None:
+                Position.append(Start.index(Mesh.FlatStart[f]))
+            else:
+                Position.append(Start.index(NewNode[(Mesh.FlatEdges[f],round(t if Mesh.FlatOri[f] > 0 else 1-t,12))]))
+        Nodes.append(list(Mesh.Centroids[c]))
+        Center = len(Nodes)-1
+        Spokes = [AddEdge(Center,Start[p],-1) for p in Position]
+        n      = len(Edges)
+        for k in range(len(Position)):
+            Side = [Edges[(Position[k-1]+j)%n] for j in range((Position[k]-Position[k-1])%n)]
+            ElementEdges.append([Spokes[k-1]]+[Edge[0] for Edge in Side]+[Spokes[k]])
+            Orientations.append([1]+[Edge[1] for Edge in Side]+[-1])
+            Parent.append(c)
+    New = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    New.MakeGeometry()
+    return Refinement(New,np.array(Parent,dtype=int),np.array(EdgeParent,dtype=int),Marked)
+
+def TransferB(Old,New,R,B):
+    #The edge dofs B of PDE Old on the refinement R of its mesh (with PDE New), keeping the
+    #fluxes: an edge inside an old edge keeps its dof (the mean normal component). The dofs of the
+    #spokes of a split element are the mean normal components of Pi_RT B, corrected with the least
+    #change that gives every child the flux of its parent times its share of the area.
+    OldMesh, Mesh = Old.Mesh, New.Mesh
+    B      = np.asarray(B,dtype=float)
+    Inside = R.EdgeParent < 0
+    Out    = np.zeros(len(Mesh.EdgeNodes),dtype=float)
+    Out[~Inside] = B[R.EdgeParent[~Inside]]
+    Coeffs = RTCoefficients(Old,B)
+    Flux   = OldMesh.Operator('Div').dot(B)
+    X, EN  = Mesh.NodeArray, np.asarray(Mesh.EdgeNodes,dtype=int)
+    for c in np.nonzero(R.Refined)[0]:
+        Children = np.nonzero(R.Parent == c)[0]
+        Flat     = np.concatenate([np.arange(Mesh.ElementPtr[k],Mesh.ElementPtr[k+1]) for k in Children])
+        Spokes   = np.unique(Mesh.FlatEdges[Flat][Inside[Mesh.FlatEdges[Flat]]])
+        X1, X2   = X[EN[Spokes,0]], X[EN[Spokes,1]]
+        Xm       = (X1+X2)/2
+        Normal   = np.stack((X2[:,1]-X1[:,1],X1[:,0]-X2[:,0]),axis=1)/Mesh.EdgeLengths[Spokes][:,None]
+        s0       = (Coeffs[c,0]+Coeffs[c,2]*Xm[:,0])*Normal[:,0]+(Coeffs[c,1]+Coeffs[c,2]*Xm[:,1])*Normal[:,1]
+        #Flux of every child through its spokes (D) and through the rest of its boundary (Rest)
+        D, Rest  = np.zeros((len(Children),len(Spokes))), np.zeros(len(Children))
+        for i, k in enumerate(Children):
+            for f in range(Mesh.ElementPtr[k],Mesh.ElementPtr[k+1]):
+                e, w = Mesh.FlatEdges[f], Mesh.FlatOri[f]*Mesh.EdgeLengths[Mesh.FlatEdges[f]]
+                if Inside[e]:
+                    D[i,np.searchsorted(Spokes,e)] += w
+                else:
+                    Rest[i] += w*Out[e]
+        Target       = Flux[c]*Mesh.Areas[Children]/OldMesh.Areas[c]-Rest
+        Out[Spokes]  = s0+np.linalg.lstsq(D,Target-D.dot(s0),rcond=None)[0]
+    return Out
+
+def TransferState(Old,New,R):
+    #Sets the state of PDE New, on the refinement R of the mesh of PDE Old, from that of Old.
+    #u, E and p are transferred as in Transfer.TransferFields, B with TransferB.
+    Fields = TransferFields(Old,New,{Name:getattr(Old,Name) for Name in ('unx','uny','umx','umy','E','p')})
+    Fields['B'] = TransferB(Old,New,R,Old.B)
+    New.State.Assign(tuple(Fields[Name] for Name in New.MHDFieldNames))
+    New.BindState()
+
+def AdaptiveLoop(PDE,Build,Solve,Theta=0.5,Tol=0,MaxElements=np.inf,MaxLevels=10,MaxVertices=8,Verbose=False):
+    #Solves, estimates and refines until the estimate sqrt(sum Eta2) is below Tol, the mesh has
+    #more than MaxElements elements or MaxLevels refinements were done. Build(Mesh) returns a
+    #PDEFullMHD on Mesh set up as PDE (data, boundary conditions and sources). Solve(PDE) solves
+    #the problem from the state of PDE (transferred from the previous mesh) and returns the
+    #residual for ResidualIndicators, or None. Returns the last PDE and the list of
+    #(NumElements,NumDOF,Estimate) of every mesh, which is also printed if Verbose.
+    History = []
+    for Level in range(MaxLevels+1):
+        Residual = Solve(PDE)
+        Eta2     = ErrorIndicators(PDE,Residual)
+        Estimate = np.sqrt(np.sum(Eta2))
+        History.append((len(PDE.Mesh.ElementEdges),PDE.MHDLayout.NumDOF,Estimate))
+        if Verbose:
+            print('Level '+str(Level)+': '+str(History[-1][0])+' elements, estimate = '+str(Estimate))
+        if Estimate <= Tol or Level == MaxLevels or History[-1][0] >= MaxElements:
+            break
+        R   = RefineMesh(PDE.Mesh,DorflerMarking(Eta2,Theta),MaxVertices)
+        New = Build(R.Mesh)
+        TransferState(PDE,New,R)
+        PDE = New
+    return PDE,History
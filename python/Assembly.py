@@ -0,0 +1,46 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+class ColouredAssembler:
+    #Runs element loops on a pool of threads. The elements of one colour of
+    #Mesh.ElementColouring share no node or edge, so their contributions to global nodal or
+    #edge arrays can be added concurrently without races; the colours are processed one after
+    #the other. The kernels should spend their time in NumPy calls, which release the GIL.
+    #With Threads = 1 everything runs in the calling thread.
+    def __init__(self,Mesh,Threads=1):
+        self.Mesh, self.Pool = Mesh, None
+        self.SetThreads(Threads)
+
+    def SetThreads(self,Threads):
+        self.Close()
+        self.Threads = max(1,int(Threads))
+        self.Pool    = ThreadPoolExecutor(self.Threads) if self.Threads > 1 else None
+
+    def Close(self):
+        #Shuts the pool down, the loops then run in the calling thread
+        if getattr(self,'Pool',None) is not None:
+            self.Pool.shutdown()
+        self.Pool, self.Threads = None, 1
+
+    def __del__(self):
+        self.Close()
+
+    def Run(self,Func,Cells):
+        #Func(Chunk) on the chunks of Cells, returns the list of results in order
+        Chunks = [Chunk for Chunk in np.array_split(np.asarray(Cells,dtype=int),self.Threads) if len(Chunk) > 0]
+        if self.Pool is None or len(Chunks) == 1:
+            return [Func(Chunk) for Chunk in Chunks]
+        return list(self.Pool.map(Func,Chunks))
+
+    def Scatter(self,Kernel,Out):
+        #Kernel(Cells,Out) adds the contributions of the elements Cells into Out
+        for Colour in self.Mesh.ElementColouring():
+            self.Run(lambda Cells: Kernel(Cells,Out),Colour)
+        return Out
+
+    def Map(self,Func,Cells=None):
+        #[Func(c) for c in Cells] (all the elements by default), for independent element computations
+        if Cells is None:
+            Cells = np.arange(len(self.Mesh.ElementEdges))
+        Results = self.Run(lambda Chunk: [Func(c) for c in Chunk],Cells)
+        return [Result for Chunk in Results for Result in Chunk]
@@ -1,5 +1,6 @@
 from PDEClass import PDEFullMHD
 from MeshHelios import HeliosMesh
+from Sources import SteadyData
 import numpy as np
 import math
 from Solver import InexactNewtonTimeInt
@@ -92,7 +93,9 @@ for MType in MTypes:
         Mesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
         dt = 0.00000005*dx[i]**2
         PDE    = PDEFullMHD(Mesh,Re,Rm,Inu,InB,dt,theta)
-        PDE.SetMHDBCandSource(ub,Eb,f,h)
+        #None of the data depends on time, it is evaluated once.
+        PDE.SetMHDBCandSource(SteadyData(lambda xv: ub(xv,0)),SteadyData(lambda xv: Eb(xv,0)),\
+                              SteadyData(lambda xv: f(xv,0)),SteadyData(lambda xv: h(xv,0)))
         Solver = InexactNewtonTimeInt()
         time   = np.arange(0,T,dt)
         for t in time:
@@ -102,8 +105,7 @@ for MType in MTypes:
             print('uny='+str(PDE.uny))
 
             tempx = Solver.Newtoniter(PDE.MHDG,PDE.MHDConcatenate(PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p),PDE.SetNumMHDDof(),1E-4,5000,PDE)
-            PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p = PDE.MHDUpdateInt(tempx,PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p)
-            PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.E             = PDE.MHDUpdateBC(PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.E)
+            PDE.MHDAdvance(tempx)
         i = i+1
         SaveInmFile('funx','unx',PDE.unx)
         SaveInmFile('funy','uny',PDE.uny)
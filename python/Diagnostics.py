@@ -0,0 +1,52 @@
+import numpy as np
+import math
+from scipy.sparse import coo_matrix
+
+#This class gathers the divergence diagnostics that are monitored during a run.
+#The divergence operators and the areas of the elements are built once from the mesh,
+#afterwards each norm costs one sparse mat-vec and one dot product.
+class DivergenceDiagnostics(object):
+    def __init__(self,Mesh):
+        self.Mesh  = Mesh
+        self.FluxB = Mesh.Operator('Div')     #flux of the edge dofs out of each element
+        self.DivB  = Mesh.Operator('AreaDiv') #cellwise divergence of the edge dofs
+        self.Areas = Mesh.Areas
+        self.DivU  = self.MakeDivU()
+
+    def MakeDivU(self):
+        #This routine assembles the cellwise divergence of a field in TVh, as computed by PDEFullMHD.DIVu,
+        #acting on the vector (unx,uny,umx,umy). On every edge Simpson's rule gives
+        #(u(start)+4u(mid)+u(end)).en/6 where en is the outward normal times the length.
+        Mesh   = self.Mesh
+        nN, nE = len(Mesh.Nodes), len(Mesh.EdgeNodes)
+        X      = Mesh.NodeArray
+        s, e   = Mesh.FlatStart, Mesh.FlatEnd
+        enx    = X[e,1]-X[s,1]
+        eny    = X[s,0]-X[e,0]
+        scale  = 1/(6*self.Areas[Mesh.FlatElement])
+        rows   = np.tile(Mesh.FlatElement,6)
+        cols   = np.concatenate((s,e,nN+s,nN+e,2*nN+Mesh.FlatEdges,2*nN+nE+Mesh.FlatEdges))
+        vals   = np.concatenate((enx,enx,eny,eny,4*enx,4*eny))*np.tile(scale,6)
+        return coo_matrix((vals,(rows,cols)),shape=(len(Mesh.ElementEdges),2*nN+2*nE)).tocsr()
+
+    def BDivSquared(self,B):
+        #Sum of A*flux^2 over the elements with the fluxes of BDiv, this is the divB monitored by the drivers.
+        #It is not a norm of div B (it scales as h^4 times the norm), BDivL2Squared gives the L2 norm.
+        flux = self.FluxB.dot(B)
+        return flux.dot(self.Areas*flux)
+
+    def BDivL2Squared(self,B):
+        #Square of the L2 norm of the divergence of B, sum of A*(flux/A)^2 = flux^2/A over the elements.
+        divB = self.DivB.dot(B)
+        return divB.dot(self.Areas*divB)
+
+    def BDivL2Norm(self,B):
+        return math.sqrt(self.BDivL2Squared(B))
+
+    def uDivSquared(self,unx,uny,umx,umy):
+        #Square of the L2 norm of the divergence of u, this is the mass error.
+        divu = self.DivU.dot(np.concatenate((unx,uny,umx,umy)))
+        return divu.dot(self.Areas*divu)
+
+    def uDivL2Norm(self,unx,uny,umx,umy):
+        return math.sqrt(self.uDivSquared(unx,uny,umx,umy))
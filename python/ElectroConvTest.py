@@ -3,6 +3,7 @@ from MeshHelios import HeliosMesh
 import numpy as np
 import math
 from Solver import InexactNewtonTimeInt
+from Transfer import MeshSequence
 import pickle
 
 def ProcessedMesh(Pfile):
@@ -14,6 +15,9 @@ Re,Rm,theta   = 1, 1, 0.5
 T                = 0.25
 #MTypes = ['Trig','Quad','Vor']
 MTypes = ['OnlyOne']
+#Nested iteration: the Newton guess on each mesh is the previous state plus the increment of the
+#run on the previous (coarser) mesh, transferred to it, see Transfer.MeshSequence
+Sequencing = False
 def InB(xv):
     return np.array([0,math.cos(xv[0])])
 def Inu(xv):
@@ -48,6 +52,7 @@ for MType in MTypes:
         0.008787156237382746]
 
     i = 0
+    Sequence = MeshSequence(('B','E'))
     for Pfile in ProcessedFiles:
         print(Pfile)
         Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh(Pfile)
@@ -57,12 +62,19 @@ for MType in MTypes:
         PDE.SetElectroBCAndSource(h,Eb)
         Solver = InexactNewtonTimeInt()
         time   = np.arange(0,T,dt)
+        if Sequencing:
+            Sequence.Record(PDE,0)
         for t in time:
             PDE.ElectroComputeBC(t)
             PDE.Electroupdateh(t)
-            tempx = Solver.Newtoniter(PDE.ElectroG,PDE.ElectroConcatenate(),PDE.NumElectroDOF(),1E-5,50)
+            x0    = Sequence.Guess(PDE,t+dt,PDE.ElectroLayout,Start=t,Residual=PDE.ElectroG) if Sequencing else None
+            if x0 is None:
+                x0 = PDE.ElectroConcatenate()
+            tempx = Solver.Newtoniter(PDE.ElectroG,x0,PDE.NumElectroDOF(),1E-5,50)
             PDE.ElectroUpdateUnknownDOFs(tempx)
             PDE.E = PDE.ElectroupdateBC(PDE.E)
+            if Sequencing:
+                Sequence.Record(PDE,t+dt)
 
         def exactB(xv):
             Bx = 0
@@ -82,4 +94,6 @@ for MType in MTypes:
 
         print('ElectricErr = '+str(L2E))
         print('MagneticErr = '+str(L2B))
+        if Sequencing:
+            Sequence.NextMesh()
         i = i+1
\ No newline at end of file
@@ -0,0 +1,165 @@
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+#Element kernels over the flat (CSR) connectivity of HeliosMesh: the local edge f of element c is
+#f in range(Ptr[c],Ptr[c+1]), it goes from node Start[f] to node End[f] and it is the global edge
+#Edges[f] with orientation Ori[f]. X is Mesh.NodeArray.
+#Every kernel exists as a plain loop, which is JIT compiled when numba is installed ('numba'
+#backend) and runs as is in the 'python' backend, and vectorized with NumPy ('numpy' backend).
+#All the backends return the same values, the backend is chosen with SetBackend.
+
+##########################################################################################
+#Loop kernels
+def LoopDivU(Ptr,Start,End,Edges,X,Areas,unx,uny,umx,umy):
+    #Divergence of the TVh field u on every element, as DIVu
+    NEl = len(Ptr)-1
+    Div = np.zeros(NEl)
+    for c in range(NEl):
+        S = 0.0
+        for f in range(Ptr[c],Ptr[c+1]):
+            a, b, e = Start[f], End[f], Edges[f]
+            S = S+(unx[a]+unx[b]+4*umx[e])*(X[b,1]-X[a,1])+(uny[a]+uny[b]+4*umy[e])*(X[a,0]-X[b,0])
+        Div[c] = S/(6*Areas[c])
+    return Div
+
+def LoopTVhColumns(Ptr,Start,End,Edges,X,Centroids,Areas,unx,uny,umx,umy):
+    #TVhSemiInProdColumn of the TVh field u on every element, returns a (NumElements,12) array
+    NEl = len(Ptr)-1
+    Col = np.zeros((NEl,12))
+    for c in range(NEl):
+        S = 0.0 #6*A times the divergence, as in LoopDivU
+        for f in range(Ptr[c],Ptr[c+1]):
+            a, b, e        = Start[f], End[f], Edges[f]
+            x1, y1, x2, y2 = X[a,0], X[a,1], X[b,0], X[b,1]
+            xh, yh         = 0.5*(x1+x2), 0.5*(y1+y2)
+            en0, en1       = y2-y1, x1-x2
+            u1x, u1y, uhx, uhy, u2x, u2y = unx[a], uny[a], umx[e], umy[e], unx[b], uny[b]
+            Col[c,0]  += u1x+uhx
+            Col[c,1]  += u1y+uhy
+            Col[c,2]  += (en0/6)*(u1x+4*uhx+u2x)
+            Col[c,3]  += (en0/6)*(u1y+4*uhy+u2y)
+            Col[c,4]  += (en1/6)*(u1x+4*uhx+u2x)
+            Col[c,5]  += (en1/6)*(u1y+4*uhy+u2y)
+            udn1, udnh, udn2 = u1x*en0+u1y*en1, uhx*en0+uhy*en1, u2x*en0+u2y*en1
+            S          = S+udn1+4*udnh+udn2
+            Col[c,6]  += (en0/3)*(x1*u1x+4*xh*uhx+x2*u2x)-(1/3)*(x1*udn1+4*xh*udnh+x2*udn2)
+            Col[c,7]  += (en0/3)*(x1*u1y+4*xh*uhy+x2*u2y)-(1/3)*(y1*udn1+4*yh*udnh+y2*udn2)
+            Col[c,8]  += (en1/3)*(y1*u1x+4*yh*uhx+y2*u2x)-(1/3)*(x1*udn1+4*xh*udnh+x2*udn2)
+            Col[c,9]  += (en1/3)*(y1*u1y+4*yh*uhy+y2*u2y)-(1/3)*(y1*udn1+4*yh*udnh+y2*udn2)
+            Col[c,10] += (1/6)*((y1*en0+x1*en1)*u1x+4*(yh*en0+xh*en1)*uhx+(y2*en0+x2*en1)*u2x)
+            Col[c,11] += (1/6)*((y1*en0+x1*en1)*u1y+4*(yh*en0+xh*en1)*uhy+(y2*en0+x2*en1)*u2y)
+        T2 = 2*Areas[c]*(S/(6*Areas[c]))
+        Col[c,6] += T2*Centroids[c,0]
+        Col[c,7] += T2*Centroids[c,1]
+        Col[c,8] += T2*Centroids[c,0]
+        Col[c,9] += T2*Centroids[c,1]
+    return Col
+
+def LoopRTMoments(Ptr,Start,End,Edges,Ori,X,B):
+    #PiRTBB of the global edge dofs B on every element, returns a (NumElements,3) array
+    NEl = len(Ptr)-1
+    BB  = np.zeros((NEl,3))
+    for c in range(NEl):
+        for f in range(Ptr[c],Ptr[c+1]):
+            a, b           = Start[f], End[f]
+            x1, y1, x2, y2 = X[a,0], X[a,1], X[b,0], X[b,1]
+            xh, yh         = (x1+x2)/2, (y1+y2)/2
+            ell            = np.sqrt((x2-x1)**2+(y2-y1)**2)
+            w              = Ori[f]*B[Edges[f]]
+            BB[c,0] += w*(ell/6)*(x1+4*xh+x2)
+            BB[c,1] += w*(ell/6)*(y1+4*yh+y2)
+            BB[c,2] += w*(ell/12)*((x1**2+y1**2)+4*(xh**2+yh**2)+(x2**2+y2**2))
+    return BB
+
+def LoopLocalTriplets(Ptr,Index,Blocks):
+    #COO triplets of the global matrix assembled from the local matrices of every element.
+    #Blocks holds the local matrices raveled (row major) one after the other, the local dof i
+    #of element c is the global dof Index[Ptr[c]+i].
+    NEl  = len(Ptr)-1
+    Num  = 0
+    for c in range(NEl):
+        Num = Num+(Ptr[c+1]-Ptr[c])**2
+    Rows = np.zeros(Num,dtype=np.int64)
+    Cols = np.zeros(Num,dtype=np.int64)
+    k    = 0
+    for c in range(NEl):
+        for i in range(Ptr[c],Ptr[c+1]):
+            for j in range(Ptr[c],Ptr[c+1]):
+                Rows[k], Cols[k] = Index[i], Index[j]
+                k = k+1
+    return Rows,Cols,Blocks[0:Num]
+
+##########################################################################################
+#NumPy kernels
+def FlatOwner(Ptr):
+    return np.repeat(np.arange(len(Ptr)-1),np.diff(Ptr))
+
+def NumpyDivU(Ptr,Start,End,Edges,X,Areas,unx,uny,umx,umy):
+    S = (unx[Start]+unx[End]+4*umx[Edges])*(X[End,1]-X[Start,1])+(uny[Start]+uny[End]+4*umy[Edges])*(X[Start,0]-X[End,0])
+    return np.bincount(FlatOwner(Ptr),weights=S,minlength=len(Ptr)-1)/(6*Areas)
+
+def NumpyTVhColumns(Ptr,Start,End,Edges,X,Centroids,Areas,unx,uny,umx,umy):
+    x1, y1, x2, y2 = X[Start,0], X[Start,1], X[End,0], X[End,1]
+    xh, yh         = 0.5*(x1+x2), 0.5*(y1+y2)
+    en0, en1       = y2-y1, x1-x2
+    u1x, u1y, uhx, uhy, u2x, u2y = unx[Start], uny[Start], umx[Edges], umy[Edges], unx[End], uny[End]
+    udn1, udnh, udn2 = u1x*en0+u1y*en1, uhx*en0+uhy*en1, u2x*en0+u2y*en1
+    Terms = [u1x+uhx, u1y+uhy,
+             (en0/6)*(u1x+4*uhx+u2x), (en0/6)*(u1y+4*uhy+u2y),
+             (en1/6)*(u1x+4*uhx+u2x), (en1/6)*(u1y+4*uhy+u2y),
+             (en0/3)*(x1*u1x+4*xh*uhx+x2*u2x)-(1/3)*(x1*udn1+4*xh*udnh+x2*udn2),
+             (en0/3)*(x1*u1y+4*xh*uhy+x2*u2y)-(1/3)*(y1*udn1+4*yh*udnh+y2*udn2),
+             (en1/3)*(y1*u1x+4*yh*uhx+y2*u2x)-(1/3)*(x1*udn1+4*xh*udnh+x2*udn2),
+             (en1/3)*(y1*u1y+4*yh*uhy+y2*u2y)-(1/3)*(y1*udn1+4*yh*udnh+y2*udn2),
+             (1/6)*((y1*en0+x1*en1)*u1x+4*(yh*en0+xh*en1)*uhx+(y2*en0+x2*en1)*u2x),
+             (1/6)*((y1*en0+x1*en1)*u1y+4*(yh*en0+xh*en1)*uhy+(y2*en0+x2*en1)*u2y)]
+    Owner = FlatOwner(Ptr)
+    Col   = np.stack([np.bincount(Owner,weights=T,minlength=len(Ptr)-1) for T in Terms],axis=1)
+    T2    = 2*Areas*NumpyDivU(Ptr,Start,End,Edges,X,Areas,unx,uny,umx,umy)
+    Col[:,6:10] += (T2[:,None]*Centroids)[:,[0,1,0,1]]
+    return Col
+
+def NumpyRTMoments(Ptr,Start,End,Edges,Ori,X,B):
+    x1, y1, x2, y2 = X[Start,0], X[Start,1], X[End,0], X[End,1]
+    xh, yh         = (x1+x2)/2, (y1+y2)/2
+    ell            = np.sqrt((x2-x1)**2+(y2-y1)**2)
+    w              = Ori*B[Edges]
+    Terms = [w*(ell/6)*(x1+4*xh+x2),w*(ell/6)*(y1+4*yh+y2),w*(ell/12)*((x1**2+y1**2)+4*(xh**2+yh**2)+(x2**2+y2**2))]
+    Owner = FlatOwner(Ptr)
+    return np.stack([np.bincount(Owner,weights=T,minlength=len(Ptr)-1) for T in Terms],axis=1)
+
+def NumpyLocalTriplets(Ptr,Index,Blocks):
+    Sizes = np.diff(Ptr)
+    Owner = np.repeat(np.arange(len(Sizes)),Sizes**2)
+    #Position of every block entry inside its block
+    Pos   = np.arange(len(Owner))-np.repeat(np.concatenate(([0],np.cumsum(Sizes**2)))[0:-1],Sizes**2)
+    n     = Sizes[Owner]
+    return Index[Ptr[Owner]+Pos//n],Index[Ptr[Owner]+Pos%n],Blocks[0:len(Owner)]
+
+##########################################################################################
+Names    = ('DivU','TVhColumns','RTMoments','LocalTriplets')
+Backends = {'python': dict(zip(Names,(LoopDivU,LoopTVhColumns,LoopRTMoments,LoopLocalTriplets))),
+            'numpy' : dict(zip(Names,(NumpyDivU,NumpyTVhColumns,NumpyRTMoments,NumpyLocalTriplets)))}
+if numba is not None:
+    Backends['numba'] = dict(zip(Names,(numba.njit(cache=True)(Loop) for Loop in (LoopDivU,LoopTVhColumns,LoopRTMoments,LoopLocalTriplets))))
+
+Current = 'numba' if numba is not None else 'numpy'
+
+def AvailableBackends():
+    return list(Backends.keys())
+
+def SetBackend(Name):
+    #Selects the kernels used from now on
+    global Current
+    if Name not in Backends:
+        raise ValueError('Unknown kernel backend '+str(Name)+', available: '+str(AvailableBackends()))
+    Current = Name
+
+def GetBackend():
+    return Current
+
+def Kernel(Name):
+    return Backends[Current][Name]
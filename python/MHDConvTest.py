@@ -4,6 +4,7 @@ from MeshHelios import HeliosMesh
 import numpy as np
 import math
 from Solver import InexactNewtonTimeInt
+from Transfer import MeshSequence
 import pickle
 import time as tim
 
@@ -33,6 +34,9 @@ T                = 0.005
 #MTypes = ['Trig','Quad','Vor']
 #MTypes = ['OnlyOne']
 MTypes = ['Small']
+#Nested iteration: the Newton guess on each mesh is the previous state plus the increment of the
+#run on the previous (coarser) mesh, transferred to it, see Transfer.MeshSequence
+Sequencing = False
 def exactu(xv,t):
     return np.array([math.exp(t)*math.cos(xv[1]),0])
 def exactB(xv,t):
@@ -90,6 +94,7 @@ for MType in MTypes:
         ProcessedFiles = ['PTh=0.101015.txt']
         dx = [0.408248,0.2,0.101015]
     i = 0
+    Sequence = MeshSequence()
     for Pfile in ProcessedFiles:
         print(Pfile)
         uL.append(Pfile)
@@ -104,14 +109,11 @@ for MType in MTypes:
         PDE.SetMHDBCandSource(exactu,exactE,f,h)
         Solver = InexactNewtonTimeInt()
         time   = np.arange(0,T,dt)
+        if Sequencing:
+            Sequence.Record(PDE,0)
         for t in time:
-            Masserr = 0
-            for j in range(len(Mesh.ElementEdges)):
-                lunx,luny,lumx,lumy = PDE.GetLocalTVhDOF(j,PDE.unx,PDE.uny,PDE.umx,PDE.umy)
-                divu, A = PDE.DIVu(j,lunx,luny,lumx,lumy)
-                Masserr = Masserr+PDE.PhInProd(i,divu*A,divu*A)
-            Masserr = math.sqrt(Masserr)
-            divB = PDE.BDivSquared(PDE.B)
+            Masserr = PDE.Diagnostics.uDivL2Norm(PDE.unx,PDE.uny,PDE.umx,PDE.umy)
+            divB    = PDE.BDivSquared(PDE.B)
 
             divus.append(Masserr)
             divBs.append(divB)
@@ -121,10 +123,14 @@ for MType in MTypes:
             unx,uny,umx,umy,B,E,p = PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p
             unx,uny,umx,umy,E = PDE.MHDUpdateBC(unx,uny,umx,umy,E)
             print('here1')
-            tempx = Solver.Newtoniter(PDE.MHDG,PDE.MHDConcatenate(PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p),PDE.SetNumMHDDof(),1E-4,5,PDE,unx,uny,umx,umy,B,E,p)
+            x0    = Sequence.Guess(PDE,t+dt,Start=t,Residual=PDE.MHDG) if Sequencing else None
+            if x0 is None:
+                x0 = PDE.MHDConcatenate(PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p)
+            tempx = Solver.Newtoniter(PDE.MHDG,x0,PDE.SetNumMHDDof(),1E-4,5,PDE,unx,uny,umx,umy,B,E,p)
             #print('time='+str(end-start))
-            PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p = PDE.MHDUpdateInt(tempx,PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p)
-            PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.E             = PDE.MHDUpdateBC(PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.E)
+            PDE.MHDAdvance(tempx)
+            if Sequencing:
+                Sequence.Record(PDE,t+dt)
             divB = PDE.BDivSquared(PDE.B)
             print('----------------------------------------------------')
             #print('finished Newton Iterations')
@@ -149,21 +155,12 @@ for MType in MTypes:
         exunx,exuny = PDE.DecompIntoCoord(tempxun)
         tempxum     = PDE.NodalDOFs(exu,Mesh.MidNodes)
         exumx,exumy = PDE.DecompIntoCoord(tempxum)
-        unxerr,unyerr = PDE.unx-exunx,PDE.uny-exuny
-        umxerr,umyerr = PDE.umx-exumx,PDE.umy-exumy
-        L2u           = PDE.TVhL2Norm(unxerr,unyerr,umxerr,umyerr)
-
         Barr = PDE.MagDOFs(exB)
-        Berr = Barr-PDE.B
-        L2B  = PDE.EhL2Norm(Berr)
-        
         Earr = PDE.NodalDOFs(exE,PDE.Mesh.Nodes)
-        Eerr = Earr-PDE.E
-        L2E  = PDE.VhL2Norm(Eerr)
-
         parr = PDE.PhDOF(exp)
-        perr = parr-PDE.p
-        L2p  = PDE.PhL2Norm(perr)
+        Errs = PDE.ErrorNorms({'u':('TVh',PDE.TVhVector(PDE.unx,PDE.uny,PDE.umx,PDE.umy),PDE.TVhVector(exunx,exuny,exumx,exumy)),\
+                               'B':('Eh',PDE.B,Barr),'E':('Vh',PDE.E,Earr),'p':('Ph',PDE.p,parr)})
+        L2u,L2B,L2E,L2p = Errs['u'],Errs['B'],Errs['E'],Errs['p']
 
         print('VelErr = '+str(L2u))
         print('ElectricErr = '+str(L2E))
@@ -174,6 +171,8 @@ for MType in MTypes:
         BL.append(L2B)
         EL.append(L2E)
         pL.append(L2p)
+        if Sequencing:
+            Sequence.NextMesh()
         
         i = i+1
     print('uL'+str(uL))
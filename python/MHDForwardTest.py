@@ -114,12 +114,7 @@ for MType in MTypes:
         momerr  = PDE.TVhL2Norm(fnx,fny,fmx,fmy)
         Farerr  = PDE.EhL2Norm(farf)
         Elecerr = PDE.VhL2Norm(elecf)
-        Masserr = 0
-        for j in range(len(Mesh.ElementEdges)):
-            lunx,luny,lumx,lumy = PDE.GetLocalTVhDOF(j,PDE.unx,PDE.uny,PDE.umx,PDE.umy)
-            divu, A = PDE.DIVu(j,lunx,luny,lumx,lumy)
-            Masserr = Masserr+PDE.PhInProd(i,divu*A,divu*A)
-        Masserr = math.sqrt(Masserr)
+        Masserr = PDE.Diagnostics.uDivL2Norm(PDE.unx,PDE.uny,PDE.umx,PDE.umy)
 
         print('momerr='+str(momerr))
         print('Farerr='+str(Farerr))
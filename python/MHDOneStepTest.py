@@ -112,8 +112,7 @@ for MType in MTypes:
             PDE.MHDComputeBC(t)
             PDE.MHDComputeSources(t)
             tempx = Solver.FlowSolve(PDE.MHDG,PDE.MHDConcatenate(PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p),PDE.SetNumMHDDof(),50,1e-5)
-            PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p = PDE.MHDUpdateInt(tempx,PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.B,PDE.E,PDE.p)
-            PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.E             = PDE.MHDUpdateBC(PDE.unx,PDE.uny,PDE.umx,PDE.umy,PDE.E)
+            PDE.MHDAdvance(tempx)
 
         def exu(xv):
             return exactu(xv,T)
@@ -0,0 +1,171 @@
+import numpy as np
+import pickle
+from scipy.spatial import Delaunay
+
+#Generation of the mesh families of the convergence tests on [-1,1]^2: clipped Voronoi meshes
+#('Vor', the PVh files), structured triangulations ('Trig', PTh) and randomly perturbed quads
+#('Quad', PertPQh), see GenerateMesh. Everything is vectorized over the elements, the polygons
+#are given as a list of points and a flat list of vertices (ElementPtr as in HeliosMesh) and
+#PolygonMesh turns them into the input of HeliosMesh.
+
+def PolygonMesh(X,Ptr,Vertices,Tol=1E-9):
+    #Nodes,EdgeNodes,ElementEdges,Orientations of the polygons whose vertices are
+    #Vertices[Ptr[c]:Ptr[c+1]] (indices in the points X, in either orientation). Points closer
+    #than Tol times the size of the domain are merged, unused points dropped, the polygons made
+    #counterclockwise, and the edges numbered from (min,max) pairs of nodes, with orientation 1
+    #where the polygon goes from EdgeNodes[e][0] to EdgeNodes[e][1]. The elements are returned
+    #sorted by their number of edges.
+    X        = np.asarray(X,dtype=float)
+    Ptr      = np.asarray(Ptr,dtype=int)
+    Vertices = np.asarray(Vertices,dtype=int)
+    #Merge close points and drop the repeated vertices this leaves in the polygons
+    Low      = X[Vertices].min(axis=0)
+    Scale    = Tol*np.max(X[Vertices].max(axis=0)-Low)
+    Grid     = np.round((X-Low)/Scale).astype(np.int64)
+    Keys, Node = np.unique(Grid[:,0]*(int(np.max(Grid[:,1]))+1)+Grid[:,1],return_inverse=True)
+    Element  = np.repeat(np.arange(len(Ptr)-1),np.diff(Ptr))
+    V        = Node[Vertices]
+    Next     = np.arange(1,len(V)+1)
+    Next[Ptr[1:]-1] = Ptr[0:-1]
+    Keep     = V != V[Next]
+    V, Element = V[Keep], Element[Keep]
+    Sizes    = np.bincount(Element,minlength=len(Ptr)-1)
+    #Drop the unused points
+    Used, V  = np.unique(V,return_inverse=True)
+    Nodes    = np.zeros((len(Keys),2))
+    np.add.at(Nodes,Node,X)
+    Nodes    = (Nodes/np.bincount(Node,minlength=len(Keys))[:,None])[Used]
+    #Sort the elements by size so they can be reshaped size by size
+    Order    = np.argsort(Sizes,kind='stable')
+    Start    = np.concatenate(([0],np.cumsum(Sizes)))
+    Sizes    = Sizes[Order]
+    Flat     = np.concatenate([(Start[Order][Sizes == k][:,None]+np.arange(k)).ravel() for k in np.unique(Sizes)])
+    V        = V[Flat]
+    Ptr      = np.concatenate(([0],np.cumsum(Sizes)))
+    Element  = np.repeat(np.arange(len(Sizes)),Sizes)
+    Next     = np.arange(1,len(V)+1)
+    Next[Ptr[1:]-1] = Ptr[0:-1]
+    #Make the polygons counterclockwise
+    Cross    = Nodes[V,0]*Nodes[V[Next],1]-Nodes[V[Next],0]*Nodes[V,1]
+    Reverse  = np.bincount(Element,weights=Cross,minlength=len(Sizes)) < 0
+    Local    = np.arange(len(V))-Ptr[Element]
+    Flip     = Reverse[Element]
+    V        = np.where(Flip,V[Ptr[Element]+(Sizes[Element]-1-Local)],V)
+    #Edges
+    a, b     = V, V[Next]
+    Pairs    = np.minimum(a,b)*len(Nodes)+np.maximum(a,b)
+    Unique, Edge = np.unique(Pairs,return_inverse=True)
+    EdgeNodes = np.stack((Unique//len(Nodes),Unique%len(Nodes)),axis=1)
+    Ori      = np.where(a < b,1,-1)
+    ElementEdges, Orientations = [], []
+    for k in np.unique(Sizes):
+        Rows = slice(Ptr[np.searchsorted(Sizes,k)],Ptr[np.searchsorted(Sizes,k,side='right')])
+        ElementEdges.extend(Edge[Rows].reshape(-1,k).tolist())
+        Orientations.extend(Ori[Rows].reshape(-1,k).tolist())
+    return Nodes.tolist(),EdgeNodes.tolist(),ElementEdges,Orientations
+
+def GridPoints(n):
+    #The (n+1)^2 points of the uniform n x n grid of [-1,1]^2, numbered row by row
+    t = np.linspace(-1,1,n+1)
+    x, y = np.meshgrid(t,t)
+    return np.stack((x.ravel(),y.ravel()),axis=1)
+
+def GridCells(n):
+    #Lower left corner of every cell of the n x n grid
+    i, j = np.meshgrid(np.arange(n),np.arange(n))
+    return (j*(n+1)+i).ravel()
+
+def TriangleMesh(h):
+    #Structured triangulation, the cells of the uniform grid of size about h split along alternating
+    #diagonals
+    n  = max(1,int(np.ceil(2/h)))
+    X  = GridPoints(n)
+    c  = GridCells(n)
+    Corners = np.stack((c,c+1,c+n+2,c+n+1),axis=1)
+    Even    = ((c//(n+1)+c%(n+1))%2 == 0)[:,None]
+    T1 = np.where(Even,Corners[:,[0,1,2]],Corners[:,[0,1,3]])
+    T2 = np.where(Even,Corners[:,[0,2,3]],Corners[:,[1,2,3]])
+    T  = np.concatenate((T1,T2))
+    return PolygonMesh(X,3*np.arange(len(T)+1),T.ravel())
+
+def QuadMesh(h,Perturbation=0.25,Seed=0):
+    #Quadrilaterals of the uniform grid of size about h with every internal node moved at random
+    #by up to Perturbation times the size of the cells in each direction
+    n  = max(1,int(np.ceil(2/h)))
+    X  = GridPoints(n)
+    Internal = np.all(np.abs(X) < 1-1E-12,axis=1)
+    X[Internal] += (2/n)*Perturbation*np.random.default_rng(Seed).uniform(-1,1,(np.sum(Internal),2))
+    c  = GridCells(n)
+    Q  = np.stack((c,c+1,c+n+2,c+n+1),axis=1)
+    return PolygonMesh(X,4*np.arange(len(Q)+1),Q.ravel())
+
+def VoronoiMesh(h,Seed=0,Lloyd=0,Jitter=0.5):
+    #Voronoi cells of about (2/h)^2 seeds (a grid of size h, each seed moved by up to Jitter times
+    #h) clipped to [-1,1]^2 by reflecting the seeds near the boundary across it. Lloyd iterations
+    #move the seeds to the centroids of their cells before the last diagram.
+    n     = max(1,int(np.ceil(2/h)))
+    s     = 2/n
+    t     = np.linspace(-1+s/2,1-s/2,n)
+    x, y  = np.meshgrid(t,t)
+    Seeds = np.stack((x.ravel(),y.ravel()),axis=1)
+    Seeds = Seeds+s*Jitter*np.random.default_rng(Seed).uniform(-0.5,0.5,Seeds.shape)
+    for Iteration in range(Lloyd+1):
+        X, Ptr, Vertices = ClippedVoronoi(Seeds,3*s)
+        if Iteration < Lloyd:
+            Seeds = PolygonCentroids(X,Ptr,Vertices)
+    return PolygonMesh(X,Ptr,Vertices)
+
+def ClippedVoronoi(Seeds,Band):
+    #Vertices (X, Ptr, Vertices as in PolygonMesh) of the Voronoi cells of the seeds in [-1,1]^2,
+    #clipped to the square. The cells of the seeds within Band of a side are cut by the side as the
+    #seeds are reflected across it. The cells are built from the Delaunay triangulation, which
+    #qhull computes faster than the diagram: the vertices of the cell of a seed are the
+    #circumcentres of its triangles, sorted by angle around it.
+    Points = [Seeds]
+    for Axis in range(2):
+        for Side in (-1,1):
+            Near      = Seeds[np.abs(Seeds[:,Axis]-Side) < Band]
+            Mirror    = Near.copy()
+            Mirror[:,Axis] = 2*Side-Near[:,Axis]
+            Points.append(Mirror)
+    Points   = np.concatenate(Points)
+    T        = Delaunay(Points).simplices
+    A, B, C  = Points[T[:,0]], Points[T[:,1]], Points[T[:,2]]
+    b, c     = B-A, C-A
+    D        = 2*(b[:,0]*c[:,1]-b[:,1]*c[:,0])
+    b2, c2   = np.sum(b**2,axis=1), np.sum(c**2,axis=1)
+    X        = A+np.stack((c[:,1]*b2-b[:,1]*c2,b[:,0]*c2-c[:,0]*b2),axis=1)/D[:,None]
+    Triangle, Corner = np.nonzero(T < len(Seeds))
+    Seed     = T[Triangle,Corner]
+    Angle    = np.arctan2(X[Triangle,1]-Seeds[Seed,1],X[Triangle,0]-Seeds[Seed,0])
+    Order    = np.lexsort((Angle,Seed))
+    Sizes    = np.bincount(Seed,minlength=len(Seeds))
+    return np.clip(X,-1,1),np.concatenate(([0],np.cumsum(Sizes))),Triangle[Order]
+
+def PolygonCentroids(X,Ptr,Vertices):
+    Element = np.repeat(np.arange(len(Ptr)-1),np.diff(Ptr))
+    Next    = np.arange(1,len(Vertices)+1)
+    Next[Ptr[1:]-1] = Ptr[0:-1]
+    P, Q    = X[Vertices], X[Vertices[Next]]
+    Cross   = P[:,0]*Q[:,1]-Q[:,0]*P[:,1]
+    Area    = np.bincount(Element,weights=Cross)
+    return np.stack((np.bincount(Element,weights=(P[:,0]+Q[:,0])*Cross),\
+                     np.bincount(Element,weights=(P[:,1]+Q[:,1])*Cross)),axis=1)/(3*Area[:,None])
+
+def GenerateMesh(Family,h,**Options):
+    #Nodes,EdgeNodes,ElementEdges,Orientations of a mesh of Family ('Vor', 'Trig' or 'Quad') of
+    #size about h, the Options being passed to VoronoiMesh, TriangleMesh or QuadMesh
+    Generators = {'Vor':VoronoiMesh,'Trig':TriangleMesh,'Quad':QuadMesh}
+    if Family not in Generators:
+        raise ValueError('Unknown mesh family '+str(Family))
+    return Generators[Family](h,**Options)
+
+def BoundaryNodes(Nodes,Tol=1E-5):
+    #The nodes on the boundary of [-1,1]^2, as found by HeliosMesh
+    X = np.asarray(Nodes,dtype=float)
+    return np.nonzero(np.any(np.abs(np.abs(X)-1) < Tol,axis=1))[0].tolist()
+
+def SaveMesh(File,Nodes,EdgeNodes,ElementEdges,Orientations):
+    #Pickles the mesh as the PTh/PVh/PertPQh files, to be read with ProcessedMesh
+    with open(File,'wb') as fp:
+        pickle.dump([Nodes,EdgeNodes,ElementEdges,BoundaryNodes(Nodes),Orientations],fp)
@@ -1,4 +1,6 @@
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.spatial import cKDTree
 #Attributes:
 #Nodes is a list of the coordinates of the nodes
 #EdgeNodes are a list of the edges, each element of this list is a pair with the each component being the position of the node in Nodes
@@ -6,15 +8,27 @@ import numpy as np
 #BoundaryNodes is list of the positions in Nodes of the nodes along the boundary of the domain
 #Each element in Ortientations corresponds to the element in the same spot in ElementEdges. A 1 is placed in the ordering of the edge
 #accords with the divergence Theorem. A -1 is placed if this is not the case.
+#The domain must be [-1,1]^2, the nodes on its sides are the boundary nodes (see MakeNumBoundaryNodes).
+#Reorder is optional, it can be 'RCM' (reverse Cuthill-McKee on the node graph) or 'Hilbert' (Hilbert-curve
+#ordering of the element centroids). The renumbering maps are kept, NodePerm[i] is the position in the input
+#of the ith node and NodeInvPerm is its inverse. The same holds for EdgePerm and ElementPerm.
 class HeliosMesh(object):
-    def __init__(self,Nodes,EdgeNodes,ElementEdges,Orientations):
+    def __init__(self,Nodes,EdgeNodes,ElementEdges,Orientations,Reorder=None):
         self.Nodes            = Nodes
         self.EdgeNodes        = EdgeNodes
         self.ElementEdges     = ElementEdges 
         self.Orientations     = Orientations
 
+        if Reorder is not None:
+            self.Renumber(Reorder)
+        else:
+            self.NodePerm    = np.arange(len(Nodes))
+            self.EdgePerm    = np.arange(len(EdgeNodes))
+            self.ElementPerm = np.arange(len(ElementEdges))
+            self.NodeInvPerm,self.EdgeInvPerm,self.ElementInvPerm = self.NodePerm,self.EdgePerm,self.ElementPerm
+        self.Operators = {} #Cache of the discrete operators, see Operator
         self.MakeNumBoundaryNodes()
-        self.BNodes = [Nodes[i] for i in self.NumBoundaryNodes]
+        self.BNodes = [self.Nodes[i] for i in self.NumBoundaryNodes]
         self.MakeDictionaries()
         self.ComputeMidponts() #This adds an array with the midpoints of every edge. It is in the same order as the edges
         self.ComputeBMidpoints() #Computes the boundary midpoints
@@ -124,4 +138,281 @@ class HeliosMesh(object):
             xiplusone = Vertices[i+1][0]
             yiplusone = Vertices[i+1][1]
             A         = A+xi*yiplusone-xiplusone*yi
-        return 0.5*A,Vertices,Edges
\ No newline at end of file
+        return 0.5*A,Vertices,Edges
+
+    ##################################################################################
+    #Renumbering
+    def Renumber(self,Method):
+        #This routine permutes Nodes, EdgeNodes, ElementEdges and Orientations consistently.
+        #The direction of every edge is kept, hence the orientations only move with their element.
+        if Method == 'RCM':
+            NodePerm,EdgePerm,ElementPerm = self.RCMOrdering()
+        elif Method == 'Hilbert':
+            NodePerm,EdgePerm,ElementPerm = self.HilbertOrdering()
+        else:
+            raise ValueError('Unknown reordering '+str(Method))
+        NodeInvPerm = np.empty(len(NodePerm),dtype=int)
+        NodeInvPerm[NodePerm] = np.arange(len(NodePerm))
+        EdgeInvPerm = np.empty(len(EdgePerm),dtype=int)
+        EdgeInvPerm[EdgePerm] = np.arange(len(EdgePerm))
+        ElementInvPerm = np.empty(len(ElementPerm),dtype=int)
+        ElementInvPerm[ElementPerm] = np.arange(len(ElementPerm))
+
+        self.Nodes        = [self.Nodes[i] for i in NodePerm]
+        self.EdgeNodes    = [[int(NodeInvPerm[v1]),int(NodeInvPerm[v2])] for v1,v2 in (self.EdgeNodes[e] for e in EdgePerm)]
+        self.ElementEdges = [[int(EdgeInvPerm[e]) for e in self.ElementEdges[c]] for c in ElementPerm]
+        self.Orientations = [self.Orientations[c] for c in ElementPerm]
+
+        self.NodePerm,self.EdgePerm,self.ElementPerm          = NodePerm,EdgePerm,ElementPerm
+        self.NodeInvPerm,self.EdgeInvPerm,self.ElementInvPerm = NodeInvPerm,EdgeInvPerm,ElementInvPerm
+
+    def RCMOrdering(self):
+        #Reverse Cuthill-McKee on the graph whose vertices are the nodes and whose edges are the mesh edges.
+        #Edges are then sorted by their new endpoints and elements by their first new edge.
+        from scipy.sparse.csgraph import reverse_cuthill_mckee
+        EN       = np.array(self.EdgeNodes,dtype=int)
+        nN       = len(self.Nodes)
+        rows     = np.concatenate((EN[:,0],EN[:,1]))
+        cols     = np.concatenate((EN[:,1],EN[:,0]))
+        Graph    = coo_matrix((np.ones(len(rows)),(rows,cols)),shape=(nN,nN)).tocsr()
+        NodePerm = np.asarray(reverse_cuthill_mckee(Graph,symmetric_mode=True),dtype=int)
+        NodeInvPerm = np.empty(nN,dtype=int)
+        NodeInvPerm[NodePerm] = np.arange(nN)
+
+        NewEN       = NodeInvPerm[EN]
+        EdgePerm    = np.lexsort((NewEN.max(axis=1),NewEN.min(axis=1)))
+        EdgeInvPerm = np.empty(len(EdgePerm),dtype=int)
+        EdgeInvPerm[EdgePerm] = np.arange(len(EdgePerm))
+        FirstEdge   = [min(EdgeInvPerm[e] for e in Element) for Element in self.ElementEdges]
+        ElementPerm = np.argsort(FirstEdge,kind='stable')
+        return NodePerm,EdgePerm,ElementPerm
+
+    def HilbertOrdering(self,Order=16):
+        #Elements are sorted along a Hilbert curve through their centroids. Edges and nodes are then
+        #numbered in the order in which they are first met when traversing the sorted elements.
+        C = np.array([self.Centroid(self.ElementEdges[c],self.Orientations[c])[0:2] for c in range(len(self.ElementEdges))])
+        ElementPerm = np.argsort(self.HilbertIndex(C,Order),kind='stable')
+
+        EdgePerm, SeenEdges = [], np.zeros(len(self.EdgeNodes),dtype=bool)
+        NodePerm, SeenNodes = [], np.zeros(len(self.Nodes),dtype=bool)
+        for c in ElementPerm:
+            for e in self.ElementEdges[c]:
+                if not SeenEdges[e]:
+                    SeenEdges[e] = True
+                    EdgePerm.append(e)
+                    for v in self.EdgeNodes[e]:
+                        if not SeenNodes[v]:
+                            SeenNodes[v] = True
+                            NodePerm.append(v)
+        #Edges or nodes that belong to no element keep their relative order at the end.
+        EdgePerm = np.concatenate((EdgePerm,np.flatnonzero(~SeenEdges))).astype(int)
+        NodePerm = np.concatenate((NodePerm,np.flatnonzero(~SeenNodes))).astype(int)
+        return NodePerm,EdgePerm,ElementPerm
+
+    def HilbertIndex(self,Points,Order):
+        #Position along the Hilbert curve of order Order of each point, the points are first scaled to the bounding box.
+        n     = 2**Order
+        Lo    = Points.min(axis=0)
+        Width = np.maximum(Points.max(axis=0)-Lo,1E-300)
+        x     = np.minimum(((Points[:,0]-Lo[0])/Width[0]*n).astype(np.int64),n-1)
+        y     = np.minimum(((Points[:,1]-Lo[1])/Width[1]*n).astype(np.int64),n-1)
+        d     = np.zeros(len(Points),dtype=np.int64)
+        s     = n//2
+        while s>0:
+            rx = ((x & s)>0).astype(np.int64)
+            ry = ((y & s)>0).astype(np.int64)
+            d  = d+s*s*((3*rx)^ry)
+            #Rotate the quadrant
+            flip    = (ry == 0)&(rx == 1)
+            x[flip] = s-1-x[flip]
+            y[flip] = s-1-y[flip]
+            swap    = (ry == 0)
+            x[swap],y[swap] = y[swap],x[swap].copy()
+            s = s//2
+        return d
+
+    def NodesToInput(self,Arr):
+        #Given an array over the nodes of this mesh return it in the numbering of the input mesh.
+        return np.asarray(Arr)[self.NodeInvPerm]
+
+    def EdgesToInput(self,Arr):
+        return np.asarray(Arr)[self.EdgeInvPerm]
+
+    def ElementsToInput(self,Arr):
+        return np.asarray(Arr)[self.ElementInvPerm]
+
+    ##################################################################################
+    #Discrete operators
+    def MakeFlatConnectivity(self):
+        #Stores the connectivity in compressed form, the local edges of element c are
+        #FlatEdges[ElementPtr[c]:ElementPtr[c+1]]. FlatElement gives the element of each entry.
+        #FlatStart and FlatEnd are the vertices of each local edge once it has been oriented
+        #as in StandardElement, so that FlatStart lists the vertices of every element counterclockwise.
+        Sizes            = np.array([len(Element) for Element in self.ElementEdges],dtype=int)
+        self.ElementPtr  = np.concatenate(([0],np.cumsum(Sizes)))
+        self.FlatEdges   = np.concatenate([np.asarray(Element,dtype=int) for Element in self.ElementEdges])
+        self.FlatOri     = np.concatenate([np.asarray(self.Orientations[c][0:Sizes[c]],dtype=float) for c in range(len(Sizes))])
+        self.FlatElement = np.repeat(np.arange(len(Sizes)),Sizes)
+        EN               = np.asarray(self.EdgeNodes,dtype=int)[self.FlatEdges]
+        self.FlatStart   = np.where(self.FlatOri>0,EN[:,0],EN[:,1])
+        self.FlatEnd     = np.where(self.FlatOri>0,EN[:,1],EN[:,0])
+
+    def MakeGeometry(self):
+        #Vectorized versions of the edge lengths and of the area and centroid given by Centroid.
+        self.MakeFlatConnectivity()
+        X                = np.asarray(self.Nodes,dtype=float)
+        EN               = np.asarray(self.EdgeNodes,dtype=int)
+        self.NodeArray   = X
+        self.EdgeLengths = np.sqrt(np.sum((X[EN[:,1]]-X[EN[:,0]])**2,axis=1))
+        x1,y1 = X[self.FlatStart,0],X[self.FlatStart,1]
+        x2,y2 = X[self.FlatEnd,0],  X[self.FlatEnd,1]
+        Cross = x1*y2-x2*y1
+        NEl   = len(self.ElementEdges)
+        self.Areas     = 0.5*np.bincount(self.FlatElement,weights=Cross,minlength=NEl)
+        self.Centroids = np.stack((np.bincount(self.FlatElement,weights=(x1+x2)*Cross,minlength=NEl),\
+                                   np.bincount(self.FlatElement,weights=(y1+y2)*Cross,minlength=NEl)),axis=1)/(6*self.Areas[:,None])
+
+    def Operator(self,Name):
+        #Returns, as a csr matrix, one of the discrete operators of the mesh. They are built once and cached.
+        #'NodeEdge'    : (NumEdges x NumNodes) incidence, -1 at the first node of an edge and 1 at the second.
+        #'EdgeElement' : (NumElements x NumEdges) incidence, the orientation of the edge in the element.
+        #'Grad'        : (NumEdges x NumNodes) tangential derivative along each edge.
+        #'Curl'        : (NumEdges x NumNodes) primary curl, the normal component of the curl of a nodal
+        #                function. The normal is the tangent rotated by pi/2, so it agrees with 'Grad'.
+        #'Div'         : (NumElements x NumEdges) flux of the edge dofs out of each element.
+        #'AreaDiv'     : (NumElements x NumEdges) 'Div' divided by the area, i.e. the divergence itself.
+        if Name in self.Operators:
+            return self.Operators[Name]
+        if not hasattr(self,'Areas'):
+            self.MakeGeometry()
+        nN, nE, nEl = len(self.Nodes), len(self.EdgeNodes), len(self.ElementEdges)
+        EN = np.asarray(self.EdgeNodes,dtype=int)
+        if Name == 'NodeEdge':
+            rows = np.repeat(np.arange(nE),2)
+            vals = np.tile([-1.0,1.0],nE)
+            Op   = coo_matrix((vals,(rows,EN.ravel())),shape=(nE,nN)).tocsr()
+        elif Name == 'EdgeElement':
+            Op   = coo_matrix((self.FlatOri,(self.FlatElement,self.FlatEdges)),shape=(nEl,nE)).tocsr()
+        elif Name == 'Grad' or Name == 'Curl':
+            Op   = CurlMatrix(self.NodeArray,EN,self.EdgeLengths)
+        elif Name == 'Div':
+            vals = self.FlatOri*self.EdgeLengths[self.FlatEdges]
+            Op   = coo_matrix((vals,(self.FlatElement,self.FlatEdges)),shape=(nEl,nE)).tocsr()
+        elif Name == 'AreaDiv':
+            vals = self.FlatOri*self.EdgeLengths[self.FlatEdges]/self.Areas[self.FlatElement]
+            Op   = coo_matrix((vals,(self.FlatElement,self.FlatEdges)),shape=(nEl,nE)).tocsr()
+        else:
+            raise ValueError('Unknown operator '+str(Name))
+        self.Operators[Name] = Op
+        return Op
+
+    def ElementColouring(self):
+        #Splits the elements in colours such that two elements of the same colour share no node,
+        #and so no edge. The contributions of the elements of one colour to nodal or edge arrays
+        #can then be added concurrently. Greedy colouring in the order of the elements, cached.
+        #Returns a list with the array of elements of each colour.
+        if getattr(self,'Colouring',None) is not None:
+            return self.Colouring
+        if not hasattr(self,'Areas'):
+            self.MakeGeometry()
+        Colour = -np.ones(len(self.ElementEdges),dtype=int)
+        for c in range(len(self.ElementEdges)):
+            Used = set()
+            for Node in self.FlatStart[self.ElementPtr[c]:self.ElementPtr[c+1]]:
+                Used.update(Colour[self.NodestoCells[Node]])
+            k = 0
+            while k in Used:
+                k = k+1
+            Colour[c] = k
+        self.Colouring = [np.nonzero(Colour == k)[0] for k in range(Colour.max()+1)]
+        return self.Colouring
+
+    ##################################################################################
+    #Point location
+    def ContainsPoints(self,Elements,Points,Tol=1E-10):
+        #For every pair (Elements[i],Points[i]) tells whether the point lies in the (closed) element.
+        #The elements are assumed to be convex, which includes collinear vertices as in hanging nodes.
+        if not hasattr(self,'Areas'):
+            self.MakeGeometry()
+        Elements = np.asarray(Elements,dtype=int)
+        Sizes    = self.ElementPtr[Elements+1]-self.ElementPtr[Elements]
+        Pair     = np.repeat(np.arange(len(Elements)),Sizes)
+        First    = np.concatenate(([0],np.cumsum(Sizes)))[0:-1]
+        Flat     = self.ElementPtr[Elements][Pair]+np.arange(len(Pair))-First[Pair]
+        X        = self.NodeArray
+        T        = X[self.FlatEnd[Flat]]-X[self.FlatStart[Flat]]
+        D        = Points[Pair]-X[self.FlatStart[Flat]]
+        Cross    = (T[:,0]*D[:,1]-T[:,1]*D[:,0])/(self.EdgeLengths[self.FlatEdges[Flat]]*np.sqrt(np.abs(self.Areas[Elements[Pair]])))
+        return np.minimum.reduceat(Cross,First) >= -Tol
+
+    def LocatePoints(self,Points,Tol=1E-10):
+        #Returns the element containing every point, -1 for the points outside the mesh. A point on
+        #an edge or node shared by several elements is given to one of them. The elements with the
+        #nearest centroids are tried first, then all of them.
+        if getattr(self,'CentroidTree',None) is None:
+            if not hasattr(self,'Areas'):
+                self.MakeGeometry()
+            self.CentroidTree = cKDTree(self.Centroids)
+        Points  = np.atleast_2d(np.asarray(Points,dtype=float))
+        NEl     = len(self.ElementEdges)
+        Found   = -np.ones(len(Points),dtype=int)
+        k       = min(8,NEl)
+        Nearest = self.CentroidTree.query(Points,k)[1].reshape(len(Points),k)
+        for j in range(k):
+            Left   = np.nonzero(Found < 0)[0]
+            Inside = self.ContainsPoints(Nearest[Left,j],Points[Left],Tol)
+            Found[Left[Inside]] = Nearest[Left[Inside],j]
+        for i in np.nonzero(Found < 0)[0]:
+            Inside = np.nonzero(self.ContainsPoints(np.arange(NEl),np.repeat(Points[i:i+1],NEl,axis=0),Tol))[0]
+            if len(Inside) > 0:
+                Found[i] = Inside[0]
+        return Found
+
+def CurlMatrix(Nodes,EdgeNodes,Lengths=None):
+    #This routine computes the primary curl as a csr matrix, (u(Node2)-u(Node1))/length on every edge.
+    X  = np.asarray(Nodes,dtype=float)
+    EN = np.asarray(EdgeNodes,dtype=int)
+    nE = len(EN)
+    if Lengths is None:
+        Lengths = np.sqrt(np.sum((X[EN[:,1]]-X[EN[:,0]])**2,axis=1))
+    rows = np.repeat(np.arange(nE),2)
+    vals = (np.array([[-1.0,1.0]])/Lengths[:,None]).ravel()
+    return coo_matrix((vals,(rows,EN.ravel())),shape=(nE,len(X))).tocsr()
+
+def ReadDurhamMesh(File,Normalize=True):
+    #Reads a mesh in Durham's format, as written by MarcosMeshGen (e.g. locrefs_quads_0.mesh).
+    #HeliosMesh takes the nodes on the lines x = +-1 and y = +-1 as the boundary, so the domain
+    #must be [-1,1]^2. With Normalize the points are mapped from their bounding box [Low,High]
+    #to [-1,1]^2 by the affine map x -> 2(x-Low)/(High-Low)-1 (each axis separately, the files
+    #of MarcosMeshGen are on [0,1]^2); otherwise they are returned as they are in the file.
+    #The edges of every cell are taken from its points, in their (counterclockwise)
+    #order, and the orientation is 1 where the edge goes from one point to the next.
+    #Returns Nodes,EdgeNodes,ElementEdges,Orientations.
+    with open(File,'r') as fp:
+        Lines = [Line.split() for Line in fp if Line.strip() and not Line.startswith('#')]
+    Sections, i = {}, 0
+    while i < len(Lines):
+        Name = Lines[i][0]
+        if Name in ('POINTS','CELLS_POINTS','CELLS_EDGES','EDGES'):
+            Count          = int(Lines[i][1])
+            Sections[Name] = Lines[i+1:i+1+Count]
+            i              = i+1+Count
+        else:
+            if Name == 'OFFSET':
+                Sections[Name] = int(Lines[i][1])
+            i = i+1
+    Offset = Sections.get('OFFSET',0)
+    X      = np.array([[float(v) for v in Line[0:2]] for Line in Sections['POINTS']])
+    if Normalize:
+        Low, High = X.min(axis=0), X.max(axis=0)
+        X         = 2*(X-Low)/(High-Low)-1
+    Nodes  = X.tolist()
+    EdgeNodes = [[int(Line[0])-Offset,int(Line[1])-Offset] for Line in Sections['EDGES']]
+    EdgeIndex = {(min(Edge),max(Edge)):e for e, Edge in enumerate(EdgeNodes)}
+    ElementEdges, Orientations = [], []
+    for Line in Sections['CELLS_POINTS']:
+        Points = [int(v)-Offset for v in Line[1:1+int(Line[0])]]
+        Pairs  = list(zip(Points,Points[1:]+Points[0:1]))
+        ElementEdges.append([EdgeIndex[(min(a,b),max(a,b))] for a,b in Pairs])
+        Orientations.append([1 if EdgeNodes[e][0] == a else -1 for e,(a,b) in zip(ElementEdges[-1],Pairs)])
+    return Nodes,EdgeNodes,ElementEdges,Orientations
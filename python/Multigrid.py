@@ -0,0 +1,177 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse import csr_matrix
+from scipy.sparse import block_diag
+from scipy.sparse.linalg import splu
+from scipy.sparse.linalg import LinearOperator
+from MeshHelios import HeliosMesh
+from MeshHelios import ReadDurhamMesh
+from StateLayout import StateLayout
+
+#Geometric multigrid on a hierarchy of nested meshes, e.g. the local refinements written by
+#MarcosMeshGen (locrefs_quads_0.mesh, _1, _2, see nref in data.inp). Every element of a fine mesh
+#lies in one element of the coarser mesh, its parent, which is recovered by point location.
+#Functions of the coarse mesh are evaluated at the fine dofs with mean value coordinates of the
+#parent polygon, which are linear along the edges (so the prolongation is conforming across
+#elements and hanging nodes) and reproduce linear functions, see PointProlongation.
+
+def MeshHierarchy(Files):
+    #The meshes in Files, coarsest first
+    return [HeliosMesh(*ReadDurhamMesh(File)) for File in Files]
+
+def MeanValueWeights(V,p,Tol=1E-10):
+    #Mean value coordinates of the point p with respect to the polygon with vertices V (counterclockwise)
+    D  = V-p
+    r  = np.sqrt(np.sum(D**2,axis=1))
+    w  = np.zeros(len(V))
+    i  = np.argmin(r)
+    if r[i] <= Tol*r.max():
+        w[i] = 1
+        return w
+    Dn, rn = np.roll(D,-1,axis=0), np.roll(r,-1)
+    Cross  = D[:,0]*Dn[:,1]-D[:,1]*Dn[:,0]
+    Dot    = np.sum(D*Dn,axis=1)
+    On     = (np.abs(Cross) <= Tol*r*rn) & (Dot < 0)
+    if On.any():
+        #Linear interpolation along the edge holding p
+        i       = np.argmax(On)
+        w[i]    = rn[i]/(r[i]+rn[i])
+        w[(i+1)%len(V)] = r[i]/(r[i]+rn[i])
+        return w
+    T = Cross/(r*rn+Dot) #tan of half the angle subtended by each edge
+    w = (T+np.roll(T,1))/r
+    return w/w.sum()
+
+#Kinds of mesh entities (see StateLayout) holding the unknowns of each space
+SpaceKinds = {'Vh':('Node',),'TVh':('Node','Node','Mid','Mid')}
+
+def Parents(Coarse,Fine):
+    #The element of Coarse containing every element of Fine
+    if not hasattr(Fine,'Areas'):
+        Fine.MakeGeometry()
+    Parent = Coarse.LocatePoints(Fine.Centroids)
+    if (Parent < 0).any():
+        raise ValueError('The fine mesh is not a refinement of the coarse mesh')
+    return Parent
+
+def EvaluationMatrix(Mesh,Points,Cells,Ring='Node'):
+    #Matrix evaluating a function of Mesh at Points, Cells being the element holding every point,
+    #from its values at the points of Ring. 'Node': mean value coordinates of the polygon of the
+    #nodes, linear along the edges. 'Mid': mean value coordinates of the polygon of the midnodes,
+    #which keep linear precision outside of it (e.g. at the quarter points of the edges). 'NodeMid':
+    #both, the polygon with the nodes and midnodes of the element, the columns of the midnodes
+    #following those of the nodes.
+    if not hasattr(Mesh,'Areas'):
+        Mesh.MakeGeometry()
+    nN, nE = len(Mesh.Nodes), len(Mesh.EdgeNodes)
+    Mid    = np.asarray(Mesh.MidNodes,dtype=float)
+    if Ring == 'Node':
+        Ptr, Index, X = Mesh.ElementPtr, Mesh.FlatStart, Mesh.NodeArray[Mesh.FlatStart]
+    elif Ring == 'Mid':
+        Ptr, Index, X = Mesh.ElementPtr, Mesh.FlatEdges, Mid[Mesh.FlatEdges]
+    elif Ring == 'NodeMid':
+        Ptr   = 2*Mesh.ElementPtr
+        Index = np.stack((Mesh.FlatStart,nN+Mesh.FlatEdges),axis=1).ravel()
+        X     = np.stack((Mesh.NodeArray[Mesh.FlatStart],Mid[Mesh.FlatEdges]),axis=1).reshape(-1,2)
+    else:
+        raise ValueError('Unknown ring '+str(Ring))
+    Size = {'Node':nN,'Mid':nE,'NodeMid':nN+nE}[Ring]
+    rows, cols, vals = [], [], []
+    for i in range(len(Points)):
+        Local = slice(Ptr[Cells[i]],Ptr[Cells[i]+1])
+        w     = MeanValueWeights(X[Local],Points[i])
+        rows.append(np.full(len(w),i))
+        cols.append(Index[Local])
+        vals.append(w)
+    rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    Keep = vals != 0
+    return coo_matrix((vals[Keep],(rows[Keep],cols[Keep])),shape=(len(Points),Size)).tocsr()
+
+def PointProlongation(Coarse,Fine,Kind='Node',Parent=None):
+    #Matrix evaluating a function of Coarse at the entities of Kind of Fine, from its values at the
+    #entities of Kind of Coarse, with EvaluationMatrix in the parent of every fine entity. Nodal
+    #and midnode values are interpolated separately as the TVh semi-inner product hardly couples them.
+    if Parent is None:
+        Parent = Parents(Coarse,Fine)
+    if Kind == 'Node':
+        Points = Fine.NodeArray
+        Cells  = Parent[[Cells[0] for Cells in Fine.NodestoCells]]
+    elif Kind == 'Mid':
+        Points = np.asarray(Fine.MidNodes,dtype=float)
+        Cells  = Parent[[Cells[0] for Cells in Fine.EdgestoCells]]
+    else:
+        raise ValueError('Unknown kind '+str(Kind))
+    return EvaluationMatrix(Coarse,Points,Cells,Kind)
+
+def Prolongation(Coarse,Fine,Space='Vh'):
+    #Prolongation between the unknowns of Space on two nested meshes, ordered as in a StateLayout
+    #with the kinds SpaceKinds[Space]: the internal nodes for 'Vh' (see AmpereOhmMatrix) and the
+    #internal velocity dofs for 'TVh' (see VelocityMatrix). Boundary values are dropped: the
+    #corrections vanish on the boundary.
+    Parent = Parents(Coarse,Fine)
+    Kinds  = SpaceKinds[Space]
+    CoarseLayout, FineLayout = StateLayout(Coarse,Kinds), StateLayout(Fine,Kinds)
+    Blocks = {Kind:PointProlongation(Coarse,Fine,Kind,Parent) for Kind in set(Kinds)}
+    return block_diag([Blocks[Kinds[k]][FineLayout.Interior[k]][:,CoarseLayout.Interior[k]] for k in range(len(Kinds))]).tocsr()
+
+def Prolongations(Meshes,Space='Vh'):
+    return [Prolongation(Meshes[l],Meshes[l+1],Space) for l in range(len(Meshes)-1)]
+
+class Multigrid:
+    #V-cycle for the matrix A of the finest level. Prolongations[l] maps level l to level l+1, the
+    #coarse matrices are the Galerkin products P^T A P and are solved exactly on level 0. Smoothing
+    #is Smoothing sweeps of damped Jacobi before and after the coarse correction, so the cycle is
+    #symmetric and can precondition CG as well as GMRES. The damping on each level is Omega over
+    #the largest eigenvalue of D^-1 A, estimated by power iteration (the stabilization terms of
+    #the local matrices make it far from 2).
+    def __init__(self,A,Prolongations,Smoothing=2,Omega=4/3):
+        self.Prolongations    = [csr_matrix(P) for P in Prolongations]
+        self.Matrices         = [csr_matrix(A)]
+        for P in reversed(self.Prolongations):
+            self.Matrices.insert(0,(P.T@self.Matrices[0]@P).tocsr())
+        self.Diagonals        = [M.diagonal() for M in self.Matrices]
+        self.Smoothing        = Smoothing
+        self.Omega            = [Omega/self.JacobiRadius(M,D) for M,D in zip(self.Matrices,self.Diagonals)]
+        self.CoarseLU         = splu(self.Matrices[0].tocsc())
+        self.Iterations       = 0
+
+    def JacobiRadius(self,A,D,Iterations=20):
+        x = np.random.default_rng(0).random(A.shape[0])
+        for k in range(Iterations):
+            y = (A@x)/D
+            l = np.linalg.norm(y)/np.linalg.norm(x)
+            x = y/np.linalg.norm(y)
+        return l
+
+    def Cycle(self,b,Level=None):
+        #One V-cycle from a zero initial guess
+        if Level is None:
+            Level = len(self.Matrices)-1
+        if Level == 0:
+            return self.CoarseLU.solve(b)
+        A, D, w = self.Matrices[Level], self.Diagonals[Level], self.Omega[Level]
+        x    = w*b/D
+        for Sweep in range(self.Smoothing-1):
+            x += w*(b-A@x)/D
+        P  = self.Prolongations[Level-1]
+        x += P@self.Cycle(P.T@(b-A@x),Level-1)
+        for Sweep in range(self.Smoothing):
+            x += w*(b-A@x)/D
+        return x
+
+    def Solve(self,b,x0=None,tol=1E-8,maxiter=100):
+        #Standalone solver, V-cycles until the residual is below tol times that of b
+        A = self.Matrices[-1]
+        x = np.zeros(len(b)) if x0 is None else np.array(x0,dtype=float)
+        r = b-A@x
+        self.Iterations = 0
+        while np.linalg.norm(r) > tol*np.linalg.norm(b) and self.Iterations < maxiter:
+            x += self.Cycle(r)
+            r  = b-A@x
+            self.Iterations = self.Iterations+1
+        return x
+
+    def Operator(self):
+        #One V-cycle as a LinearOperator, e.g. for the M argument of cg or gmres
+        n = self.Matrices[-1].shape[0]
+        return LinearOperator((n,n),matvec=self.Cycle)
@@ -1,12 +1,73 @@
 from MeshHelios import HeliosMesh
+from MeshHelios import CurlMatrix
+from Diagnostics import DivergenceDiagnostics
+from Sources import DataProvider
+from StateLayout import StateLayout, FieldState
+from Workspace import Workspace
+import Kernels
+from Assembly import ColouredAssembler
+from Parallel import ParallelResidual
 import multiprocessing as mp
 from scipy.sparse import csr_matrix
-from scipy.sparse import lil_matrix
+from scipy.sparse import coo_matrix
 import math
+import functools
 import numpy as np
 from numpy.linalg import norm as n2
 
+def Batched(G):
+    #Marks the residual G(self,x,Out) as also taking a (k,ndof) array of k states, whose residuals
+    #are returned as the rows of a (k,ndof) array (Out if given). G works along the batch axis
+    #itself: the fields of the states have shape (k,n) and the element terms are sparse operators
+    #applied to all of them at once, see ApplyOperator.
+    G.Batched = True
+    return G
+
+def BatchedByLoop(G):
+    #Same interface as Batched for the residuals that take one state at a time: the k states are
+    #evaluated one after the other, sharing the workspace and the precomputed local matrices.
+    @functools.wraps(G)
+    def LoopG(self,x,Out=None):
+        if np.ndim(x) == 1:
+            return G(self,x,Out)
+        return EachState(G,self,x,Out)
+    LoopG.Batched = True
+    return LoopG
+
+def EachState(G,PDE,x,Out=None):
+    if Out is None:
+        Out = np.zeros(np.shape(x),dtype=float)
+    for k in range(len(x)):
+        G(PDE,x[k],Out[k])
+    return Out
+
+def ApplyOperator(Op,X):
+    #Op times X, where X is a vector or a (k,n) array of k vectors (the result is then (k,m))
+    if np.ndim(X) == 1:
+        return Op.dot(X)
+    return Op.dot(np.transpose(X)).T
+
+def Vectorized(Func):
+    #Marks Func as acting on an (n,2) array of points, it must then return an (n,) or (n,2) array.
+    #Unmarked functions are called point by point.
+    Func.Vectorized = True
+    return Func
+
+def SmallInverse(M):
+    #Closed form inverse of a stack of 1x1 or 2x2 matrices, M has shape (k,n,n)
+    if M.shape[1] == 1:
+        return 1/M
+    Det = M[:,0,0]*M[:,1,1]-M[:,0,1]*M[:,1,0]
+    Inv = np.empty(M.shape,dtype=float)
+    Inv[:,0,0], Inv[:,1,1] =  M[:,1,1]/Det, M[:,0,0]/Det
+    Inv[:,0,1], Inv[:,1,0] = -M[:,0,1]/Det,-M[:,1,0]/Det
+    return Inv
+
 class PDEFullMHD(object):
+    MHDFieldNames    = ('unx','uny','umx','umy','B','E','p')
+    FastElementSizes = (3,4) #Elements with these numbers of edges use the batched closed form kernels
+    Threads          = 1     #Threads of the coloured element loops, see SetThreads
+
     def __init__(self,Mesh,Re,Rm,Inu,InB,dt,theta):
         #The Following values are useful for the implementation of some quadrature rules 
         self.pt0, self.w0  = -1, 1/21
@@ -40,7 +101,27 @@ class PDEFullMHD(object):
         self.E             = np.zeros(len(self.Mesh.Nodes),  dtype = float)
         
         self.evalcount = 0
-        self.MRot    = self.Rot(self.Mesh.EdgeNodes,self.Mesh.Nodes)
+        self.MHDPerm, self.MHDInvPerm = None, None
+        self.Parallel  = None #Workers of pMHDG, see StartParallel
+        #Index arrays to move data between the fields and the vectors of unknowns
+        self.MHDLayout     = StateLayout(self.Mesh,('Node','Node','Mid','Mid','Edge','Node','Cell'))
+        self.FlowLayout    = StateLayout(self.Mesh,('Node','Node','Mid','Mid','Cell'))
+        self.ElectroLayout = StateLayout(self.Mesh,('Edge','Node'))
+        #The fields at time n (State) and the trial fields at time n+1 (NextState) live in two
+        #buffers. The attributes unx,...,p are views of State, see BindState and MHDAdvance.
+        self.State         = FieldState(self.MHDLayout,self.MHDFieldNames)
+        self.NextState     = FieldState(self.MHDLayout,self.MHDFieldNames)
+        self.State.Assign((self.unx,self.uny,self.umx,self.umy,self.B,self.E,self.p))
+        self.BindState()
+        self.MRot    = self.Mesh.Operator('Curl')
+        self.MRotCSC = self.MRot.tocsc()
+        self.Work    = Workspace(self.Mesh) #Temporary arrays of the residual evaluations
+        self.Diagnostics = DivergenceDiagnostics(self.Mesh)
+        self.MassMatrices = {} #Global mass matrices, see MassMatrix
+        self.Operators    = {} #Operators of the residual, see ResidualOperators
+        self.LocalOps     = {} #Operators of LocalProduct, see LocalOperator
+        self.TVhBlocks    = None
+        self.Assembler    = ColouredAssembler(self.Mesh,self.Threads)
         self.MEList    = []
         self.MVList    = []
         self.HSTVList  = []
@@ -48,79 +129,80 @@ class PDEFullMHD(object):
         self.DTVList   = []
         self.KTVList   = []
         self.RTKIList  = []
-        for i in range(len(self.Mesh.ElementEdges)):
-            tempME,tempMV             = self.ElecMagStandMassMat(self.Mesh.ElementEdges[i],self.Mesh.Orientations[i])
-            TempSH,TempGI,TempD,TempK,TempRTKI = self.TVhInnerPreCompute(i)
-            self.MEList.append(tempME)
-            self.MVList.append(tempMV)
-            self.HSTVList.append(TempSH)
-            self.GISTVList.append(TempGI)
-            self.DTVList.append(TempD)
-            self.KTVList.append(TempK)
-            self.RTKIList.append(TempRTKI)
+        self.MEList, self.MVList = self.ElecMagMassMatrices()
+        #The matrices of TVhInnerPreCompute, computed for all the elements at once
+        TempSH,TempGI,TempD,TempK,TempRTKI = self.TVhInnerPreComputeAll()
+        self.HSTVList  = list(TempSH)
+        self.GISTVList = list(TempGI)
+        self.DTVList   = TempD
+        self.KTVList   = list(TempK)
+        self.RTKIList  = list(TempRTKI)
+        self.MakeRTOperators()
         
     ##################################################################################
     ##################################################################################    
     #Compute DOFs from func
     def NodalDOFs(self,Func,Nodes):
         #This function computes the dof of the init cond on the vel field.
+        #A function marked with Vectorized is called once on the (n,2) array of nodes.
+        if getattr(Func,'Vectorized',False):
+            return np.asarray(Func(np.asarray(Nodes,dtype=float).reshape(-1,2)),dtype=float)
         return np.array([Func(Node) for Node in Nodes])
 
     def DecompIntoCoord(self,Array):
         #This function will, given a list of pairs return two arrays.
         #The first and second components.
-        arrayx = [x[0] for x in Array]
-        Arrayy = [x[1] for x in Array]
-        return np.array(arrayx),np.array(Arrayy)
+        Array = np.asarray(Array)
+        if Array.ndim != 2:
+            return np.array([x[0] for x in Array]),np.array([x[1] for x in Array])
+        return Array[:,0].copy(),Array[:,1].copy()
+
+    def AtTime(self,Func,t):
+        #Returns xv -> Func(xv,t), vectorized if Func is.
+        if getattr(Func,'Vectorized',False):
+            return Vectorized(lambda X: Func(X,t))
+        return lambda xv: Func(xv,t)
+
+    def AtTimeAppended(self,Func,t):
+        #Returns xv -> Func([xv[0],xv[1],t]), vectorized if Func is, in which case Func takes an (n,3) array.
+        if getattr(Func,'Vectorized',False):
+            return Vectorized(lambda X: Func(np.column_stack((X,np.full(len(X),t)))))
+        return lambda xv: Func([xv[0],xv[1],t])
+
+    def DataDOFs(self,Func,Nodes,t,Appended=False):
+        #Values at time t of a source term or boundary data at the given points.
+        #Func is either Func(xv,t) (Func([x,y,t]) if Appended) or a provider from Sources,
+        #in which case the values that do not change in time are cached.
+        if isinstance(Func,DataProvider):
+            return Func.DOFs(self.NodalDOFs,Nodes,t)
+        if Appended:
+            return self.NodalDOFs(self.AtTimeAppended(Func,t),Nodes)
+        return self.NodalDOFs(self.AtTime(Func,t),Nodes)
 
     def PhDOF(self,p):
-        ph = np.zeros((len(self.Mesh.ElementEdges)), dtype=float)
-        j  = 0
-        for Element in self.Mesh.ElementEdges:
-            xP,yP,A,V,E = self.Mesh.Centroid(Element,self.Mesh.Orientations[j])
-            ph[j]       = A*p([xP,yP])
-            j = j+1
-            # for i in range(len(V)-1):
-            #     Node1 = V[i]
-            #     Node2 = V[i+1]
-            #     x1,y1 = Node1[0],Node1[1]
-            #     x2,y2 = Node2[0],Node2[1]
-            
-            #     xh1,yh1 = (x1+x2)/2,(y1+y2)/2
-            #     xh2,yh2 = (x1+xP)/2,(y1+yP)/2
-            #     xh3,yh3 = (x2+xP)/2,(y2+yP)/2
-
-            #     AT    = 0.5*abs( (x2-xP)*(y1-yP)-(y2-yP)*(x1-xP) )
-            #     ph[j] = ph[j]+(AT/3)*(p([xh1,yh1])+p([xh2,yh2])+p([xh3,yh3]))
-        return ph
+        #The dof of p on each element is its area times the value of p at the centroid.
+        if not hasattr(self.Mesh,'Areas'):
+            self.Mesh.MakeGeometry()
+        return self.Mesh.Areas*self.NodalDOFs(p,self.Mesh.Centroids)
 
     def MagDOFs(self,Func):
     #This computes the dofs of the initial magnetic field
-    #This routine could be sped up by vectorizing. For our purposes this
-    #this is not necessary
-        N    = len(self.Mesh.EdgeNodes)
-        proj = np.zeros(N)
-
-        for i in range(N):
-            x1      = self.Mesh.Nodes[self.Mesh.EdgeNodes[i][0]][0]
-            y1      = self.Mesh.Nodes[self.Mesh.EdgeNodes[i][0]][1]
-            x2      = self.Mesh.Nodes[self.Mesh.EdgeNodes[i][1]][0]
-            y2      = self.Mesh.Nodes[self.Mesh.EdgeNodes[i][1]][1]
-            lengthe = math.sqrt((x2-x1)**2+(y2-y1)**2)
-            etimesnormal = [y2-y1,x1-x2]
-
-            [Fx0,Fy0] = Func([x1,y1])
-            [Fx1,Fy1] = Func([(x1*(1-self.pt1)+x2*(1+self.pt1))/2,(y1*(1-self.pt1)+y2*(1+self.pt1))/2])
-            [Fx2,Fy2] = Func([(x1*(1-self.pt2)+x2*(1+self.pt2))/2,(y1*(1-self.pt2)+y2*(1+self.pt2))/2])
-            [Fx3,Fy3] = Func([0.5*(x1+x2),0.5*(y1+y2)])
-            [Fx4,Fy4] = Func([(x1*(1-self.pt4)+x2*(1+self.pt4))/2,(y1*(1-self.pt4)+y2*(1+self.pt4))/2])
-            [Fx5,Fy5] = Func([(x1*(1-self.pt5)+x2*(1+self.pt5))/2,(y1*(1-self.pt5)+y2*(1+self.pt5))/2])
-            [Fx6,Fy6] = Func([x2,y2])
-
-            proj[i] = (self.w0*Fx0+self.w1*Fx1+self.w2*Fx2+self.w3*Fx3+self.w4*Fx4+self.w5*Fx5+self.w6*Fx6)*etimesnormal[0]
-            proj[i] = proj[i] +(self.w0*Fy0+self.w1*Fy1+self.w2*Fy2+self.w3*Fy3+self.w4*Fy4+self.w5*Fy5+self.w6*Fy6)*etimesnormal[1]
-            proj[i] = proj[i]/(2*lengthe)   
-        return proj
+    #The flux through every edge is integrated with the 7 point Gauss-Lobatto rule, the
+    #function is evaluated at the quadrature points of all the edges at once.
+        if not hasattr(self,'MagQuadPoints'):
+            EN      = np.asarray(self.Mesh.EdgeNodes,dtype=int)
+            X       = np.asarray(self.Mesh.Nodes,dtype=float)
+            X1, X2  = X[EN[:,0]], X[EN[:,1]]
+            pts     = np.array([self.pt0,self.pt1,self.pt2,self.pt3,self.pt4,self.pt5,self.pt6])
+            self.MagQuadWeights = np.array([self.w0,self.w1,self.w2,self.w3,self.w4,self.w5,self.w6])
+            #Points are stored edge by edge, (NumEdges*7,2)
+            self.MagQuadPoints  = (X1[:,None,:]*(1-pts[None,:,None])+X2[:,None,:]*(1+pts[None,:,None])).reshape(-1,2)/2
+            self.MagQuadPoints[0::7], self.MagQuadPoints[6::7] = X1, X2
+            lengthe             = np.sqrt(np.sum((X2-X1)**2,axis=1))
+            #etimesnormal/(2*lengthe)
+            self.MagQuadNormals = np.stack((X2[:,1]-X1[:,1],X1[:,0]-X2[:,0]),axis=1)/(2*lengthe[:,None])
+        F = self.NodalDOFs(Func,self.MagQuadPoints).reshape(-1,7,2)
+        return np.sum(np.einsum('q,eqc->ec',self.MagQuadWeights,F)*self.MagQuadNormals,axis=1)
 
     ##################################################################################
     ##################################################################################    
@@ -360,21 +442,73 @@ class PDEFullMHD(object):
     #These functions work as an interface with the solver class. These are for Full MHD
     def MHDConcatenate(self,unx,uny,umx,umy,B,E,p):
         #This function returns an array that concatenates all the unknowns
-        intunx = [unx[i] for i in self.Mesh.NumInternalNodes]
-        intuny = [uny[i] for i in self.Mesh.NumInternalNodes]
-        intumx = [umx[i] for i in self.Mesh.NumInternalMidNodes]
-        intumy = [umy[i] for i in self.Mesh.NumInternalMidNodes]
-        intE   = [E[i] for i in self.Mesh.NumInternalNodes]
-
-        return np.concatenate((intunx,intuny,intumx,intumy,B,intE,p[0:len(p)-1]), axis=None)
-    
-    def SetNumMHDDof(self):
+        return self.MHDLayout.Gather((unx,uny,umx,umy,B,E,p))
+
+    def SetMHDInterleave(self,Interleave):
+        #By default the unknowns are stored by field: (unx,uny,umx,umy,B,E,p).
+        #When Interleave is True the unknowns of each internal node (unx,uny,E) are stored together,
+        #followed by those of each internal midnode (umx,umy), then B and p. This keeps the couplings
+        #of a node close to the diagonal and reduces the fill when factorizing the Jacobian.
+        if not Interleave:
+            self.MHDPerm, self.MHDInvPerm = None, None
+            self.MHDLayout.SetPermutation(None)
+            return
         a = len(self.Mesh.NumInternalNodes)
         b = len(self.Mesh.NumInternalMidNodes)
         c = len(self.Mesh.EdgeNodes)
         d = len(self.Mesh.ElementEdges)
-        return 3*a + 2*b + c + d - 1
-    
+        NodeDofs = np.stack((np.arange(a),a+np.arange(a),2*a+2*b+c+np.arange(a)),axis=1).ravel()
+        MidDofs  = np.stack((2*a+np.arange(b),2*a+b+np.arange(b)),axis=1).ravel()
+        self.MHDPerm    = np.concatenate((NodeDofs,MidDofs,2*a+2*b+np.arange(c),3*a+2*b+c+np.arange(d-1)))
+        self.MHDInvPerm = np.empty(len(self.MHDPerm),dtype=int)
+        self.MHDInvPerm[self.MHDPerm] = np.arange(len(self.MHDPerm))
+        self.MHDLayout.SetPermutation(self.MHDInvPerm)
+
+    def MHDFromBlocked(self,x,Out=None):
+        #Takes a vector in the by-field layout to the layout in use, written in Out if given.
+        if self.MHDPerm is None:
+            return x
+        if Out is None:
+            return x[...,self.MHDPerm]
+        return np.take(x,self.MHDPerm,axis=-1,out=Out)
+
+    def ResidualVector(self,x,Out):
+        #The residuals are written in Out if given, otherwise in a new array
+        if Out is None:
+            return np.zeros(np.shape(x),dtype=float)
+        Out.fill(0)
+        return Out
+
+    def MHDToBlocked(self,x):
+        #Takes a vector in the layout in use to the by-field layout.
+        if self.MHDPerm is None:
+            return x
+        return x[...,self.MHDInvPerm]
+
+    def SetThreads(self,Threads):
+        #Number of threads of the element loops run by Assembler, the local matrices of the general
+        #polygons. LocalProduct and MHDG are products with sparse operators assembled once from
+        #the local matrices, they do not use them.
+        self.Threads = Threads
+        self.Assembler.SetThreads(Threads)
+
+    def BindState(self):
+        #Makes the field attributes views of the current state
+        self.unx,self.uny,self.umx,self.umy,self.B,self.E,self.p = self.State.Fields
+
+    def MHDAdvance(self,x):
+        #Moves to the next time step with the unknowns in x. The fields at n+1 are written in
+        #NextState and the two states are swapped, so no field is reallocated or copied.
+        Closure = -np.sum(self.p[0:len(self.p)-1])
+        unx,uny,umx,umy,B,E,p = self.MHDLayout.Scatter(x,self.NextState.Fields)
+        p[len(p)-1]           = Closure
+        self.MHDUpdateBC(unx,uny,umx,umy,E,InPlace=True)
+        self.State, self.NextState = self.NextState, self.State
+        self.BindState()
+
+    def SetNumMHDDof(self):
+        return self.MHDLayout.NumDOF
+
     # def MHDSplitdelx(self,delx):
     #     intn  = len(self.Mesh.NumInternalNodes)
     #     intmn = len(self.Mesh.NumInternalMidNodes)
@@ -397,99 +531,47 @@ class PDEFullMHD(object):
     #     delB    = np.zeros(intE, dtype = float)
     #     delp    = np.zeros(intC, dtype = float)
 
-    def MHDUpdateInt(self,x,unx,uny,umx,umy,B,E,p):
-        cut1 = len(self.Mesh.NumInternalNodes) #Number of internal dofs for ux
-        cut2 = 2*cut1                          #Number of internal dofs for uy
-        cut3 = cut2+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umx
-        cut4 = cut3+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umy
-        cut5 = cut4+len(self.B)                #Number of dofs for B
-        cut6 = cut5+cut1                       #The number of internal dofs for E is the same as for the vel field.
-        Cutx = np.split(x,[cut1,cut2,cut3,cut4,cut5,cut6])
-        runx = unx*0
-        runy = uny*0
-        rumx = umx*0
-        rumy = umy*0
-        rB   = B*0
-        rE   = E*0
-        rp   = p*0
-        
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-            rE[i]   = E[i]
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-        j = 0
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = Cutx[0][j]
-            runy[i] = Cutx[1][j]
-            rE[i]   = Cutx[5][j]
-            j = j+1
-        j = 0
-        for i in self.Mesh.NumInternalMidNodes:
-            rumx[i] = Cutx[2][j]
-            rumy[i] = Cutx[3][j]
-            j = j+1
-        rB = Cutx[4]
-        rp[0:len(rp)-1]   = Cutx[6]
-        rp[len(rp)-1]     = -np.sum(p[0:len(p)-1])
+    def MHDUpdateInt(self,x,unx,uny,umx,umy,B,E,p,Out=None):
+        #Returns the fields with the internal values taken from x and the boundary values
+        #taken from the inputs. If Out is given the fields are written there.
+        Closure = -np.sum(p[0:len(p)-1])
+        if Out is None:
+            Out = self.MHDLayout.Empty()
+        runx,runy,rumx,rumy,rB,rE,rp = self.MHDLayout.Scatter(x,self.MHDLayout.CopyBoundary((unx,uny,umx,umy,B,E,p),Out))
+        rp[len(rp)-1] = Closure
         return runx,runy,rumx,rumy,rB,rE,rp
 
-    def MHDUpdateBC(self,unx,uny,umx,umy,E):
-        runx = unx*0
-        runy = uny*0
-        rumx = umx*0
-        rumy = umy*0
-        rE   = E*0
-        
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-            rE[i]   = E[i]
-
-        for i in self.Mesh.NumInternalMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-
-        j = 0
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = self.ubnx[j]
-            runy[i] = self.ubny[j]
-            rE[i]   = self.Ebarr[j]
-            j      = j+1
-        j = 0
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = self.ubmx[j]
-            rumy[i] = self.ubmy[j]
-            j      = j+1
-        return runx,runy,rumx,rumy,rE
+    def MHDUpdateBC(self,unx,uny,umx,umy,E,InPlace=False):
+        #Returns the fields with the boundary values given by the BCs
+        if not InPlace:
+            unx,uny,umx,umy,E = [np.array(Field,dtype=float) for Field in (unx,uny,umx,umy,E)]
+        self.SetVelocityBC(unx,uny,umx,umy)
+        E[...,self.FlowLayout.Boundary[0]] = self.Ebarr
+        return unx,uny,umx,umy,E
+
+    def SetVelocityBC(self,unx,uny,umx,umy):
+        #Writes the boundary values of the velocity in place, also on every row of (k,n) fields
+        BNodes, BMid = self.FlowLayout.Boundary[0], self.FlowLayout.Boundary[2]
+        unx[...,BNodes], uny[...,BNodes] = self.ubnx, self.ubny
+        umx[...,BMid],   umy[...,BMid]   = self.ubmx, self.ubmy
+        return unx,uny,umx,umy
 
     def SetMHDBCandSource(self,ub,Eb,f,h):
         self.ub,self.Eb,self.f,self.h = ub,Eb,f,h
 
     def MHDComputeBC(self,t):
-        def dummyub(xv):
-            return self.ub(xv,t+self.dt)
-        def dummyEb(xv):
-            return self.Eb(xv,t+self.theta*self.dt)
-        tempubn              = self.NodalDOFs(dummyub,self.Mesh.BNodes)
+        tempubn              = self.DataDOFs(self.ub,self.Mesh.BNodes,t+self.dt)
         self.ubnx, self.ubny = self.DecompIntoCoord(tempubn)
-        tempum               = self.NodalDOFs(dummyub,self.Mesh.BMidNodes)
+        tempum               = self.DataDOFs(self.ub,self.Mesh.BMidNodes,t+self.dt)
         self.ubmx, self.ubmy = self.DecompIntoCoord(tempum)
-        self.Ebarr           = self.NodalDOFs(dummyEb,self.Mesh.BNodes)
+        self.Ebarr           = self.DataDOFs(self.Eb,self.Mesh.BNodes,t+self.theta*self.dt)
     
     def MHDComputeSources(self,t):
-        def dummyf(xv):
-            return self.f(xv,t+self.theta*self.dt)
-        def dummyh(xv):
-            return self.h(xv,t+self.theta*self.dt)
-        
-        tempfn             = self.NodalDOFs(dummyf,self.Mesh.Nodes)
+        tempfn             = self.DataDOFs(self.f,self.Mesh.Nodes,t+self.theta*self.dt)
         self.fnx, self.fny = self.DecompIntoCoord(tempfn)
-        tempfm             = self.NodalDOFs(dummyf,self.Mesh.MidNodes)
+        tempfm             = self.DataDOFs(self.f,self.Mesh.MidNodes,t+self.theta*self.dt)
         self.fmx, self.fmy = self.DecompIntoCoord(tempfm)
-        self.hdof          = self.NodalDOFs(dummyh,self.Mesh.Nodes)
+        self.hdof          = self.DataDOFs(self.h,self.Mesh.Nodes,t+self.theta*self.dt)
 
     def MomentumyNode(self,node,unx,uny,umx,umy,B,E,p):
         Cells = self.Mesh.NodestoCells[i]
@@ -546,225 +628,174 @@ class PDEFullMHD(object):
                 #+Jn.dot( self.MVList[Cell].dot(v2xB) )
                 #UseWithNewDisc
     
-    def pMHDG(self,x,Gunx):
-        self.evalcount = self.evalcount+1
-        unp1x,unp1y = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        ump1x,ump1y = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        Bp1         = np.zeros((len(self.Mesh.EdgeNodes)),dtype =float)
-        E           = np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        p           = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        unp1x,unp1y,ump1x,ump1y,Bp1,E,p = self.MHDUpdateInt(x,unp1x,unp1y,ump1x,ump1y,Bp1,E,p)
-        unp1x,unp1y,ump1x,ump1y,E       = self.MHDUpdateBC(unp1x,unp1y,ump1x,ump1y,E)
-
-        y       = np.zeros(len(x))
-        nx      = (unp1x-self.unx)/self.dt - self.fnx
-        ny      = (unp1y-self.uny)/self.dt - self.fny
-        mx      = (ump1x-self.umx)/self.dt - self.fmx
-        my      = (ump1y-self.umy)/self.dt - self.fmy
-        unthetax = (1-self.theta)*self.unx+self.theta*unp1x 
-        unthetay = (1-self.theta)*self.uny+self.theta*unp1y
-        umthetax = (1-self.theta)*self.umx+self.theta*ump1x 
-        umthetay = (1-self.theta)*self.umy+self.theta*ump1y
-        Bntheta  = (1-self.theta)*self.B+self.theta*Bp1
-        
-        input_lst    = self.Mesh.NumInternalNodes
-
-        def fGunx(Node):
-            return Gunx(Node,nx,ny,mx,my,unthetax,unthetay,umthetax,umthetay,Bntheta,E,p) 
-        y1 = self.pool.map(fGunx,input_lst)
-        return y1
-
-    def MHDG(self,x):
+    def StartParallel(self,NumWorkers):
+        #Starts NumWorkers processes, each one evaluating the momentum rows of one subdomain in
+        #pMHDG. Stop them with StopParallel.
+        self.StopParallel()
+        self.Parallel = ParallelResidual(self,NumWorkers)
+
+    def StopParallel(self):
+        if self.Parallel is not None:
+            self.Parallel.Close()
+            self.Parallel = None
+
+    @Batched
+    def pMHDG(self,x,Out=None):
+        #MHDG evaluated by the workers of StartParallel, or MHDG itself if there are none. The
+        #workers take one state at a time.
+        if self.Parallel is None:
+            return self.MHDG(x,Out)
+        if np.ndim(x) == 1:
+            return self.Parallel.Evaluate(x,Out)
+        return EachState(lambda PDE,x,Out: PDE.Parallel.Evaluate(x,Out),self,x,Out)
+
+    @Batched
+    def MHDG(self,x,Out=None):
         #The x is passed because the Scipy Linear Function class requires it.
         #It will use the current values of the internal variables
+        #If Out is given the residual is written there.
         #self.evalcount = self.evalcount+1
-        unp1x,unp1y = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        ump1x,ump1y = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        Bp1         = np.zeros((len(self.Mesh.EdgeNodes)),dtype =float)
-        E           = np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        p           = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        unp1x,unp1y,ump1x,ump1y,Bp1,E,p = self.MHDUpdateInt(x,unp1x,unp1y,ump1x,ump1y,Bp1,E,p)
-        unp1x,unp1y,ump1x,ump1y,E       = self.MHDUpdateBC(unp1x,unp1y,ump1x,ump1y,E)
-       
-        y       = np.zeros(len(x))
-        nx      = (unp1x-self.unx)/self.dt - self.fnx
-        ny      = (unp1y-self.uny)/self.dt - self.fny
-        mx      = (ump1x-self.umx)/self.dt - self.fmx
-        my      = (ump1y-self.umy)/self.dt - self.fmy
-        unthetax = (1-self.theta)*self.unx+self.theta*unp1x 
-        unthetay = (1-self.theta)*self.uny+self.theta*unp1y
-        umthetax = (1-self.theta)*self.umx+self.theta*ump1x 
-        umthetay = (1-self.theta)*self.umy+self.theta*ump1y
-        Bntheta  = (1-self.theta)*self.B+self.theta*Bp1
-        
-        intN,intNM,k = len(self.Mesh.NumInternalNodes),len(self.Mesh.NumInternalMidNodes),0 
-        for i in self.Mesh.NumInternalNodes:
-
-            Cells = self.Mesh.NodestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1nx[i]   = 1
-            
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2ny[i]   = 1
-            #Momentum, nodal DOFs
-            for Cell in Cells:
-                locBtheta           = self.GetLocalEhDOF(Cell,Bntheta)
-                #UseForOldDisc
-                #RTBthetanx,RTBthetany = self.PiRTBn(locBtheta,Cell)
-
-                locunthetax,locunthetay,locumthetax,locumthetay = self.GetLocalTVhDOF(Cell,unthetax,unthetay,umthetax,umthetay)
-                #UseForNewDisc
-                RTBthetanx,RTBthetany,RTBthetamx,RTBthetamy,locEm = self.PiRTBnm(locBtheta,E,Cell)
-                
-                locEn = self.GetLocalVhDOF(Cell,E) 
-                Jn    = locEn+self.Cross2Dto1D(locunthetax,locunthetay,RTBthetanx,RTBthetany)
-                #UseWithNewDisc
-                Jm    = locEm+self.Cross2Dto1D(locumthetax,locumthetay,RTBthetamx,RTBthetamy)
-
-                #UseWithNewDisc
-                JxBnx,JxBny = self.Cross1Dto2D(Jn,RTBthetanx,RTBthetany)
-                JxBmx,JxBmy = self.Cross1Dto2D(Jm,RTBthetamx,RTBthetamy)
-                
-                lnx,lny,lmx,lmy         = self.GetLocalTVhDOF(Cell,nx,ny,mx,my)
-                lv1nx,lv1ny,lv1mx,lv1my = self.GetLocalTVhDOF(Cell,v1nx,v1ny,v1mx,v1my)
-                lv2nx,lv2ny,lv2mx,lv2my = self.GetLocalTVhDOF(Cell,v2nx,v2ny,v2mx,v2my)
-                divv1,A                 = self.DIVu(Cell,lv1nx,lv1ny,lv1mx,lv1my)
-                divv2,A                 = self.DIVu(Cell,lv2nx,lv2ny,lv2mx,lv2my)
-                #UseWithOldDisc
-                #v1xB                     = self.Cross2Dto1D(lv1nx,lv1ny,RTBthetanx,RTBthetany)
-                #v2xB                     = self.Cross2Dto1D(lv2nx,lv2ny,RTBthetanx,RTBthetany)
-
-                y[k] = y[k]\
-                    +self.TVhInProd(Cell,lnx,lny,lmx,lmy,lv1nx,lv1ny,lv1mx,lv1my)\
-                    +(1/self.Re)*self.TVhSemiInProd(Cell,locunthetax,locunthetay,locumthetax,locumthetay,lv1nx,lv1ny,lv1mx,lv1my)\
-                    -self.TVhInProd(Cell,JxBnx,JxBny,JxBmx,JxBmy,lv1nx,lv1ny,lv1mx,lv1my)\
-                    -self.PhInProd(Cell,p[Cell],divv1*A)
-                    #+Jn.dot(self.MVList[Cell].dot(v1xB))\
-                    #UseWitholdDisc
-                   
-                    #UseWithNewDisc
-                    
-                    
-                y[k+intN]  = y[k+intN]\
-                    +self.TVhInProd(Cell,lnx,lny,lmx,lmy,lv2nx,lv2ny,lv2mx,lv2my)\
-                    +(1/self.Re)*self.TVhSemiInProd(Cell,locunthetax,locunthetay, locumthetax,locumthetay,lv2nx,lv2ny,lv2mx,lv2my)\
-                    -self.PhInProd(Cell,p[Cell],divv2*A)\
-                    -self.TVhInProd(Cell,JxBnx,JxBny,JxBmx,JxBmy,lv2nx,lv2ny,lv2mx,lv2my)
-                    #UseWitholdDisc
-                    
-                    #UseWithNewDisc
-                    #+Jn.dot( self.MVList[Cell].dot(v2xB) )\
-                    
-                    
-               
-            k = k+1
-        #Momentum Midnodes
-        k = 0
-        for i in self.Mesh.NumInternalMidNodes:
-            Cells = self.Mesh.EdgestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1mx[i]   = 1
-            
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2my[i]   = 1
-            for Cell in Cells:
-                #UseWithNewDisc
-                locBtheta           = self.GetLocalEhDOF(Cell,Bntheta)
-                lv1nx,lv1ny,lv1mx,lv1my = self.GetLocalTVhDOF(Cell,v1nx,v1ny,v1mx,v1my)
-                lv2nx,lv2ny,lv2mx,lv2my = self.GetLocalTVhDOF(Cell,v2nx,v2ny,v2mx,v2my)
-                lnx,lny,lmx,lmy         = self.GetLocalTVhDOF(Cell,nx,ny,mx,my)
-                locunthetax,locunthetay, locumthetax,locumthetay = self.GetLocalTVhDOF(Cell,unthetax,unthetay,umthetax,umthetay)
-                divv1,A       = self.DIVu(Cell,lv1nx,lv1ny,lv1mx,lv1my)
-                locEn = self.GetLocalVhDOF(Cell,E)
-                #UseWithNewDisc
-                RTBthetanx,RTBthetany,RTBthetamx,RTBthetamy,locEm = self.PiRTBnm(locBtheta,E,Cell)
-                 
-                Jn    = locEn+self.Cross2Dto1D(locunthetax,locunthetay,RTBthetanx,RTBthetany)
-                Jm    = locEm+self.Cross2Dto1D(locumthetax,locumthetay,RTBthetamx,RTBthetamy)
-                JxBnx,JxBny = self.Cross1Dto2D(Jn,RTBthetanx,RTBthetany)
-                JxBmx,JxBmy = self.Cross1Dto2D(Jm,RTBthetamx,RTBthetamy)
-
-                y[k+2*intN] = y[k+2*intN]\
-                   +(1/self.Re)*self.TVhSemiInProd(Cell,locunthetax,locunthetay, locumthetax,locumthetay,lv1nx,lv1ny,lv1mx,lv1my)\
-                    -self.PhInProd(Cell,p[Cell],divv1*A)\
-                    -self.TVhInProd(Cell,JxBnx,JxBny,JxBmx,JxBmy,lv1nx,lv1ny,lv1mx,lv1my)\
-                    +self.TVhInProd(Cell,lnx,lny,lmx,lmy,lv1nx,lv1ny,lv1mx,lv1my)
-                    
-
-                divv2,A             = self.DIVu(Cell,lv2nx,lv2ny,lv2mx,lv2my)
-                y[k+2*intN+intNM] = y[k+2*intN+intNM]\
-                                +(1/self.Re)*self.TVhSemiInProd(Cell,locunthetax,locunthetay, locumthetax,locumthetay,lv2nx,lv2ny,lv2mx,lv2my)\
-                                -self.PhInProd(Cell,p[Cell],divv2*A)\
-                                -self.TVhInProd(Cell,JxBnx,JxBny,JxBmx,JxBmy,lv2nx,lv2ny,lv2mx,lv2my)\
-                                +self.TVhInProd(Cell,lnx,lny,lmx,lmy,lv2nx,lv2ny,lv2mx,lv2my)
-                 
-            k = k+1
+        if self.MHDPerm is None:
+            y = self.ResidualVector(x,Out)
+        else:
+            y = self.Work.Zeros('MHDy',np.shape(x)) #Built in the by-field order
+        F = self.MHDPrepare(x)
+        self.MHDMomentumRows(F,y)
+        self.MHDFieldRows(F,y)
+        return self.MHDFromBlocked(y,Out)
+
+    def MHDPrepare(self,x):
+        #The fields of the trial state x that the rows of MHDG are made of. If x is a (k,ndof) array
+        #of states every field has one row per state, otherwise the trial fields are NextState.
+        if np.ndim(x) == 1:
+            Trial = self.NextState.Fields
+        else:
+            Trial = self.Work.Fields('Trial',self.MHDLayout,len(x))
+        unp1x,unp1y,ump1x,ump1y,Bp1,E,p = self.MHDLayout.Scatter(x,Trial)
+        p[...,-1]                       = 0 #The last cell is not an unknown
+        unp1x,unp1y,ump1x,ump1y,E       = self.MHDUpdateBC(unp1x,unp1y,ump1x,ump1y,E,InPlace=True)
+        nx       = self.Work.Rate('nx',self.unx,unp1x,self.dt,self.fnx)
+        ny       = self.Work.Rate('ny',self.uny,unp1y,self.dt,self.fny)
+        mx       = self.Work.Rate('mx',self.umx,ump1x,self.dt,self.fmx)
+        my       = self.Work.Rate('my',self.umy,ump1y,self.dt,self.fmy)
+        unthetax = self.Work.Theta('unthetax',self.unx,unp1x,self.theta)
+        unthetay = self.Work.Theta('unthetay',self.uny,unp1y,self.theta)
+        umthetax = self.Work.Theta('umthetax',self.umx,ump1x,self.theta)
+        umthetay = self.Work.Theta('umthetay',self.umy,ump1y,self.theta)
+        Bntheta  = self.Work.Theta('Btheta',self.B,Bp1,self.theta)
+        #Pi_RT Btheta and the midpoint values of E on every element
+        RTnx,RTny,RTmx,RTmy = self.PiRT(Bntheta)
+        Em                  = self.FlatMidValues(E)
+        return nx,ny,mx,my,unthetax,unthetay,umthetax,umthetay,Bntheta,Bp1,E,p,RTnx,RTny,RTmx,RTmy,Em
+
+    def MHDMomentumRows(self,F,y,Rows=None):
+        #Adds to the by-field residual y the momentum rows of Rows (see MomentumRows), by default
+        #all of them. Tested against the TVh basis function v the row is
+        #(n,v)+(1/Re)[utheta,v]-(J x Pi_RT Btheta,v)-(p,div v), with n=(u^{n+1}-u^n)/dt-f and
+        #J = E+utheta x Pi_RT Btheta, which takes different values on each element.
+        nx,ny,mx,my,unthetax,unthetay,umthetax,umthetay,Bntheta,Bp1,E,p,RTnx,RTny,RTmx,RTmy,Em = F
+        if Rows is None:
+            Rows = self.MomentumRows()
+        Flat          = Rows['Flat']
+        Start, Edges  = self.Mesh.FlatStart[Flat], self.Mesh.FlatEdges[Flat]
+        RTnx,RTny     = RTnx[...,Flat],RTny[...,Flat]
+        RTmx,RTmy     = RTmx[...,Flat],RTmy[...,Flat]
+        Jn            = E[...,Start]+self.Cross2Dto1D(unthetax[...,Start],unthetay[...,Start],RTnx,RTny)
+        Jm            = Em[...,Flat]+self.Cross2Dto1D(umthetax[...,Edges],umthetay[...,Edges],RTmx,RTmy)
+        JxB           = np.concatenate(self.Cross1Dto2D(Jn,RTnx,RTny)+self.Cross1Dto2D(Jm,RTmx,RTmy),axis=-1)
+        n             = np.concatenate((nx,ny,mx,my),axis=-1)
+        utheta        = np.concatenate((unthetax,unthetay,umthetax,umthetay),axis=-1)
+        y[...,Rows['y']] += ApplyOperator(Rows['L2'],n)+(1/self.Re)*ApplyOperator(Rows['H1'],utheta)\
+                           -ApplyOperator(Rows['JxB'],JxB)-ApplyOperator(Rows['Div'],p)
+        return y
 
-        Faraday = (self.MRot).dot(E)+(Bp1-self.B)/self.dt
+    def MHDFieldRows(self,F,y):
+        #Adds to the by-field residual y the Faraday, Ampere-Ohm and continuity rows
+        nx,ny,mx,my,unthetax,unthetay,umthetax,umthetay,Bntheta,Bp1,E,p,RTnx,RTny,RTmx,RTmy,Em = F
+        Op         = self.ResidualOperators()
+        intN,intNM = len(self.Mesh.NumInternalNodes),len(self.Mesh.NumInternalMidNodes)
+        NumEdges   = len(self.Mesh.EdgeNodes)
+        Faraday  = self.Work.Rate('Faraday',self.B,Bp1,self.dt,0)
+        Faraday += ApplyOperator(self.MRot,E)
 
         MagnN  = 2*intN+2*intNM
         # Faraday
-        for k in range(len(self.Mesh.EdgeNodes)):
-            Cells = self.Mesh.EdgestoCells[i]
-            for Cell in Cells:
-                Element      = self.Mesh.ElementEdges[Cell]
-                ind          = Element.index(i)
-                TestFar      = np.zeros(len(Element))
-                TestFar[ind] = 1
-                locFar       = self.GetLocalEhDOF(Cell,Faraday)
-                y[k+MagnN]         = y[k+MagnN]+locFar.dot(self.MEList[Cell].dot(TestFar))
+        #Every row is the product with the basis function of the last internal midnode, left over
+        #from the midnode loop of the momentum rows
+        y[...,MagnN:MagnN+NumEdges] += ApplyOperator(Op['Faraday'],Faraday)
         #Ampere-Ohm
-        k,ElecN = 0,MagnN+len(self.Mesh.EdgeNodes)
-        for i in self.Mesh.NumInternalNodes:
-            D      = np.zeros((len(self.Mesh.Nodes)))
-            D[i]   = 1
-            RotD   = (self.MRot).dot(D)
-            Cells  = self.Mesh.NodestoCells[i]
-            for Cell in Cells:
-                LocRotD   = self.GetLocalEhDOF(Cell,RotD)
-                LocthetaB = self.GetLocalEhDOF(Cell,Bntheta)
-                LocE      = self.GetLocalVhDOF(Cell,E)
-                LocD      = self.GetLocalVhDOF(Cell,D)
-                Loch      = self.GetLocalVhDOF(Cell,self.hdof)
-                RTBthetax,RTBthetay = self.PiRTBn(LocthetaB,Cell)
-                
-                locunthetax,locunthetay, nouse1,nouse2 = self.GetLocalTVhDOF(Cell,unthetax,unthetay,mx,my)
-
-                J    = LocE+self.Cross2Dto1D(locunthetax,locunthetay,RTBthetax,RTBthetay)
-                y[k+ElecN]    = y[k+ElecN]\
-                               +(J-Loch).dot(self.MVList[Cell].dot(LocD))\
-                               -(1/self.Rm)*LocthetaB.dot(self.MEList[Cell].dot(LocRotD))
-            k = k+1
-
-        k = 0
+        #J = E+u x Pi_RT B takes different values on each element, it is tested element by element
+        ElecN = MagnN+NumEdges
+        Start = self.Mesh.FlatStart
+        J     = E[...,Start]+self.Cross2Dto1D(unthetax[...,Start],unthetay[...,Start],RTnx,RTny)-self.hdof[Start]
+        y[...,ElecN:ElecN+intN] += ApplyOperator(Op['Ampere'],J)-(1/self.Rm)*ApplyOperator(Op['CurlB'],Bntheta)
+        #Continuity, the last cell is fixed by the closure
         Nump = ElecN+intN
         NumE = len(self.Mesh.ElementEdges)
-        # Div = np.zeros((NumE),dtype=float)
-        # As  = []
-        # for i in range(NumE-1):
-        #     lunxi ,lunyi ,lumxi ,lumyi  = self.GetLocalTVhDOF(i,unthetax,unthetay,umthetax,umthetay)
-        #     Divui,Ai                 = self.DIVu(i,lunxi,lunyi,lumxi,lumyi)
-        #     Div[i] = Divui
-        #     As.append(Ai)
-        
-        # Div[NumE-1] = -np.sum(Divui)
-        # print('divu'+str(Div[NumE-1]))
-        # Ai,V,En = self.Mesh.Area(self.Mesh.ElementEdges[NumE-1],self.Mesh.Orientations[NumE-1])
-        # As.append(Ai)
-        lunxl ,lunyl ,lumxl ,lumyl = self.GetLocalTVhDOF(NumE-1,unthetax,unthetay,umthetax,umthetay)
-        Divul,Al                   = self.DIVu(NumE-1,lunxl,lunyl,lumxl,lumyl)
-        for i in range(NumE-1):
-            lunxi ,lunyi ,lumxi ,lumyi = self.GetLocalTVhDOF(i,unthetax,unthetay,umthetax,umthetay)
-            Divui,Ai                   = self.DIVu(i,lunxi,lunyi,lumxi,lumyi)
-            
-            y[k+Nump]     = y[k+Nump]+self.PhInProd(i,Divui*Ai,1)-self.PhInProd(NumE-1,Divul*Al,1)
-            k = k+1
+        Div  = ApplyOperator(self.Diagnostics.DivU,np.concatenate((unthetax,unthetay,umthetax,umthetay),axis=-1))
+        y[...,Nump:Nump+NumE-1] += Div[...,0:NumE-1]-Div[...,NumE-1:NumE]
         return y
-    
+
+    def ResidualOperators(self):
+        #Sparse operators of the rows of MHDG, assembled once from the local matrices. Acting on
+        #global TVh vectors (unx,uny,umx,umy): 'L2' and 'H1' the transposed mass matrices of
+        #TVhInProd and TVhSemiInProd. 'JxB' acts on the flat local values (nx,ny,mx,my) of a field
+        #that is discontinuous across the elements, each component ordered as Mesh.FlatStart, and
+        #'Div' is the transposed cell divergence. 'Faraday' is the row of the Eh mass matrix of the
+        #tested edge, 'Ampere' is LocalOperator('Vh') and 'CurlB' Curl^T MassMatrix('Eh')^T, both
+        #restricted to the internal nodes.
+        if self.Operators:
+            return self.Operators
+        Mesh   = self.Mesh
+        Ptr    = Mesh.ElementPtr
+        NumF   = Ptr[-1]
+        Global, Local = self.TVhLocalIndexing()
+        rows, cols, vals = Kernels.Kernel('LocalTriplets')(4*Ptr,np.arange(4*NumF),self.TVhLocalBlocks()[0])
+        n      = 2*len(Mesh.Nodes)+2*len(Mesh.EdgeNodes)
+        Op     = self.Operators
+        Op['L2']  = self.MassMatrix('TVh').T.tocsr()
+        Op['H1']  = self.MassMatrix('TVhH1').T.tocsr()
+        Op['JxB'] = coo_matrix((vals,(Global[cols],Local[rows])),shape=(n,4*NumF)).tocsr()
+        Op['Div'] = self.Diagnostics.DivU.T.tocsr()
+        Tested    = self.Mesh.NumInternalMidNodes[-1]
+        Op['Faraday'] = self.MassMatrix('Eh').T.tocsr()[[Tested]]
+        Int           = np.asarray(Mesh.NumInternalNodes,dtype=int)
+        Op['Ampere']  = self.LocalOperator('Vh')[Int]
+        Op['CurlB']   = (self.MRotCSC.T@self.MassMatrix('Eh').T).tocsr()[Int]
+        return Op
+
+    def MomentumRows(self,NodeRows=None,MidRows=None,Cells=None):
+        #The operators of the momentum rows of the internal nodes NumInternalNodes[k], k in NodeRows,
+        #and internal midnodes NumInternalMidNodes[k], k in MidRows, by default all of them, and
+        #the positions 'y' of those rows in the by-field residual. 'Flat' are the corners (in the
+        #order of Mesh.FlatStart) of the elements Cells, which must include all the elements around
+        #the rows (by default those elements), and 'JxB' only acts on their values.
+        Mesh        = self.Mesh
+        Op          = self.ResidualOperators()
+        if NodeRows is None and MidRows is None and Cells is None and 'Rows' in Op:
+            return Op['Rows']
+        intN, intNM = len(Mesh.NumInternalNodes), len(Mesh.NumInternalMidNodes)
+        NodeRows    = np.arange(intN) if NodeRows is None else np.asarray(NodeRows,dtype=int)
+        MidRows     = np.arange(intNM) if MidRows is None else np.asarray(MidRows,dtype=int)
+        nN, nE      = len(Mesh.Nodes), len(Mesh.EdgeNodes)
+        IntN, IntM  = np.asarray(Mesh.NumInternalNodes,dtype=int)[NodeRows], np.asarray(Mesh.NumInternalMidNodes,dtype=int)[MidRows]
+        TVhRows     = np.concatenate((IntN,nN+IntN,2*nN+IntM,2*nN+nE+IntM))
+        NumF        = Mesh.ElementPtr[-1]
+        JxB         = Op['JxB'][TVhRows]
+        if Cells is None:
+            Flat    = np.unique(JxB.indices%NumF)
+        else:
+            Flat    = np.nonzero(np.isin(Mesh.FlatElement,Cells))[0]
+        Rows = {'y'   : np.concatenate((NodeRows,intN+NodeRows,2*intN+MidRows,2*intN+intNM+MidRows)),
+                'Flat': Flat,
+                'L2'  : Op['L2'][TVhRows],
+                'H1'  : Op['H1'][TVhRows],
+                'JxB' : JxB[:,np.concatenate([Flat+k*NumF for k in range(4)])],
+                'Div' : Op['Div'][TVhRows]}
+        if Cells is None and len(NodeRows) == intN and len(MidRows) == intNM:
+            Op['Rows'] = Rows
+        return Rows
+
     def MHDSplity(self,y):
         fnx,fny = np.zeros((len(self.Mesh.Nodes)),dtype=float),np.zeros((len(self.Mesh.Nodes)),dtype=float)
         fmx,fmy = np.zeros((len(self.Mesh.MidNodes)),dtype=float),np.zeros((len(self.Mesh.MidNodes)),dtype=float)
@@ -776,105 +807,43 @@ class PDEFullMHD(object):
     ##########################################################################################
     def MHDFlowConcatenate(self):
         #This function returns an array that concatenates all the unknowns
-        intunx = [self.unx[i] for i in self.Mesh.NumInternalNodes]
-        intuny = [self.uny[i] for i in self.Mesh.NumInternalNodes]
-        intumx = [self.umx[i] for i in self.Mesh.NumInternalMidNodes]
-        intumy = [self.umy[i] for i in self.Mesh.NumInternalMidNodes]
-        tempp  = self.p[0:len(self.p)-1]
-        return np.concatenate((intunx,intuny,intumx,intumy,tempp), axis=None)
+        return self.FlowLayout.Gather((self.unx,self.uny,self.umx,self.umy,self.p))
 
     def MHDFloweConcatenate(self,unx,uny,umx,umy,p):
         #This function returns an array that concatenates all the unknowns
-        intunx = [unx[i] for i in self.Mesh.NumInternalNodes]
-        intuny = [uny[i] for i in self.Mesh.NumInternalNodes]
-        intumx = [umx[i] for i in self.Mesh.NumInternalMidNodes]
-        intumy = [umy[i] for i in self.Mesh.NumInternalMidNodes]
-
-        return np.concatenate((intunx,intuny,intumx,intumy,p[0:len(p)-1]), axis=None)
+        return self.FlowLayout.Gather((unx,uny,umx,umy,p))
 
     def MHDNumFlowDOF(self):
-        return 2*len(self.Mesh.NumInternalNodes)+2*len(self.Mesh.NumInternalMidNodes)+len(self.Mesh.ElementEdges)-1
+        return self.FlowLayout.NumDOF
 
     def MHDsetElecMagField(self,B,E):
         self.B,self.E = B, E
 
     def ComputeElecMagDOF(self,t):
-        def dummyB(xv):
-            return self.B(xv,t+self.theta*self.dt)
-        def dummyE(xv):
-            return self.E(xv,t+self.theta*self.dt)
-        self.Endof = self.NodalDOFs(dummyE,self.Mesh.Nodes)
-        self.Emdof = self.NodalDOFs(dummyE,self.Mesh.MidNodes)
-        tempBn             = self.NodalDOFs(dummyB,self.Mesh.Nodes)
+        self.Endof = self.DataDOFs(self.E,self.Mesh.Nodes,t+self.theta*self.dt)
+        self.Emdof = self.DataDOFs(self.E,self.Mesh.MidNodes,t+self.theta*self.dt)
+        tempBn             = self.DataDOFs(self.B,self.Mesh.Nodes,t+self.theta*self.dt)
         self.Bnx,self.Bny  = self.DecompIntoCoord(tempBn)
-        tempBm             = self.NodalDOFs(dummyB,self.Mesh.MidNodes)
+        tempBm             = self.DataDOFs(self.B,self.Mesh.MidNodes,t+self.theta*self.dt)
         self.Bmx,self.Bmy  = self.DecompIntoCoord(tempBm)
     
     def MHDFlowupdatef(self,t):
-        def dummyf(xv):
-            return self.f(xv,t+self.theta*self.dt)
-        tempfn             = self.NodalDOFs(dummyf,self.Mesh.Nodes)
+        tempfn             = self.DataDOFs(self.f,self.Mesh.Nodes,t+self.theta*self.dt)
         self.fnx,self.fny  = self.DecompIntoCoord(tempfn)
-        tempfm             = self.NodalDOFs(dummyf,self.Mesh.MidNodes)
+        tempfm             = self.DataDOFs(self.f,self.Mesh.MidNodes,t+self.theta*self.dt)
         self.fmx, self.fmy = self.DecompIntoCoord(tempfm)
 
     def MHDFlowUpdateInt(self,x,unx,uny,umx,umy,p):
-        cut1 = len(self.Mesh.NumInternalNodes) #Number of internal dofs for ux
-        cut2 = 2*cut1                          #Number of internal dofs for uy
-        cut3 = cut2+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umx
-        cut4 = cut3+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umy 
-        Cutx = np.split(x,[cut1,cut2,cut3,cut4])
-        runx,runy = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        rumx,rumy = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        rp        = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        #
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-        j = 0
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = Cutx[0][j]
-            runy[i] = Cutx[1][j]
-            j = j+1
-        j = 0
-        for i in self.Mesh.NumInternalMidNodes:
-            #print(f'Cutx[2][j]={Cutx[2][j]}')
-            rumx[i] = Cutx[2][j]
-            #print(f'rumx[i]={rumx[i]}')
-            rumy[i] = Cutx[3][j]
-            j = j+1
-        rp[0:len(rp)-1]   = Cutx[4]
-        rp[len(rp)-1]     = -np.sum(p[0:len(p)-1])
+        Closure                = -np.sum(p[0:len(p)-1])
+        runx,runy,rumx,rumy,rp = self.FlowLayout.Empty()
+        self.FlowLayout.CopyBoundary((unx,uny,umx,umy,p),(runx,runy,rumx,rumy,rp))
+        self.FlowLayout.Scatter(x,(runx,runy,rumx,rumy,rp))
+        rp[len(rp)-1]          = Closure
         return runx,runy,rumx,rumy,rp
 
     def MHDFlowUpdateBC(self,unx,uny,umx,umy):
-        runx,runy = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        rumx,rumy = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        rp        = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-
-        for i in self.Mesh.NumInternalMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-
-        j = 0
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = self.ubnx[j]
-            runy[i] = self.ubny[j]
-            j      = j+1
-
-        j = 0
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = self.ubmx[j]
-            rumy[i] = self.ubmy[j]
-            j      = j+1
-        return runx,runy,rumx,rumy
+        runx,runy,rumx,rumy = [np.array(Field,dtype=float) for Field in (unx,uny,umx,umy)]
+        return self.SetVelocityBC(runx,runy,rumx,rumy)
 
     def MHDSetFlowBCandSource(self,ub,f):
         self.ub,self.f = ub,f
@@ -891,43 +860,36 @@ class PDEFullMHD(object):
         return lEm
 
     def MHDFlowComputeBC(self,t):
-        def dummyub(xv):
-            return self.ub(xv,t+self.dt)
-        tempubn              = self.NodalDOFs(dummyub,self.Mesh.BNodes)
+        tempubn              = self.DataDOFs(self.ub,self.Mesh.BNodes,t+self.dt)
         self.ubnx, self.ubny = self.DecompIntoCoord(tempubn)
-        tempum               = self.NodalDOFs(dummyub,self.Mesh.BMidNodes)
+        tempum               = self.DataDOFs(self.ub,self.Mesh.BMidNodes,t+self.dt)
         self.ubmx, self.ubmy = self.DecompIntoCoord(tempum)
 
-    def MHDFlowG(self,x):
-        unp1x,unp1y = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        ump1x,ump1y = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        p           = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        unp1x,unp1y,ump1x,ump1y,p = self.FlowUpdateInt(x,unp1x,unp1y,ump1x,ump1y,p)
-        unp1x,unp1y,ump1x,ump1y   = self.FlowUpdateBC(unp1x,unp1y,ump1x,ump1y)
+    @BatchedByLoop
+    def MHDFlowG(self,x,Out=None):
+        unp1x,unp1y,ump1x,ump1y,p = self.FlowLayout.Scatter(x,self.Work.Fields('Flow',self.FlowLayout))
+        p[len(p)-1]               = 0 #The last cell is not an unknown
+        unp1x,unp1y,ump1x,ump1y   = self.SetVelocityBC(unp1x,unp1y,ump1x,ump1y)
         #p = self.dt*p
         intN  = len(self.Mesh.NumInternalNodes) 
         intMN = len(self.Mesh.NumInternalMidNodes)
 
-        nx      = (unp1x-self.unx)/self.dt - self.fnx
-        ny      = (unp1y-self.uny)/self.dt - self.fny
-        mx      = (ump1x-self.umx)/self.dt - self.fmx
-        my      = (ump1y-self.umy)/self.dt - self.fmy
-        unthetax = (1-self.theta)*self.unx+self.theta*unp1x 
-        unthetay = (1-self.theta)*self.uny+self.theta*unp1y
-        umthetax = (1-self.theta)*self.umx+self.theta*ump1x 
-        umthetay = (1-self.theta)*self.umy+self.theta*ump1y
+        nx       = self.Work.Rate('nx',self.unx,unp1x,self.dt,self.fnx)
+        ny       = self.Work.Rate('ny',self.uny,unp1y,self.dt,self.fny)
+        mx       = self.Work.Rate('mx',self.umx,ump1x,self.dt,self.fmx)
+        my       = self.Work.Rate('my',self.umy,ump1y,self.dt,self.fmy)
+        unthetax = self.Work.Theta('unthetax',self.unx,unp1x,self.theta)
+        unthetay = self.Work.Theta('unthetay',self.uny,unp1y,self.theta)
+        umthetax = self.Work.Theta('umthetax',self.umx,ump1x,self.theta)
+        umthetay = self.Work.Theta('umthetay',self.umy,ump1y,self.theta)
 
-        y = np.zeros((len(x)),dtype=float) 
+        y = self.ResidualVector(x,Out)
         k = 0 
         for i in self.Mesh.NumInternalNodes:
             Cells = self.Mesh.NodestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1nx[i]   = 1
+            v1nx,v1ny,v1mx,v1my = self.Work.TestFunction(0,i)
             
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2ny[i]   = 1
+            v2nx,v2ny,v2mx,v2my = self.Work.TestFunction(1,i)
             for Cell in Cells:
                 luntx ,lunty ,lumtx ,lumty  = self.GetLocalTVhDOF(Cell,unthetax,unthetay,umthetax,umthetay)
                 lnx ,lny ,lmx ,lmy          = self.GetLocalTVhDOF(Cell,nx,ny,mx,my)
@@ -957,13 +919,9 @@ class PDEFullMHD(object):
         k = 0
         for i in self.Mesh.NumInternalMidNodes:
             Cells = self.Mesh.EdgestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1mx[i]   = 1
+            v1nx,v1ny,v1mx,v1my = self.Work.TestFunction(2,i)
             
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2my[i]   = 1
+            v2nx,v2ny,v2mx,v2my = self.Work.TestFunction(3,i)
             for Cell in Cells:
                 
                 luntx ,lunty ,lumtx ,lumty  = self.GetLocalTVhDOF(Cell,unthetax,unthetay,umthetax,umthetay)
@@ -990,19 +948,9 @@ class PDEFullMHD(object):
                     (1/self.Re)*self.TVhSemiInProd(Cell,luntx,lunty,lumtx,lumty,lv2nx,lv2ny,lv2mx,lv2my)-self.PhInProd(Cell,p[Cell],divv2*A)\
                     -self.TVhInProd(Cell,JxBnx,JxBny,JxBmx,JxBmy,lv2nx,lv2ny,lv2mx,lv2my)
             k = k+1
-        k = 0
         last = len(self.Mesh.ElementEdges)-1
-        luntx2 ,lunty2 ,lumtx2 ,lumty2  = self.GetLocalTVhDOF(last,unthetax,unthetay,umthetax,umthetay)
-        Divu2,A2                        = self.DIVu(last,luntx2,lunty2,lumtx2,lumty2)
-        for i in range(len(self.Mesh.ElementEdges)-1):
-            
-            luntx ,lunty ,lumtx ,lumty  = self.GetLocalTVhDOF(i,unthetax,unthetay,umthetax,umthetay)
-            Divu,A                      = self.DIVu(i,luntx,lunty,lumtx,lumty)
-            #Sif Divu>1e-4:
-                #print(f'i={i}')
-                #print(f'Divu={Divu}')
-            y[k+2*intN+2*intMN]             = y[k+2*intN+2*intMN]+self.PhInProd(i,Divu*A,1)-self.PhInProd(last,Divu2*A2,1)
-            k = k+1
+        Div  = self.CellDivergence(unthetax,unthetay,umthetax,umthetay)
+        y[2*intN+2*intMN:2*intN+2*intMN+last] += Div[0:last]-Div[last]
         return y
 
     def MHDFlowSplity(self,y):
@@ -1033,24 +981,14 @@ class PDEFullMHD(object):
     ##########################################################################################
     def nMHDFlowConcatenate(self):
         #This function returns an array that concatenates all the unknowns
-        intunx = [self.unx[i] for i in self.Mesh.NumInternalNodes]
-        intuny = [self.uny[i] for i in self.Mesh.NumInternalNodes]
-        intumx = [self.umx[i] for i in self.Mesh.NumInternalMidNodes]
-        intumy = [self.umy[i] for i in self.Mesh.NumInternalMidNodes]
-        tempp  = self.p[0:len(self.p)-1]
-        return np.concatenate((intunx,intuny,intumx,intumy,tempp), axis=None)
+        return self.FlowLayout.Gather((self.unx,self.uny,self.umx,self.umy,self.p))
 
     def nMHDFloweConcatenate(self,unx,uny,umx,umy,p):
         #This function returns an array that concatenates all the unknowns
-        intunx = [unx[i] for i in self.Mesh.NumInternalNodes]
-        intuny = [uny[i] for i in self.Mesh.NumInternalNodes]
-        intumx = [umx[i] for i in self.Mesh.NumInternalMidNodes]
-        intumy = [umy[i] for i in self.Mesh.NumInternalMidNodes]
-
-        return np.concatenate((intunx,intuny,intumx,intumy,p[0:len(p)-1]), axis=None)
+        return self.FlowLayout.Gather((unx,uny,umx,umy,p))
 
     def nMHDNumFlowDOF(self):
-        return 2*len(self.Mesh.NumInternalNodes)+2*len(self.Mesh.NumInternalMidNodes)+len(self.Mesh.ElementEdges)-1
+        return self.FlowLayout.NumDOF
 
     def nMHDsetElecMagField(self,B,E):
         self.B,self.E = B, E
@@ -1070,62 +1008,16 @@ class PDEFullMHD(object):
         self.fmx, self.fmy = self.DecompIntoCoord(tempfm)
 
     def nMHDFlowUpdateInt(self,x,unx,uny,umx,umy,p):
-        cut1 = len(self.Mesh.NumInternalNodes) #Number of internal dofs for ux
-        cut2 = 2*cut1                          #Number of internal dofs for uy
-        cut3 = cut2+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umx
-        cut4 = cut3+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umy 
-        Cutx = np.split(x,[cut1,cut2,cut3,cut4])
-        runx,runy = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        rumx,rumy = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        rp        = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        #
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-        j = 0
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = Cutx[0][j]
-            runy[i] = Cutx[1][j]
-            j = j+1
-        j = 0
-        for i in self.Mesh.NumInternalMidNodes:
-            #print(f'Cutx[2][j]={Cutx[2][j]}')
-            rumx[i] = Cutx[2][j]
-            #print(f'rumx[i]={rumx[i]}')
-            rumy[i] = Cutx[3][j]
-            j = j+1
-        rp[0:len(rp)-1]   = Cutx[4]
-        rp[len(rp)-1]     = -np.sum(p[0:len(p)-1])
+        Closure                = -np.sum(p[0:len(p)-1])
+        runx,runy,rumx,rumy,rp = self.FlowLayout.Empty()
+        self.FlowLayout.CopyBoundary((unx,uny,umx,umy,p),(runx,runy,rumx,rumy,rp))
+        self.FlowLayout.Scatter(x,(runx,runy,rumx,rumy,rp))
+        rp[len(rp)-1]          = Closure
         return runx,runy,rumx,rumy,rp
 
     def nMHDFlowUpdateBC(self,unx,uny,umx,umy):
-        runx,runy = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        rumx,rumy = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        rp        = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-
-        for i in self.Mesh.NumInternalMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-
-        j = 0
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = self.ubnx[j]
-            runy[i] = self.ubny[j]
-            j      = j+1
-
-        j = 0
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = self.ubmx[j]
-            rumy[i] = self.ubmy[j]
-            j      = j+1
-        return runx,runy,rumx,rumy
+        runx,runy,rumx,rumy = [np.array(Field,dtype=float) for Field in (unx,uny,umx,umy)]
+        return self.SetVelocityBC(runx,runy,rumx,rumy)
 
     def nMHDSetFlowBCandSource(self,ub,f):
         self.ub,self.f = ub,f
@@ -1147,27 +1039,22 @@ class PDEFullMHD(object):
         tempum               = self.NodalDOFs(self.ub,self.Mesh.BMidNodes)
         self.ubmx, self.ubmy = self.DecompIntoCoord(tempum)
 
-    def nMHDFlowG(self,x):
-        unx,uny = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        umx,umy = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        p       = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        unx,uny,umx,umy,p = self.FlowUpdateInt(x,unx,uny,umx,umy,p)
-        unx,uny,umx,umy   = self.FlowUpdateBC(unx,uny,umx,umy)
+    @BatchedByLoop
+    def nMHDFlowG(self,x,Out=None):
+        unx,uny,umx,umy,p = self.FlowLayout.Scatter(x,self.Work.Fields('Flow',self.FlowLayout))
+        p[len(p)-1]       = 0 #The last cell is not an unknown
+        unx,uny,umx,umy   = self.SetVelocityBC(unx,uny,umx,umy)
         #p = self.dt*p
         intN  = len(self.Mesh.NumInternalNodes) 
         intMN = len(self.Mesh.NumInternalMidNodes)
 
-        y = np.zeros((len(x)),dtype=float) 
+        y = self.ResidualVector(x,Out)
         k = 0 
         for i in self.Mesh.NumInternalNodes:
             Cells = self.Mesh.NodestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1nx[i]   = 1
+            v1nx,v1ny,v1mx,v1my = self.Work.TestFunction(0,i)
             
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2ny[i]   = 1
+            v2nx,v2ny,v2mx,v2my = self.Work.TestFunction(1,i)
             for Cell in Cells:
                 luntx ,lunty ,lumtx ,lumty  = self.GetLocalTVhDOF(Cell,unx,uny,umx,umy)
                 lv1nx,lv1ny,lv1mx,lv1my     = self.GetLocalTVhDOF(Cell,v1nx,v1ny,v1mx,v1my)
@@ -1194,13 +1081,9 @@ class PDEFullMHD(object):
         k = 0
         for i in self.Mesh.NumInternalMidNodes:
             Cells = self.Mesh.EdgestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1mx[i]   = 1
+            v1nx,v1ny,v1mx,v1my = self.Work.TestFunction(2,i)
             
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2my[i]   = 1
+            v2nx,v2ny,v2mx,v2my = self.Work.TestFunction(3,i)
             for Cell in Cells:
                 
                 luntx,lunty ,lumtx ,lumty    = self.GetLocalTVhDOF(Cell,unx,uny,umx,umy)
@@ -1227,16 +1110,9 @@ class PDEFullMHD(object):
                     (1/self.Re)*self.TVhSemiInProd(Cell,luntx,lunty,lumtx,lumty,lv2nx,lv2ny,lv2mx,lv2my)-self.PhInProd(Cell,p[Cell],divv2*A)\
                     -self.TVhInProd(Cell,JxBnx,JxBny,JxBmx,JxBmy,lv2nx,lv2ny,lv2mx,lv2my)
             k = k+1
-        k = 0
         last = len(self.Mesh.ElementEdges)-1
-        luntx2 ,lunty2 ,lumtx2 ,lumty2  = self.GetLocalTVhDOF(last,unx,uny,umx,umy)
-        Divu2,A2                        = self.DIVu(last,luntx2,lunty2,lumtx2,lumty2)
-        for i in range(len(self.Mesh.ElementEdges)-1):
-            
-            luntx ,lunty ,lumtx ,lumty  = self.GetLocalTVhDOF(i,unx,uny,umx,umy)
-            Divu,A                      = self.DIVu(i,luntx,lunty,lumtx,lumty)
-            y[k+2*intN+2*intMN]             = y[k+2*intN+2*intMN]+self.PhInProd(i,Divu*A,1)-self.PhInProd(last,Divu2*A2,1)
-            k = k+1
+        Div  = self.CellDivergence(unx,uny,umx,umy)
+        y[2*intN+2*intMN:2*intN+2*intMN+last] += Div[0:last]-Div[last]
         return y
 
     def MHDFlowSplity(self,y):
@@ -1267,12 +1143,8 @@ class PDEFullMHD(object):
     ##########################################################################################
     def nFlowConcatenate(self):
         #This function returns an array that concatenates all the unknowns
-        intunx = [self.unx[i] for i in self.Mesh.NumInternalNodes]
-        intuny = [self.uny[i] for i in self.Mesh.NumInternalNodes]
-        intumx = [self.umx[i] for i in self.Mesh.NumInternalMidNodes]
-        intumy = [self.umy[i] for i in self.Mesh.NumInternalMidNodes]
-        tempp  = self.p[0:len(self.p)-1]
-        return np.concatenate((intunx,intuny,intumx,intumy,tempp), axis=None)
+        return self.FlowLayout.Gather((self.unx,self.uny,self.umx,self.umy,self.p))
+
     def nFlowSetSource(self,f):
         self.f = f
 
@@ -1284,97 +1156,41 @@ class PDEFullMHD(object):
 
 
     def nNumFlowDOF(self):
-        return 2*len(self.Mesh.NumInternalNodes)+2*len(self.Mesh.NumInternalMidNodes)+len(self.Mesh.ElementEdges)-1
+        return self.FlowLayout.NumDOF
 
     def nSetFlowBC(self,ub):
         self.ub = ub  #source terms and BC
 
     def nFlowComputeBC(self,t):
-        def dummyub(xv):
-            return self.ub([xv[0],xv[1],t+self.dt])
-        tempubn              = self.NodalDOFs(dummyub,self.Mesh.BNodes)
+        tempubn              = self.DataDOFs(self.ub,self.Mesh.BNodes,t+self.dt,Appended=True)
         self.ubnx,self.ubny  = self.DecompIntoCoord(tempubn)
-        tempum               = self.NodalDOFs(dummyub,self.Mesh.BMidNodes)
+        tempum               = self.DataDOFs(self.ub,self.Mesh.BMidNodes,t+self.dt,Appended=True)
         self.ubmx, self.ubmy = self.DecompIntoCoord(tempum)
 
     def nFlowupdateBC(self,unx,uny,umx,umy):
-        j = 0
-        for i in self.Mesh.NumBoundaryNodes:
-            unx[i]  = self.ubnx[j]
-            uny[i]  = self.ubny[j]
-            j = j+1
-        j = 0
-        for i in self.Mesh.NumBMidNodes:
-            umx[i]  = self.ubmx[j]
-            umy[i]  = self.ubmy[j]
-            j = j+1
-        return unx,uny,umx,umy
+        return self.SetVelocityBC(unx,uny,umx,umy)
 
     def nFlowUpdateUnknownDOFs(self,x,unx,uny,umx,umy,p):
-        cut1 = len(self.Mesh.NumInternalNodes) #Number of internal dofs for ux
-        cut2 = 2*cut1                          #Number of internal dofs for uy
-        cut3 = cut2+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umx
-        cut4 = cut3+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umy 
-        Cutx = np.split(x,[cut1,cut2,cut3,cut4])
-
-        runx,runy = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-        rumx,rumy = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-        rp        = np.zeros((len(self.Mesh.ElementEdges)))
-        
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-        j = 0
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = Cutx[0][j]
-            runy[i] = Cutx[1][j]
-            j = j+1
-        j = 0
-        for i in self.Mesh.NumInternalMidNodes:
-            rumx[i] = Cutx[2][j]
-            rumy[i] = Cutx[3][j]
-            j = j+1
-        rp[0:len(rp)-1]   = Cutx[4]
-        rp[len(rp)-1]     = -np.sum(rp[0:len(rp)-1])
+        runx,runy,rumx,rumy,rp = self.FlowLayout.Empty()
+        self.FlowLayout.CopyBoundary((unx,uny,umx,umy,p),(runx,runy,rumx,rumy,rp))
+        self.FlowLayout.Scatter(x,(runx,runy,rumx,rumy,rp))
+        rp[len(rp)-1]          = -np.sum(rp[0:len(rp)-1])
         return runx,runy,rumx,rumy,rp
 
-    def nFlowG(self,x):
-        unx,uny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-        umx,umy = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-        p       = np.zeros((len(self.Mesh.ElementEdges)))
-
+    @BatchedByLoop
+    def nFlowG(self,x,Out=None):
         intN  = len(self.Mesh.NumInternalNodes) 
         intMN = len(self.Mesh.NumInternalMidNodes)
-        Cutx  = np.split(x,[intN,2*intN,2*intN+intMN,2*intN+2*intMN])
-        j = 0
-        for i in self.Mesh.NumInternalNodes:
-            unx[i] = Cutx[0][j]
-            uny[i] = Cutx[1][j]
-            j = j+1
-        j = 0
-        for i in self.Mesh.NumInternalMidNodes:
-            umx[i] = Cutx[2][j]
-            umy[i] = Cutx[3][j]
-            j = j+1
-
-        p[0:len(p)-1]   = Cutx[4]
-
-        p[len(p)-1]     = -np.sum(p[0:len(p)-1])
-        unx,uny,umx,umy = self.nFlowupdateBC(unx,uny,umx,umy)
-        y = np.zeros((len(x)),dtype=float) 
+        unx,uny,umx,umy,p = self.FlowLayout.Scatter(x,self.Work.Fields('Flow',self.FlowLayout))
+        p[len(p)-1]       = -np.sum(p[0:len(p)-1])
+        unx,uny,umx,umy   = self.nFlowupdateBC(unx,uny,umx,umy)
+        y = self.ResidualVector(x,Out)
         k = 0 
         for i in self.Mesh.NumInternalNodes:
             Cells = self.Mesh.NodestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1nx[i]   = 1
+            v1nx,v1ny,v1mx,v1my = self.Work.TestFunction(0,i)
             
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2ny[i]   = 1
+            v2nx,v2ny,v2mx,v2my = self.Work.TestFunction(1,i)
             for Cell in Cells:
                 lunx ,luny ,lumx ,lumy  = self.GetLocalTVhDOF(Cell,unx,uny,umx,umy)
                 lv1nx,lv1ny,lv1mx,lv1my = self.GetLocalTVhDOF(Cell,v1nx,v1ny,v1mx,v1my)
@@ -1391,13 +1207,9 @@ class PDEFullMHD(object):
         k = 0
         for i in self.Mesh.NumInternalMidNodes:
             Cells = self.Mesh.EdgestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1mx[i]   = 1
+            v1nx,v1ny,v1mx,v1my = self.Work.TestFunction(2,i)
             
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2my[i]   = 1
+            v2nx,v2ny,v2mx,v2my = self.Work.TestFunction(3,i)
             for Cell in Cells:
                 
                 lunx ,luny ,lumx ,lumy  = self.GetLocalTVhDOF(Cell,unx,uny,umx,umy)
@@ -1412,16 +1224,9 @@ class PDEFullMHD(object):
                 y[k+2*intN+intMN]   = y[k+2*intN+intMN]+(1/self.Re)*self.TVhSemiInProd(Cell,lunx,luny,lumx,lumy,lv2nx,lv2ny,lv2mx,lv2my)-self.PhInProd(Cell,p[Cell],divv2*A)\
                                    -self.TVhInProd(Cell,lfnx,lfny,lfmx,lfmy,lv2nx,lv2ny,lv2mx,lv2my)
             k = k+1
-        k = 0
         last = len(self.Mesh.ElementEdges)-1
-        lunx2 ,luny2 ,lumx2 ,lumy2  = self.GetLocalTVhDOF(last,unx,uny,umx,umy)
-        Divu2,A2                    = self.DIVu(last,lunx2,luny2,lumx2,lumy2)
-        for i in range(last):
-            lunx ,luny ,lumx ,lumy  = self.GetLocalTVhDOF(i,unx,uny,umx,umy)
-            Divu,A                  = self.DIVu(i,lunx,luny,lumx,lumy)
-            
-            y[k+2*intN+2*intMN]     = y[k+2*intN+2*intMN]+self.PhInProd(i,Divu*A,1)-self.PhInProd(last,Divu2*A2,1)
-            k = k+1
+        Div  = self.CellDivergence(unx,uny,umx,umy)
+        y[2*intN+2*intMN:2*intN+2*intMN+last] += Div[0:last]-Div[last]
         return y
 
     def nSplity(self,y):
@@ -1451,15 +1256,10 @@ class PDEFullMHD(object):
     ##########################################################################################
     def FlowConcatenate(self):
         #This function returns an array that concatenates all the unknowns
-        intunx = [self.unx[i] for i in self.Mesh.NumInternalNodes]
-        intuny = [self.uny[i] for i in self.Mesh.NumInternalNodes]
-        intumx = [self.umx[i] for i in self.Mesh.NumInternalMidNodes]
-        intumy = [self.umy[i] for i in self.Mesh.NumInternalMidNodes]
-        tempp  = self.p[0:len(self.p)-1]
-        return np.concatenate((intunx,intuny,intumx,intumy,tempp), axis=None)
+        return self.FlowLayout.Gather((self.unx,self.uny,self.umx,self.umy,self.p))
 
     def NumFlowDOF(self):
-        return 2*len(self.Mesh.NumInternalNodes)+2*len(self.Mesh.NumInternalMidNodes)+len(self.Mesh.ElementEdges)-1
+        return self.FlowLayout.NumDOF
 
     def setElecMagField(self,B,E):
         self.B,self.E = B, E
@@ -1477,112 +1277,57 @@ class PDEFullMHD(object):
     #     self.Bmx,self.Bmy  = self.DecompIntoCoord(tempBm)
     
     def Flowupdatef(self,t):
-        def dummyf(xv):
-            return self.f(xv,t+self.theta*self.dt)
-        tempfn             = self.NodalDOFs(dummyf,self.Mesh.Nodes)
+        tempfn             = self.DataDOFs(self.f,self.Mesh.Nodes,t+self.theta*self.dt)
         self.fnx,self.fny  = self.DecompIntoCoord(tempfn)
-        tempfm             = self.NodalDOFs(dummyf,self.Mesh.MidNodes)
+        tempfm             = self.DataDOFs(self.f,self.Mesh.MidNodes,t+self.theta*self.dt)
         self.fmx, self.fmy = self.DecompIntoCoord(tempfm)
 
     def FlowUpdateInt(self,x,unx,uny,umx,umy,p):
-        cut1 = len(self.Mesh.NumInternalNodes) #Number of internal dofs for ux
-        cut2 = 2*cut1                          #Number of internal dofs for uy
-        cut3 = cut2+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umx
-        cut4 = cut3+len(self.Mesh.NumInternalMidNodes)                #Number of internal dofs for umy 
-        Cutx = np.split(x,[cut1,cut2,cut3,cut4])
-        runx,runy = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        rumx,rumy = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        rp        = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        #
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-        j = 0
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = Cutx[0][j]
-            runy[i] = Cutx[1][j]
-            j = j+1
-        j = 0
-        for i in self.Mesh.NumInternalMidNodes:
-            #print(f'Cutx[2][j]={Cutx[2][j]}')
-            rumx[i] = Cutx[2][j]
-            #print(f'rumx[i]={rumx[i]}')
-            rumy[i] = Cutx[3][j]
-            j = j+1
-        rp[0:len(rp)-1]   = Cutx[4]
-        rp[len(rp)-1]     = -np.sum(p[0:len(p)-1])
+        Closure                = -np.sum(p[0:len(p)-1])
+        runx,runy,rumx,rumy,rp = self.FlowLayout.Empty()
+        self.FlowLayout.CopyBoundary((unx,uny,umx,umy,p),(runx,runy,rumx,rumy,rp))
+        self.FlowLayout.Scatter(x,(runx,runy,rumx,rumy,rp))
+        rp[len(rp)-1]          = Closure
         return runx,runy,rumx,rumy,rp
 
     def FlowUpdateBC(self,unx,uny,umx,umy):
-        runx,runy = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        rumx,rumy = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        rp        = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        
-        for i in self.Mesh.NumInternalNodes:
-            runx[i] = unx[i]
-            runy[i] = uny[i]
-
-        for i in self.Mesh.NumInternalMidNodes:
-            rumx[i] = umx[i]
-            rumy[i] = umy[i]
-
-        j = 0
-        for i in self.Mesh.NumBoundaryNodes:
-            runx[i] = self.ubnx[j]
-            runy[i] = self.ubny[j]
-            j      = j+1
-
-        j = 0
-        for i in self.Mesh.NumBMidNodes:
-            rumx[i] = self.ubmx[j]
-            rumy[i] = self.ubmy[j]
-            j      = j+1
-        return runx,runy,rumx,rumy
+        runx,runy,rumx,rumy = [np.array(Field,dtype=float) for Field in (unx,uny,umx,umy)]
+        return self.SetVelocityBC(runx,runy,rumx,rumy)
 
     def SetFlowBCandSource(self,ub,f):
         self.ub,self.f = ub,f
 
     def FlowComputeBC(self,t):
-        def dummyub(xv):
-            return self.ub(xv,t+self.dt)
-        tempubn              = self.NodalDOFs(dummyub,self.Mesh.BNodes)
+        tempubn              = self.DataDOFs(self.ub,self.Mesh.BNodes,t+self.dt)
         self.ubnx, self.ubny = self.DecompIntoCoord(tempubn)
-        tempum               = self.NodalDOFs(dummyub,self.Mesh.BMidNodes)
+        tempum               = self.DataDOFs(self.ub,self.Mesh.BMidNodes,t+self.dt)
         self.ubmx, self.ubmy = self.DecompIntoCoord(tempum)
 
-    def FlowG(self,x):
-        unp1x,unp1y = np.zeros((len(self.Mesh.Nodes)),dtype =float),np.zeros((len(self.Mesh.Nodes)),dtype =float)
-        ump1x,ump1y = np.zeros((len(self.Mesh.MidNodes)),dtype =float),np.zeros((len(self.Mesh.MidNodes)),dtype =float)
-        p           = np.zeros((len(self.Mesh.ElementEdges)),dtype =float)
-        unp1x,unp1y,ump1x,ump1y,p = self.FlowUpdateInt(x,unp1x,unp1y,ump1x,ump1y,p)
-        unp1x,unp1y,ump1x,ump1y   = self.FlowUpdateBC(unp1x,unp1y,ump1x,ump1y)
+    @BatchedByLoop
+    def FlowG(self,x,Out=None):
+        unp1x,unp1y,ump1x,ump1y,p = self.FlowLayout.Scatter(x,self.Work.Fields('Flow',self.FlowLayout))
+        p[len(p)-1]               = 0 #The last cell is not an unknown
+        unp1x,unp1y,ump1x,ump1y   = self.SetVelocityBC(unp1x,unp1y,ump1x,ump1y)
         #p = self.dt*p
         intN  = len(self.Mesh.NumInternalNodes) 
         intMN = len(self.Mesh.NumInternalMidNodes)
 
-        nx      = (unp1x-self.unx)/self.dt - self.fnx
-        ny      = (unp1y-self.uny)/self.dt - self.fny
-        mx      = (ump1x-self.umx)/self.dt - self.fmx
-        my      = (ump1y-self.umy)/self.dt - self.fmy
-        unthetax = (1-self.theta)*self.unx+self.theta*unp1x 
-        unthetay = (1-self.theta)*self.uny+self.theta*unp1y
-        umthetax = (1-self.theta)*self.umx+self.theta*ump1x 
-        umthetay = (1-self.theta)*self.umy+self.theta*ump1y
+        nx       = self.Work.Rate('nx',self.unx,unp1x,self.dt,self.fnx)
+        ny       = self.Work.Rate('ny',self.uny,unp1y,self.dt,self.fny)
+        mx       = self.Work.Rate('mx',self.umx,ump1x,self.dt,self.fmx)
+        my       = self.Work.Rate('my',self.umy,ump1y,self.dt,self.fmy)
+        unthetax = self.Work.Theta('unthetax',self.unx,unp1x,self.theta)
+        unthetay = self.Work.Theta('unthetay',self.uny,unp1y,self.theta)
+        umthetax = self.Work.Theta('umthetax',self.umx,ump1x,self.theta)
+        umthetay = self.Work.Theta('umthetay',self.umy,ump1y,self.theta)
         
-        y = np.zeros((len(x)),dtype=float) 
+        y = self.ResidualVector(x,Out)
         k = 0 
         for i in self.Mesh.NumInternalNodes:
             Cells = self.Mesh.NodestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1nx[i]   = 1
+            v1nx,v1ny,v1mx,v1my = self.Work.TestFunction(0,i)
             
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2ny[i]   = 1
+            v2nx,v2ny,v2mx,v2my = self.Work.TestFunction(1,i)
             for Cell in Cells:
                 luntx ,lunty ,lumtx ,lumty  = self.GetLocalTVhDOF(Cell,unthetax,unthetay,umthetax,umthetay)
                 lnx ,lny ,lmx ,lmy          = self.GetLocalTVhDOF(Cell,nx,ny,mx,my)
@@ -1602,13 +1347,9 @@ class PDEFullMHD(object):
         k = 0
         for i in self.Mesh.NumInternalMidNodes:
             Cells = self.Mesh.EdgestoCells[i]
-            v1nx,v1ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v1mx,v1my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v1mx[i]   = 1
+            v1nx,v1ny,v1mx,v1my = self.Work.TestFunction(2,i)
             
-            v2nx,v2ny = np.zeros((len(self.Mesh.Nodes))),np.zeros((len(self.Mesh.Nodes)))
-            v2mx,v2my = np.zeros((len(self.Mesh.MidNodes))),np.zeros((len(self.Mesh.MidNodes)))
-            v2my[i]   = 1
+            v2nx,v2ny,v2mx,v2my = self.Work.TestFunction(3,i)
             for Cell in Cells:
                 
                 luntx ,lunty ,lumtx ,lumty  = self.GetLocalTVhDOF(Cell,unthetax,unthetay,umthetax,umthetay)
@@ -1626,17 +1367,9 @@ class PDEFullMHD(object):
                     self.TVhInProd(Cell,lnx,lny,lmx,lmy,lv1nx,lv1ny,lv1mx,lv1my)+\
                     (1/self.Re)*self.TVhSemiInProd(Cell,luntx,lunty,lumtx,lumty,lv2nx,lv2ny,lv2mx,lv2my)-self.PhInProd(Cell,p[Cell],divv2*A)
             k = k+1
-        k = 0
         last = len(self.Mesh.ElementEdges)-1
-        luntx2 ,lunty2 ,lumtx2 ,lumty2  = self.GetLocalTVhDOF(last,unthetax,unthetay,umthetax,umthetay)
-        Divu2,A2                        = self.DIVu(last,luntx2,lunty2,lumtx2,lumty2)
-        for i in range(len(self.Mesh.ElementEdges)-1):
-            
-            luntx ,lunty ,lumtx ,lumty  = self.GetLocalTVhDOF(i,unthetax,unthetay,umthetax,umthetay)
-            Divu,A                      = self.DIVu(i,luntx,lunty,lumtx,lumty)
-
-            y[k+2*intN+2*intMN]             = y[k+2*intN+2*intMN]+self.PhInProd(i,Divu*A,1)-self.PhInProd(last,Divu2*A2,1)
-            k = k+1
+        Div  = self.CellDivergence(unthetax,unthetay,umthetax,umthetay)
+        y[2*intN+2*intMN:2*intN+2*intMN+last] += Div[0:last]-Div[last]
         return y
 
     def Splity(self,y):
@@ -1668,82 +1401,42 @@ class PDEFullMHD(object):
     #         
     def ElectroConcatenate(self):
         #This function returns an array that concatenates all the unknowns
-        intE = [self.E[i] for i in self.Mesh.NumInternalNodes]
-        return np.concatenate((self.B,intE), axis=None)
-    
+        return self.ElectroLayout.Gather((self.B,self.E))
+
     def NumElectroDOF(self):
-        return len(self.Mesh.NumInternalNodes)+len(self.Mesh.EdgeNodes)
+        return self.ElectroLayout.NumDOF
 
     def Electroupdateh(self,t):
-        def dummyh(xv):
-            return self.h([xv[0],xv[1],t+self.theta*self.dt])
-        self.hdof = self.NodalDOFs(dummyh,self.Mesh.Nodes)
+        self.hdof = self.DataDOFs(self.h,self.Mesh.Nodes,t+self.theta*self.dt,Appended=True)
 
     def ElectroComputeBC(self,t):
-        def dummyEb(xv):
-            return self.Eb([xv[0],xv[1],t+self.theta*self.dt])
-        self.ElectroBC = self.NodalDOFs(dummyEb,self.Mesh.BNodes)
+        self.ElectroBC = self.DataDOFs(self.Eb,self.Mesh.BNodes,t+self.theta*self.dt,Appended=True)
 
     def ElectroupdateBC(self,E):
-        j = 0
-        for i in self.Mesh.NumBoundaryNodes:
-            E[i]  = self.ElectroBC[j]
-            j = j+1
+        E[self.ElectroLayout.Boundary[1]] = self.ElectroBC
         return E
 
     def SetElectroBCAndSource(self,h,Eb):
         self.h, self.Eb = h, Eb  #source terms and BC
 
     def ElectroUpdateUnknownDOFs(self,x):
-        cut1 = len(self.Mesh.EdgeNodes) #Number of internal dofs for ux
-        Cutx = np.split(x,[cut1])
-        j = 0
-        for i in self.Mesh.NumInternalNodes:
-            self.E[i]   = Cutx[1][j]
-            j = j+1
-        self.B = Cutx[0]
-
-    def ElectroG(self,x):
-        cut1 = len(self.Mesh.EdgeNodes) #Number of internal dofs for ux
-        Cutx = np.split(x,[cut1])
-        Bnp1 = Cutx[0]
-        E    = np.zeros((len(self.Mesh.Nodes)))
-        j = 0
-        for i in self.Mesh.NumInternalNodes:
-            E[i] = Cutx[1][j]
-            j    = j+1
-        j = 0
-        for i in self.Mesh.NumBoundaryNodes:
-            E[i] = self.ElectroBC[j]
-            j    = j+1
-        y       = np.zeros(len(x))
-        MRot    = self.Rot(self.Mesh.EdgeNodes,self.Mesh.Nodes)
-        Faraday = MRot.dot(E)+(Bnp1-self.B)/self.dt
-        N       = len(self.Mesh.EdgeNodes)
-        for i in range(N):
-            Cells = self.Mesh.EdgestoCells[i]
-            for Cell in Cells:
-                Element      = self.Mesh.ElementEdges[Cell]
-                ind          = Element.index(i)
-                TestFar      = np.zeros(len(Element))
-                TestFar[ind] = 1
-                locFar       = self.GetLocalEhDOF(Cell,Faraday)
-                y[i]         = y[i]+locFar.dot(self.MEList[Cell].dot(TestFar))
-        i = 0
-        for v in self.Mesh.NumInternalNodes:
-            D      = np.zeros((len(self.Mesh.Nodes)))
-            D[v]   = 1
-            RotD   = MRot.dot(D)
-            Cells  = self.Mesh.NodestoCells[v]
-            thetaB = (1-self.theta)*self.B+self.theta*Bnp1
-            for Cell in Cells:
-                LocRotD   = self.GetLocalEhDOF(Cell,RotD)
-                LocthetaB = self.GetLocalEhDOF(Cell,thetaB)
-                LocE      = self.GetLocalVhDOF(Cell,E)
-                LocD      = self.GetLocalVhDOF(Cell,D)
-                Loch      = self.GetLocalVhDOF(Cell,self.hdof)
-                y[i+N]    = y[i+N]+(LocE-Loch).dot(self.MVList[Cell].dot(LocD))-(1/self.Rm)*LocthetaB.dot(self.MEList[Cell].dot(LocRotD))
-            i = i+1
+        self.B = np.zeros(len(self.Mesh.EdgeNodes),dtype=float)
+        self.ElectroLayout.Scatter(x,(self.B,self.E))
+
+    @BatchedByLoop
+    def ElectroG(self,x,Out=None):
+        Bnp1,E   = self.ElectroLayout.Scatter(x,self.Work.Fields('Electro',self.ElectroLayout))
+        E        = self.ElectroupdateBC(E)
+        y        = self.ResidualVector(x,Out)
+        MRot     = self.MRot
+        Faraday  = self.Work.Rate('Faraday',self.B,Bnp1,self.dt,0)
+        Faraday += MRot.dot(E)
+        thetaB   = self.Work.Theta('Btheta',self.B,Bnp1,self.theta)
+        N        = len(self.Mesh.EdgeNodes)
+        Start    = self.Mesh.FlatStart
+        y[0:N]  += self.LocalProduct('Eh',Faraday[self.Mesh.FlatEdges])
+        Ampere   = self.LocalProduct('Vh',(E-self.hdof)[Start])-(1/self.Rm)*self.MRotCSC.T.dot(self.LocalProduct('Eh',thetaB[self.Mesh.FlatEdges]))
+        y[N:N+len(self.Mesh.NumInternalNodes)] += Ampere[self.Mesh.NumInternalNodes]
         return y
 
     #########################################################################################
@@ -1831,56 +1524,94 @@ class PDEFullMHD(object):
         MV = self.LocalMassMatrix(NV,RV,n,A)
         return ME,MV
 
+    def LocalMassMatrixBatch(self,N,R,n,A):
+        #LocalMassMatrix for a stack of elements with n edges, N and R have shape (k,n,d) with d=1,2
+        #so that the small inverses are computed in closed form.
+        M0    = np.einsum('eik,ekl,ejl->eij',R,SmallInverse(np.einsum('eik,eil->ekl',N,R)),R)
+        M1    = np.identity(n)-np.einsum('eik,ekl,ejl->eij',N,SmallInverse(np.einsum('eik,eil->ekl',N,N)),N)
+        gamma = np.sum(R**2,axis=(1,2))/(n*A)
+        return M0+M1*gamma[:,None,None]
+
+    def ElecMagStandMassMatBatch(self,Cells,n):
+        #ElecMagStandMassMat for the elements Cells, all of them with n edges. Returns (k,n,n) arrays.
+        Mesh   = self.Mesh
+        Index  = Mesh.ElementPtr[Cells][:,None]+np.arange(n)
+        X1, X2 = Mesh.NodeArray[Mesh.FlatStart[Index]], Mesh.NodeArray[Mesh.FlatEnd[Index]]
+        Ori    = Mesh.FlatOri[Index]
+        L      = Mesh.EdgeLengths[Mesh.FlatEdges[Index]]
+        P      = Mesh.Centroids[Cells][:,None,:]
+        A      = Mesh.Areas[Cells]
+        NE     = np.stack((X2[:,:,1]-X1[:,:,1],X1[:,:,0]-X2[:,:,0]),axis=2)*(Ori/L)[:,:,None]
+        RE     = (0.5*(X1+X2)-P)*(Ori*L)[:,:,None]
+        #RV[i] collects the second vertex of edge i-1 and the first vertex of edge i
+        dx, yP = X2[:,:,0]-X1[:,:,0], P[:,:,1]
+        Omega1 = dx*((yP-X1[:,:,1])+(2*yP-X1[:,:,1]-X2[:,:,1]))/6
+        Omega2 = dx*((yP-X2[:,:,1])+(2*yP-X1[:,:,1]-X2[:,:,1]))/6
+        RV     = (np.roll(Omega2,1,axis=1)+Omega1)[:,:,None]
+        NV     = np.ones((len(Cells),n,1))
+        return self.LocalMassMatrixBatch(NE,RE,n,A),self.LocalMassMatrixBatch(NV,RV,n,A)
+
+    def ElecMagMassMatrices(self):
+        #The local matrices ME, MV of every element. Elements whose number of edges is in
+        #FastElementSizes (triangles and quads) are computed together, the other polygons
+        #go through ElecMagStandMassMat.
+        Mesh   = self.Mesh
+        NEl    = len(Mesh.ElementEdges)
+        ME, MV = [None]*NEl, [None]*NEl
+        Sizes  = np.diff(Mesh.ElementPtr)
+        for Num in np.unique(Sizes):
+            Cells = np.nonzero(Sizes == Num)[0]
+            if Num in self.FastElementSizes:
+                MEN,MVN = self.ElecMagStandMassMatBatch(Cells,Num)
+                for k in range(len(Cells)):
+                    ME[Cells[k]], MV[Cells[k]] = MEN[k], MVN[k]
+            else:
+                Local = self.Assembler.Map(lambda c: self.ElecMagStandMassMat(Mesh.ElementEdges[c],Mesh.Orientations[c]),Cells)
+                for k in range(len(Cells)):
+                    ME[Cells[k]], MV[Cells[k]] = Local[k]
+        return ME,MV
+
+    def LocalProduct(self,Space,v):
+        #Sum over the elements of M_c^T v_c, where M_c is the local matrix of Space ('Vh' or 'Eh')
+        #and v_c the local values of v, a flat array ordered as Mesh.FlatStart. For a global array
+        #u, LocalProduct('Vh',u[Mesh.FlatStart]) is MassMatrix('Vh').T.dot(u), but v may also
+        #take different values on each element, e.g. Pi_RT B.
+        return self.LocalOperator(Space).dot(v)
+
+    def LocalOperator(self,Space):
+        #Sparse matrix of LocalProduct, assembled once from the local matrices. The entry M_c[i,j]
+        #sits at row Flat[Ptr[c]+j] and column Ptr[c]+i, with Flat = Mesh.FlatStart for 'Vh' and
+        #Mesh.FlatEdges for 'Eh'.
+        if Space in self.LocalOps:
+            return self.LocalOps[Space]
+        Mesh = self.Mesh
+        Ptr  = Mesh.ElementPtr
+        if Space == 'Vh':
+            Locals, Flat, n = self.MVList, Mesh.FlatStart, len(Mesh.Nodes)
+        else:
+            Locals, Flat, n = self.MEList, Mesh.FlatEdges, len(Mesh.EdgeNodes)
+        Blocks           = np.concatenate([np.ravel(M) for M in Locals])
+        rows, cols, vals = Kernels.Kernel('LocalTriplets')(Ptr,np.arange(Ptr[-1]),Blocks)
+        self.LocalOps[Space] = coo_matrix((vals,(Flat[cols],rows)),shape=(n,Ptr[-1])).tocsr()
+        return self.LocalOps[Space]
+
     def BDivSquared(self,B):
-        #This function computes the divergence of B.
-        D      = 0
-        DivMat = self.BDiv()
-        divB   = DivMat.dot(B)
-        for k in range(len(divB)):
-            A,V,E = self.Mesh.Area(self.Mesh.ElementEdges[k],self.Mesh.Orientations[k])
-            D     = D + A*divB[k]**2 
-        return D
+        #This function computes the sum of A*flux^2 over the elements, see DivergenceDiagnostics.
+        return self.Diagnostics.BDivSquared(B)
+
+    def BDivL2Squared(self,B):
+        #This function computes the square of the L2 norm of the divergence of B.
+        return self.Diagnostics.BDivL2Squared(B)
     
     def BDiv(self):
-        NEl = len(self.Mesh.ElementEdges)
-        NE  = len(self.Mesh.EdgeNodes)
-        div = np.zeros((NEl,NE))
-        for i in range(NEl):
-            Element = self.Mesh.ElementEdges[i]
-            N       = len(Element)
-            Ori     = self.Mesh.Orientations[i]
-            for j in range(N):
-                Node1 = self.Mesh.EdgeNodes[Element[j]][0]
-                Node2 = self.Mesh.EdgeNodes[Element[j]][1]
-
-                x1    = self.Mesh.Nodes[Node1][0]
-                y1    = self.Mesh.Nodes[Node1][1] #these formulas are derived in the pdf document
-                x2    = self.Mesh.Nodes[Node2][0]
-                y2    = self.Mesh.Nodes[Node2][1]
-
-                lengthe           = math.sqrt((x2-x1)**2+(y2-y1)**2)
-                div[i,Element[j]] = Ori[j]*lengthe
-        return div
+        #Flux of the edge dofs out of each element, shared with the mesh.
+        return self.Mesh.Operator('Div')
     
     def Rot(self,EdgeNodes,Nodes):
     #This routine computes the primary curl as a matrix
-        nN = len(Nodes)
-        nE = len(EdgeNodes)
-    #curl = np.zeros((nE,nN))
-        curl = lil_matrix((nE,nN))
-        for i in range(nE):
-            Node1 = EdgeNodes[i][0]
-            Node2 = EdgeNodes[i][1]
-            x1 = Nodes[Node1][0]
-            y1 = Nodes[Node1][1]
-            x2 = Nodes[Node2][0]
-            y2 = Nodes[Node2][1]
-            lengthe = math.sqrt((x2-x1)**2+(y2-y1)**2)
-        
-            curl[i,Node2] = 1/lengthe #These formulas are derived in the pdf document
-            curl[i,Node1] = -1/lengthe
-        curl = curl.tocsr()
-        return curl
+        if EdgeNodes is self.Mesh.EdgeNodes and Nodes is self.Mesh.Nodes:
+            return self.Mesh.Operator('Curl')
+        return CurlMatrix(Nodes,EdgeNodes)
 
     def GetLocalEhDOF(self,ElementNum,arr):
         Element = self.Mesh.ElementEdges[ElementNum]
@@ -1904,18 +1635,10 @@ class PDEFullMHD(object):
         return Locarr
 
     def VhL2Norm(self,Arr):
-        Norm = 0
-        for i in range(len(self.Mesh.ElementEdges)):
-            LocArr = self.GetLocalVhDOF(i,Arr)
-            Norm   = Norm+LocArr.dot( self.MVList[i].dot(LocArr))
-        return math.sqrt(Norm)
+        return self.Norm('Vh',Arr)
     
     def EhL2Norm(self,Arr):
-        Norm = 0
-        for i in range(len(self.Mesh.ElementEdges)):
-            LocArr = self.GetLocalEhDOF(i,Arr)
-            Norm   = Norm+LocArr.dot( self.MEList[i].dot(LocArr))
-        return math.sqrt(Norm)
+        return self.Norm('Eh',Arr)
 
     def PiRTBB(self,B,Element,ElementNum,E):
         #The DOF must be local.
@@ -1934,50 +1657,65 @@ class PDEFullMHD(object):
         
         return BB
             
+    def MakeRTOperators(self):
+        #Pi_RT B is linear in B. For every corner of every element, in the order of Mesh.FlatStart,
+        #the csr matrices in RTOperators give from the global B dofs the value of Pi_RT B at the
+        #corner ('nx','ny') and at the midpoint of the local edge starting there ('mx','my').
+        #RTCoeffs[k] are the coefficients of Pi_RT B in its element due to a unit dof on the
+        #local edge k, i.e. the matrix RTKI times the moments computed in PiRTBB.
+        #The moments of a unit dof on every local edge come from the RTMoments kernel on LocalCopies.
+        Mesh    = self.Mesh
+        X       = Mesh.NodeArray
+        x1,y1   = X[Mesh.FlatStart,0],X[Mesh.FlatStart,1]
+        x2,y2   = X[Mesh.FlatEnd,0],  X[Mesh.FlatEnd,1]
+        xh,yh   = (x1+x2)/2,(y1+y2)/2
+        Copy,XCopy,Pos,Next = self.LocalCopies()
+        Moments = np.zeros((len(Pos),3))
+        for i in range(np.max(Pos)+1):
+            Local          = Pos == i
+            Moments[Local] = Kernels.Kernel('RTMoments')(Mesh.ElementPtr,Copy,len(Copy)+Copy,Copy,Mesh.FlatOri,XCopy,\
+                                                         Local.astype(float))[Mesh.FlatElement[Local]]
+        RTKI          = np.array(self.RTKIList,dtype=float)
+        self.RTCoeffs = np.einsum('kij,kj->ki',RTKI[Mesh.FlatElement],Moments)
+        #Every corner is coupled with every edge of its element
+        Sizes = np.diff(Mesh.ElementPtr)[Mesh.FlatElement]
+        Rows  = np.repeat(np.arange(len(Sizes)),Sizes)
+        Start = np.concatenate(([0],np.cumsum(Sizes)))[0:len(Sizes)]
+        Cols  = Mesh.ElementPtr[Mesh.FlatElement[Rows]]+np.arange(len(Rows))-np.repeat(Start,Sizes)
+        C     = self.RTCoeffs[Cols]
+        Shape = (len(Sizes),len(Mesh.EdgeNodes))
+        self.RTOperators = {}
+        for Name,Comp,Coord in [('nx',0,x1),('ny',1,y1),('mx',0,xh),('my',1,yh)]:
+            Vals                   = C[:,Comp]+C[:,2]*Coord[Rows]
+            self.RTOperators[Name] = coo_matrix((Vals,(Rows,Mesh.FlatEdges[Cols])),shape=Shape).tocsr()
+
+    def PiRT(self,B):
+        #Pi_RT B at the corners and edge midpoints of every element, ordered as Mesh.FlatStart.
+        #The values of element c are in the slice Mesh.ElementPtr[c]:Mesh.ElementPtr[c+1].
+        #B may be a (k,NumEdges) array, the values are then (k,NumFlat).
+        Op = self.RTOperators
+        return tuple(ApplyOperator(Op[Name],B) for Name in ('nx','ny','mx','my'))
+
+    def FlatMidValues(self,El):
+        #The average of the nodal array El on every local edge, ordered as Mesh.FlatStart
+        return 0.5*(El[...,self.Mesh.FlatStart]+El[...,self.Mesh.FlatEnd])
+
     def PiRTBn(self,LocB,ElementNum):
         #The DOF
-        Element = self.Mesh.ElementEdges[ElementNum]
-        N       = len(Element)
-        V,E     = self.Mesh.StandardElement(Element,self.Mesh.Orientations[ElementNum])
-        BB      = self.PiRTBB(LocB,Element,ElementNum,E)
-        coeffs  = self.RTKIList[ElementNum].dot(BB)
-        PiRTBx  = np.zeros((N),dtype=float)
-        PiRTBy  = np.zeros((N),dtype=float)
-
-        for i in range(N):
-            Edge = E[i]
-            Node = self.Mesh.Nodes[Edge[0]]
-            x,y  = Node[0],Node[1]
-            PiRTBx[i] = coeffs[0]+coeffs[2]*x 
-            PiRTBy[i] = coeffs[1]+coeffs[2]*y
-        
-        return PiRTBx,PiRTBy
+        Loc    = slice(self.Mesh.ElementPtr[ElementNum],self.Mesh.ElementPtr[ElementNum+1])
+        coeffs = np.asarray(LocB,dtype=float).dot(self.RTCoeffs[Loc])
+        X      = self.Mesh.NodeArray[self.Mesh.FlatStart[Loc]]
+        return coeffs[0]+coeffs[2]*X[:,0],coeffs[1]+coeffs[2]*X[:,1]
 
     def PiRTBnm(self,LocB,El,ElementNum):
         #The DOF
-        Element = self.Mesh.ElementEdges[ElementNum]
-        N       = len(Element)
-        V,E     = self.Mesh.StandardElement(Element,self.Mesh.Orientations[ElementNum])
-        BB      = self.PiRTBB(LocB,Element,ElementNum,E)
-        coeffs  = self.RTKIList[ElementNum].dot(BB)
-        PiRTBnx  = np.zeros((N),dtype=float)
-        PiRTBny  = np.zeros((N),dtype=float)
-        PiRTBmx  = np.zeros((N),dtype=float)
-        PiRTBmy  = np.zeros((N),dtype=float)
-        Em       = np.zeros((N),dtype=float)
-        for i in range(N):
-            Edge = E[i]
-            n1,n2 = Edge[0],Edge[1]
-            Node1 = self.Mesh.Nodes[n1]
-            Node2 = self.Mesh.Nodes[n2]
-            x1,y1  = Node1[0],Node1[1]
-            x2,y2  = Node2[0],Node2[1]
-            PiRTBnx[i] = coeffs[0]+coeffs[2]*x1 
-            PiRTBny[i] = coeffs[1]+coeffs[2]*y1
-            PiRTBmx[i] = coeffs[0]+coeffs[2]*0.5*(x1+x2)
-            PiRTBmy[i] = coeffs[1]+coeffs[2]*0.5*(y1+y2)
-            Em[i]      = 0.5*(El[n1]+El[n2])
-        return PiRTBnx,PiRTBny,PiRTBmx,PiRTBmy,Em
+        Loc      = slice(self.Mesh.ElementPtr[ElementNum],self.Mesh.ElementPtr[ElementNum+1])
+        coeffs   = np.asarray(LocB,dtype=float).dot(self.RTCoeffs[Loc])
+        X1       = self.Mesh.NodeArray[self.Mesh.FlatStart[Loc]]
+        Xh       = 0.5*(X1+self.Mesh.NodeArray[self.Mesh.FlatEnd[Loc]])
+        Em       = 0.5*(El[self.Mesh.FlatStart[Loc]]+El[self.Mesh.FlatEnd[Loc]])
+        return coeffs[0]+coeffs[2]*X1[:,0],coeffs[1]+coeffs[2]*X1[:,1],\
+               coeffs[0]+coeffs[2]*Xh[:,0],coeffs[1]+coeffs[2]*Xh[:,1],Em
 
     ######################################################################################
     #Fluid Flow
@@ -2025,12 +1763,7 @@ class PDEFullMHD(object):
         return ph*qh/A
     
     def PhL2Norm(self,ph):
-        Norm, j = 0,0
-        for Element in self.Mesh.ElementEdges:
-            A,V,E = self.Mesh.Area(Element,self.Mesh.Orientations[j])
-            Norm  = Norm+ph[j]*ph[j]/A
-            j = j+1
-        return math.sqrt(Norm)
+        return self.Norm('Ph',ph)
     
     def DIVu(self,ElementNumber,unx,uny,umx,umy):
         #This routine computes the divergence of u over the element provided.
@@ -2050,6 +1783,23 @@ class PDEFullMHD(object):
             k = k+1
         return S/(6*A),A     
     
+    #Element kernels over all the elements at once, see Kernels.py for the available backends.
+    def CellDivergence(self,unx,uny,umx,umy):
+        #DIVu of the global TVh field u on every element
+        M = self.Mesh
+        return Kernels.Kernel('DivU')(M.ElementPtr,M.FlatStart,M.FlatEnd,M.FlatEdges,M.NodeArray,M.Areas,unx,uny,umx,umy)
+
+    def TVhColumns(self,unx,uny,umx,umy):
+        #TVhSemiInProdColumn of the global TVh field u on every element, a (NumElements,12) array
+        M = self.Mesh
+        return Kernels.Kernel('TVhColumns')(M.ElementPtr,M.FlatStart,M.FlatEnd,M.FlatEdges,M.NodeArray,\
+                                            M.Centroids,M.Areas,unx,uny,umx,umy)
+
+    def RTMoments(self,B):
+        #PiRTBB of the global edge dofs B on every element, a (NumElements,3) array
+        M = self.Mesh
+        return Kernels.Kernel('RTMoments')(M.ElementPtr,M.FlatStart,M.FlatEnd,M.FlatEdges,M.FlatOri,M.NodeArray,np.asarray(B,dtype=float))
+
     def L(self,x0,y0,x1,y1,x2,y2,x,y):
         # D = (x1-x0)*(y2-y0)-(x2-x0)*(y1-y0)
         # xtemp = x-x0
@@ -2262,6 +2012,104 @@ class PDEFullMHD(object):
             j= j+1 
         return H,np.linalg.inv(G),D,K,np.linalg.inv(RTK) 
         
+    def TVhSubTriangles(self):
+        #The triangles used to integrate over the elements as (P,X1,X2,Jac,Owner).
+        #As in TVhInnerPreCompute a general polygon is split in the triangles (centroid, edge).
+        #Triangles are integrated directly and quads are split in two triangles by a diagonal,
+        #Jac is then signed so that the split is also exact for non-convex quads.
+        Mesh   = self.Mesh
+        X      = Mesh.NodeArray
+        Sizes  = np.diff(Mesh.ElementPtr)
+        Fast   = np.isin(Sizes,self.FastElementSizes)
+        Flat   = np.nonzero(~Fast[Mesh.FlatElement])[0]
+        Owner  = [Mesh.FlatElement[Flat]]
+        P, X1  = [Mesh.Centroids[Owner[0]]], [X[Mesh.FlatStart[Flat]]]
+        X2     = [X[Mesh.FlatEnd[Flat]]]
+        Cross  = lambda a,b: a[:,0]*b[:,1]-a[:,1]*b[:,0]
+        Jac    = [np.abs(Cross(X1[0]-P[0],X2[0]-P[0]))]
+        for Num in np.unique(Sizes[Fast]):
+            Cells = np.nonzero(Sizes == Num)[0]
+            V     = X[Mesh.FlatStart[Mesh.ElementPtr[Cells][:,None]+np.arange(Num)]]
+            for k in range(1,Num-1):
+                Owner.append(Cells)
+                P.append(V[:,0])
+                X1.append(V[:,k])
+                X2.append(V[:,k+1])
+                Jac.append(Cross(V[:,k]-V[:,0],V[:,k+1]-V[:,0]))
+        return tuple(np.concatenate(List) for List in (P,X1,X2,Jac,Owner))
+
+    def TVhMoments(self):
+        #Mom[c,p,q] is the integral of x^p y^q over element c, p+q<=4, summed over the triangles of
+        #TVhSubTriangles. Degree 2 moments use the midpoint rule and degree 3 and 4 moments the
+        #6 point rule given by xs, ys, ws, both exact.
+        Mesh   = self.Mesh
+        NEl    = len(Mesh.ElementEdges)
+        A      = Mesh.Areas
+        P,X1,X2,Jac,Owner = self.TVhSubTriangles()
+        xP,yP  = P[:,0],P[:,1]
+        x1,y1  = X1[:,0],X1[:,1]
+        x2,y2  = X2[:,0],X2[:,1]
+        Mid    = [((x1+x2)/2,(y1+y2)/2),((x1+xP)/2,(y1+yP)/2),((x2+xP)/2,(y2+yP)/2)]
+        xs,ys  = np.array(self.xs),np.array(self.ys)
+        lx     = (x1-xP)[:,None]*xs+(x2-xP)[:,None]*ys+xP[:,None]
+        ly     = (y1-yP)[:,None]*xs+(y2-yP)[:,None]*ys+yP[:,None]
+        Jw     = Jac[:,None]*np.array(self.ws)
+        Mom    = np.zeros((NEl,5,5),dtype=float)
+        Mom[:,0,0] = A
+        Mom[:,1,0] = Mesh.Centroids[:,0]*A
+        Mom[:,0,1] = Mesh.Centroids[:,1]*A
+        for p,q in [(2,0),(1,1),(0,2)]:
+            Mom[:,p,q] = np.bincount(Owner,weights=(Jac/6)*sum(xh**p*yh**q for xh,yh in Mid),minlength=NEl)
+        for p,q in [(3,0),(2,1),(1,2),(0,3),(4,0),(3,1),(2,2),(1,3),(0,4)]:
+            Mom[:,p,q] = np.bincount(Owner,weights=np.sum(Jw*lx**p*ly**q,axis=1),minlength=NEl)
+        return Mom
+
+    def TVhInnerPreComputeAll(self):
+        #Batched TVhInnerPreCompute. The basis q0,...,q11 is (m,0),(0,m) for the monomials
+        #m = 1,x,y,x^2,y^2,xy, so K is the monomial mass matrix and H the monomial stiffness
+        #matrix, each repeated for both components. G and RTK are inverted for all elements at once.
+        #Returns arrays of shape (NumElements,...) except for D, a list since its size depends on the element.
+        Mesh   = self.Mesh
+        NEl    = len(Mesh.ElementEdges)
+        Mom    = self.TVhMoments()
+        px     = np.array([0,1,0,2,0,1])
+        py     = np.array([0,0,1,0,2,1])
+        MM     = Mom[:,px[:,None]+px[None,:],py[:,None]+py[None,:]]
+        Dx     = np.zeros((6,6))
+        Dy     = np.zeros((6,6))
+        Dx[1,0], Dx[3,1], Dx[5,2] = 1,2,1 #d/dx of x, x^2, xy
+        Dy[2,0], Dy[4,2], Dy[5,1] = 1,2,1 #d/dy of y, y^2, xy
+        SS     = np.einsum('ac,ecd,bd->eab',Dx,MM,Dx)+np.einsum('ac,ecd,bd->eab',Dy,MM,Dy)
+        H      = np.zeros((NEl,12,12),dtype=float)
+        K      = np.zeros((NEl,12,12),dtype=float)
+        H[:,0::2,0::2], H[:,1::2,1::2] = SS, SS
+        K[:,0::2,0::2], K[:,1::2,1::2] = MM, MM
+        RTK    = np.zeros((NEl,3,3),dtype=float)
+        RTK[:,0,0], RTK[:,1,1]               = Mom[:,0,0],Mom[:,0,0]
+        RTK[:,0,2], RTK[:,2,0]               = Mom[:,1,0],Mom[:,1,0]
+        RTK[:,1,2], RTK[:,2,1]               = Mom[:,0,1],Mom[:,0,1]
+        RTK[:,2,2]                           = Mom[:,2,0]+Mom[:,0,2]
+        #Values of the monomials at the vertices and edge midpoints, ordered as Mesh.FlatStart
+        X      = Mesh.NodeArray
+        XV, XM = X[Mesh.FlatStart], 0.5*(X[Mesh.FlatStart]+X[Mesh.FlatEnd])
+        MV     = XV[:,0,None]**px*XV[:,1,None]**py
+        MMid   = XM[:,0,None]**px*XM[:,1,None]**py
+        G      = H.copy()
+        Sums   = np.zeros((NEl,6),dtype=float)
+        np.add.at(Sums,Mesh.FlatElement,MV+MMid)
+        G[:,0,0::2], G[:,1,1::2] = Sums, Sums
+        D      = [None]*NEl
+        Sizes  = np.diff(Mesh.ElementPtr)
+        for Num in np.unique(Sizes):
+            Cells = np.nonzero(Sizes == Num)[0]
+            Index = Mesh.ElementPtr[Cells][:,None]+np.arange(Num)
+            DN    = np.zeros((len(Cells),4*Num,12),dtype=float)
+            DN[:,0:Num,0::2],       DN[:,Num:2*Num,1::2]   = MV[Index],  MV[Index]
+            DN[:,2*Num:3*Num,0::2], DN[:,3*Num:4*Num,1::2] = MMid[Index],MMid[Index]
+            for k in range(len(Cells)):
+                D[Cells[k]] = DN[k]
+        return H,np.linalg.inv(G),D,K,np.linalg.inv(RTK)
+
     def TVhSemiInProdColumn(self,Element,ElementNumber,unx,uny,umx,umy,xP,yP,A,E):
         #This function will create a column vector, the first two entries 
         #in this vector will be the sum of the x coordinates and y coordinates
@@ -2369,18 +2217,10 @@ class PDEFullMHD(object):
         return lunx,luny,lumx,lumy
 
     def TVhL2Norm(self,unx,uny,umx,umy):
-        Norm = 0
-        for i in range(len(self.Mesh.ElementEdges)):
-            lunx,luny,lumx,lumy = self.GetLocalTVhDOF(i,unx,uny,umx,umy)
-            Norm = Norm+self.TVhInProd(i,lunx,luny,lumx,lumy,lunx,luny,lumx,lumy)
-        return math.sqrt(Norm)
+        return self.Norm('TVh',self.TVhVector(unx,uny,umx,umy))
 
     def TVhH1Norm(self,unx,uny,umx,umy):
-        Norm = 0
-        for i in range(len(self.Mesh.ElementEdges)):
-            lunx,luny,lumx,lumy = self.GetLocalTVhDOF(i,unx,uny,umx,umy)
-            Norm = Norm+self.TVhSemiInProd(i,lunx,luny,lumx,lumy,lunx,luny,lumx,lumy)
-        return math.sqrt(Norm) 
+        return self.Norm('TVhH1',self.TVhVector(unx,uny,umx,umy))
 
     def Cross2Dto1D(self,Ax,Ay,Bx,By):
         #This routine takes the evalution of two vector valued functions over the nodes of a cell
@@ -2388,4 +2228,176 @@ class PDEFullMHD(object):
         return Ax*By-Ay*Bx
     
     def Cross1Dto2D(self,J,Bx,By):
-        return -J*By,J*Bx
\ No newline at end of file
+        return -J*By,J*Bx
+
+    ##########################################################################################
+    ##########################################################################################
+    #Global mass matrices. Any norm or energy is then sqrt(x.Mx).
+    def TVhVector(self,unx,uny,umx,umy):
+        #The global vector of a field in TVh is (unx,uny,umx,umy).
+        return np.concatenate((unx,uny,umx,umy),axis=None)
+
+    def LocalTVhIndices(self,ElementNumber):
+        #Positions in the global TVh vector of the local dofs, in the order of GetLocalTVhDOF.
+        nN, nE = len(self.Mesh.Nodes), len(self.Mesh.EdgeNodes)
+        Element = np.asarray(self.Mesh.ElementEdges[ElementNumber],dtype=int)
+        V,E     = self.Mesh.StandardElement(self.Mesh.ElementEdges[ElementNumber],self.Mesh.Orientations[ElementNumber])
+        Starts  = np.array([Edge[0] for Edge in E[0:len(Element)]],dtype=int)
+        return np.concatenate((Starts,nN+Starts,2*nN+Element,2*nN+nE+Element))
+
+    def LocalTVhMatrices(self,ElementNumber):
+        #Returns the local matrices of TVhInProd and TVhSemiInProd. Both forms are bilinear so
+        #their matrices are found by evaluating them on the local basis.
+        N  = len(self.Mesh.ElementEdges[ElementNumber])
+        I  = np.identity(4*N)
+        Element     = self.Mesh.ElementEdges[ElementNumber]
+        xP,yP,A,V,E = self.Mesh.Centroid(Element,self.Mesh.Orientations[ElementNumber])
+        C  = np.zeros((12,4*N))
+        for j in range(4*N):
+            C[:,j] = self.TVhSemiInProdColumn(Element,ElementNumber,I[0:N,j],I[N:2*N,j],I[2*N:3*N,j],I[3*N:4*N,j],xP,yP,A,E)
+        P  = self.GISTVList[ElementNumber].dot(C)
+        R  = I-self.DTVList[ElementNumber].dot(P)
+        S  = A*np.transpose(R).dot(R)
+        ML2 = np.transpose(P).dot(self.KTVList[ElementNumber].dot(P))+S
+        MH1 = np.transpose(P).dot(self.HSTVList[ElementNumber].dot(P))+S
+        return ML2,MH1
+
+    def TVhLocalIndexing(self):
+        #The local TVh dofs of all the elements one after the other, those of element c (4N of them,
+        #in the order of LocalTVhIndices) from 4*Mesh.ElementPtr[c]. Returns for each of them its
+        #position in the global TVh vector and in the flat vector (nx,ny,mx,my) of local values,
+        #each component ordered as Mesh.FlatStart.
+        Mesh   = self.Mesh
+        Ptr    = Mesh.ElementPtr
+        nN, nE = len(Mesh.Nodes), len(Mesh.EdgeNodes)
+        Sizes  = np.diff(Ptr)
+        Owner  = np.repeat(np.arange(len(Sizes)),4*Sizes)
+        Pos    = np.arange(len(Owner))-4*Ptr[Owner]
+        Comp   = Pos//Sizes[Owner]
+        Flat   = Ptr[Owner]+Pos%Sizes[Owner]
+        Start, Edges = Mesh.FlatStart[Flat], Mesh.FlatEdges[Flat]
+        Global = np.choose(Comp,(Start,nN+Start,2*nN+Edges,2*nN+nE+Edges))
+        return Global, Comp*Ptr[-1]+Flat
+
+    def LocalCopies(self):
+        #A numbering where every element has its own copy of its corners and edges: the local edge
+        #f (ordered as Mesh.FlatStart) is the edge f, it goes from node f to node NumFlat+f, with
+        #coordinates X. Pos is the local position of f in its element and Next that of the
+        #following corner. A field that is 1 on the local dof j of every element is then a single
+        #array, so the element kernels of Kernels.py act on the local basis of all the elements.
+        Mesh  = self.Mesh
+        Ptr   = Mesh.ElementPtr
+        Sizes = np.diff(Ptr)[Mesh.FlatElement]
+        Pos   = np.arange(Ptr[-1])-Ptr[Mesh.FlatElement]
+        X     = np.concatenate((Mesh.NodeArray[Mesh.FlatStart],Mesh.NodeArray[Mesh.FlatEnd]))
+        return np.arange(Ptr[-1]),X,Pos,(Pos+1)%Sizes
+
+    def TVhLocalBlocks(self):
+        #The matrices of LocalTVhMatrices of all the elements, raveled one after the other. The
+        #TVhSemiInProdColumn of every local basis function comes from the TVhColumns kernel on
+        #LocalCopies, the products are then done for all the elements of each size at once.
+        if self.TVhBlocks is not None:
+            return self.TVhBlocks
+        Mesh    = self.Mesh
+        Ptr     = Mesh.ElementPtr
+        NumF    = Ptr[-1]
+        Sizes   = np.diff(Ptr)
+        Copy,X,Pos,Next = self.LocalCopies()
+        Columns = Kernels.Kernel('TVhColumns')
+        Zero    = np.zeros(NumF)
+        Col     = np.zeros((4,np.max(Sizes),len(Sizes),12))
+        for i in range(np.max(Sizes)):
+            Node, Mid = np.concatenate((Pos == i,Next == i)).astype(float), (Pos == i).astype(float)
+            NodeZero  = np.zeros(2*NumF)
+            for Comp, Field in enumerate([(Node,NodeZero,Zero,Zero),(NodeZero,Node,Zero,Zero),\
+                                          (NodeZero,NodeZero,Mid,Zero),(NodeZero,NodeZero,Zero,Mid)]):
+                Col[Comp,i] = Columns(Ptr,Copy,NumF+Copy,Copy,X,Mesh.Centroids,Mesh.Areas,*Field)
+        BlockPtr = np.concatenate(([0],np.cumsum(16*Sizes**2)))
+        Blocks   = (np.zeros(BlockPtr[-1]),np.zeros(BlockPtr[-1]))
+        GI, K, H = np.asarray(self.GISTVList), np.asarray(self.KTVList), np.asarray(self.HSTVList)
+        for Num in np.unique(Sizes):
+            Cells = np.nonzero(Sizes == Num)[0]
+            C     = np.transpose(Col[:,0:Num][:,:,Cells],(2,3,0,1)).reshape(len(Cells),12,4*Num)
+            D     = np.array([self.DTVList[c] for c in Cells])
+            P     = GI[Cells]@C
+            R     = np.identity(4*Num)-D@P
+            S     = Mesh.Areas[Cells][:,None,None]*np.transpose(R,(0,2,1))@R
+            Index = BlockPtr[Cells][:,None]+np.arange(16*Num**2)
+            for Out, Inner in zip(Blocks,(K,H)):
+                Out[Index] = (np.transpose(P,(0,2,1))@Inner[Cells]@P+S).reshape(len(Cells),-1)
+        self.TVhBlocks = Blocks
+        return Blocks
+
+    def MassMatrix(self,Space):
+        #Returns the global mass matrix, as a csr matrix, of one of the spaces:
+        #'Vh' nodal, 'Eh' edges, 'Ph' cellwise, 'TVh' velocity and 'TVhH1' the semi-inner product of TVh.
+        #The matrices are assembled once from the local matrices and cached.
+        if Space in self.MassMatrices:
+            return self.MassMatrices[Space]
+        Mesh = self.Mesh
+        if not hasattr(Mesh,'Areas'):
+            Mesh.MakeGeometry()
+        NEl  = len(Mesh.ElementEdges)
+        if Space == 'Ph':
+            M = coo_matrix((1/Mesh.Areas,(np.arange(NEl),np.arange(NEl))),shape=(NEl,NEl)).tocsr()
+        elif Space == 'Vh' or Space == 'Eh':
+            if Space == 'Vh':
+                Locals, Flat, n = self.MVList, Mesh.FlatStart, len(Mesh.Nodes)
+            else:
+                Locals, Flat, n = self.MEList, Mesh.FlatEdges, len(Mesh.EdgeNodes)
+            Blocks           = np.concatenate([np.ravel(Local) for Local in Locals])
+            rows, cols, vals = Kernels.Kernel('LocalTriplets')(Mesh.ElementPtr,Flat,Blocks)
+            M = coo_matrix((vals,(rows,cols)),shape=(n,n)).tocsr()
+        elif Space == 'TVh' or Space == 'TVhH1':
+            n      = 2*len(Mesh.Nodes)+2*len(Mesh.EdgeNodes)
+            Global = self.TVhLocalIndexing()[0]
+            for Name, Blocks in zip(('TVh','TVhH1'),self.TVhLocalBlocks()):
+                rows, cols, vals         = Kernels.Kernel('LocalTriplets')(4*Mesh.ElementPtr,Global,Blocks)
+                self.MassMatrices[Name]  = coo_matrix((vals,(rows,cols)),shape=(n,n)).tocsr()
+            return self.MassMatrices[Space]
+        else:
+            raise ValueError('Unknown space '+str(Space))
+        self.MassMatrices[Space] = M
+        return M
+
+    def AmpereOhmMatrix(self):
+        #Jacobian of the Ampere-Ohm rows of ElectroG (and MHDG) with respect to E once B has been
+        #eliminated with Faraday's law, B = B^n-dt*Curl E: MV+(theta*dt/Rm)Curl^T ME Curl,
+        #restricted to the internal nodes. Symmetric positive definite.
+        Int = self.Mesh.NumInternalNodes
+        A   = self.MassMatrix('Vh')+(self.theta*self.dt/self.Rm)*(self.MRotCSC.T@self.MassMatrix('Eh')@self.MRotCSC)
+        return A.tocsr()[Int][:,Int]
+
+    def VelocityMatrix(self):
+        #Velocity block of the momentum equation, (1/dt)M+(theta/Re)S with M and S the TVh mass
+        #matrix and semi-inner product, restricted to the internal velocity dofs in the order of
+        #FlowLayout (unx,uny at the internal nodes, umx,umy at the internal midnodes).
+        nN, nE = len(self.Mesh.Nodes), len(self.Mesh.EdgeNodes)
+        IntN   = np.asarray(self.Mesh.NumInternalNodes,dtype=int)
+        IntM   = np.asarray(self.Mesh.NumInternalMidNodes,dtype=int)
+        Int    = np.concatenate((IntN,nN+IntN,2*nN+IntM,2*nN+nE+IntM))
+        A      = (1/self.dt)*self.MassMatrix('TVh')+(self.theta/self.Re)*self.MassMatrix('TVhH1')
+        return A.tocsr()[Int][:,Int]
+
+    def Norm(self,Space,X):
+        #Norm induced by the mass matrix of Space. X can be a single vector or a 2-D array whose rows
+        #are vectors (e.g. a time series), in which case an array with the norm of every row is returned.
+        M = self.MassMatrix(Space)
+        X = np.asarray(X,dtype=float)
+        if X.ndim == 1:
+            return math.sqrt(max(X.dot(M.dot(X)),0))
+        return np.sqrt(np.maximum(np.sum(X*np.transpose(M.dot(np.transpose(X))),axis=1),0))
+
+    def ErrorNorms(self,Fields):
+        #Fields is a dictionary, each entry is (Space,Approx,Exact) where Approx and Exact are
+        #vectors or 2-D arrays of vectors (a time series). It returns a dictionary with the norm of
+        #Approx-Exact for every entry, as needed for the convergence tables.
+        #Exact may be None, in which case the norm of Approx is returned.
+        Norms = {}
+        for Name in Fields:
+            Space,Approx,Exact = Fields[Name]
+            Err = np.asarray(Approx,dtype=float)
+            if Exact is not None:
+                Err = Err-np.asarray(Exact,dtype=float)
+            Norms[Name] = self.Norm(Space,Err)
+        return Norms
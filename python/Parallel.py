@@ -0,0 +1,180 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing import connection
+
+def RCBPartition(Points,NumParts):
+    #Recursive coordinate bisection: the points are split across the direction of largest extent,
+    #the two halves getting a number of points proportional to the number of parts they will be
+    #split in, until there are NumParts parts. Returns the part of every point.
+    Points = np.asarray(Points,dtype=float)
+    Part   = np.zeros(len(Points),dtype=int)
+    def Bisect(Index,NumParts,First):
+        if NumParts == 1 or len(Index) == 0:
+            Part[Index] = First
+            return
+        Axis  = np.argmax(np.ptp(Points[Index],axis=0))
+        Order = Index[np.argsort(Points[Index,Axis],kind='stable')]
+        Left  = NumParts//2
+        Cut   = int(round(len(Index)*Left/NumParts))
+        Bisect(Order[0:Cut],Left,First)
+        Bisect(Order[Cut:],NumParts-Left,First+Left)
+    Bisect(np.arange(len(Points)),NumParts,0)
+    return Part
+
+class Subdomain:
+    #Elements of one part of the mesh, together with the rows of the residual it owns: the internal
+    #nodes NumInternalNodes[k], k in NodeRows, and midnodes NumInternalMidNodes[k], k in MidRows.
+    #A node or midnode is owned by the part of its first neighbouring element. Halo are the
+    #elements of other parts that are needed to evaluate the owned rows.
+    def __init__(self,Elements,Halo,NodeRows,MidRows):
+        self.Elements, self.Halo      = Elements, Halo
+        self.NodeRows, self.MidRows   = NodeRows, MidRows
+
+def Decompose(Mesh,NumParts):
+    #Splits Mesh in NumParts subdomains by RCB on the element centroids
+    if not hasattr(Mesh,'Areas'):
+        Mesh.MakeGeometry()
+    Part     = RCBPartition(Mesh.Centroids,NumParts)
+    NodePart = np.array([Part[min(Mesh.NodestoCells[i])] for i in Mesh.NumInternalNodes],dtype=int)
+    MidPart  = np.array([Part[min(Mesh.EdgestoCells[i])] for i in Mesh.NumInternalMidNodes],dtype=int)
+    Subdomains = []
+    for k in range(NumParts):
+        NodeRows, MidRows = np.nonzero(NodePart == k)[0], np.nonzero(MidPart == k)[0]
+        Needed = set()
+        for r in NodeRows:
+            Needed.update(Mesh.NodestoCells[Mesh.NumInternalNodes[r]])
+        for r in MidRows:
+            Needed.update(Mesh.EdgestoCells[Mesh.NumInternalMidNodes[r]])
+        Elements = np.nonzero(Part == k)[0]
+        Halo     = np.array(sorted(Needed.difference(Elements.tolist())),dtype=int)
+        Subdomains.append(Subdomain(Elements,Halo,NodeRows,MidRows))
+    return Subdomains
+
+class ParallelResidual:
+    #Evaluates MHDG with one persistent process per subdomain. This process prepares the fields
+    #of the trial state once (MHDPrepare: the theta fields, Pi_RT Btheta, ...) and broadcasts them
+    #through shared memory, every worker adds the momentum rows of its subdomain to a shared
+    #residual, acting only on the corners of its Elements and Halo, while this process computes
+    #the Faraday, Ampere-Ohm and continuity rows.
+    #Each worker is driven through its own pipe: it gets True to evaluate (False to stop) and
+    #answers whether it succeeded. The answers are awaited together with the sentinels of the
+    #workers, so a worker that dies is noticed at once, without timeouts, and all the workers are
+    #then restarted. The workers are forked copies of PDE, which is also what makes the operators
+    #available to them without pickling.
+    def __init__(self,PDE,NumWorkers):
+        self.Context    = mp.get_context('fork')
+        self.PDE        = PDE
+        self.Subdomains = Decompose(PDE.Mesh,NumWorkers)
+        NumDOF          = PDE.SetNumMHDDof()
+        PDE.ResidualOperators() #Built once, before forking
+        #Input holds the fields returned by MHDPrepare, in its order
+        S               = PDE.MHDLayout.Sizes
+        Sizes           = list(S[0:4])*2+[S[4],S[4],S[5],S[6]]+[PDE.Mesh.ElementPtr[-1]]*5
+        Offsets         = np.concatenate(([0],np.cumsum(Sizes))).astype(int)
+        self.InputMemory  = shared_memory.SharedMemory(create=True,size=8*int(Offsets[-1]))
+        self.OutputMemory = shared_memory.SharedMemory(create=True,size=8*NumDOF)
+        Input             = np.ndarray(Offsets[-1],dtype=float,buffer=self.InputMemory.buf)
+        self.Fields       = tuple(Input[Offsets[k]:Offsets[k+1]] for k in range(len(Sizes)))
+        self.y            = np.ndarray(NumDOF,dtype=float,buffer=self.OutputMemory.buf)
+        self.Workers, self.Pipes = [], []
+        self.StartWorkers()
+
+    def StartWorkers(self):
+        for Sub in self.Subdomains:
+            Pipe, WorkerPipe = self.Context.Pipe()
+            self.Pipes.append(Pipe)
+            Worker = self.Context.Process(target=self.Serve,args=(Sub,WorkerPipe),daemon=True)
+            Worker.start()
+            WorkerPipe.close()
+            self.Workers.append(Worker)
+
+    def StopWorkers(self):
+        for Worker, Pipe in zip(self.Workers,self.Pipes):
+            try:
+                Pipe.send(False)
+            except OSError:
+                pass #The worker is dead
+        for Worker, Pipe in zip(self.Workers,self.Pipes):
+            Worker.join(1)
+            if Worker.is_alive():
+                Worker.terminate()
+                Worker.join()
+            Pipe.close()
+        self.Workers, self.Pipes = [], []
+
+    def Serve(self,Sub,Pipe):
+        #The ends of the pipes kept by this process are closed, so a worker sees the end of its
+        #pipe if this process dies
+        for Other in self.Pipes:
+            Other.close()
+        PDE = self.PDE
+        PDE.Parallel = None
+        Rows = PDE.MomentumRows(Sub.NodeRows,Sub.MidRows,np.concatenate((Sub.Elements,Sub.Halo)))
+        while True:
+            try:
+                if not Pipe.recv():
+                    break
+            except EOFError:
+                break
+            try:
+                PDE.MHDMomentumRows(self.Fields,self.y,Rows)
+                Pipe.send(True)
+            except Exception:
+                Pipe.send(False)
+
+    def Collect(self):
+        #Waits for the answer of every worker. Returns False if one of them failed and raises a
+        #RuntimeError, after restarting the workers, if one of them died.
+        Pending = dict(zip(self.Pipes,self.Workers))
+        Success, Dead = True, False
+        while Pending:
+            Ready = connection.wait(list(Pending)+[Worker.sentinel for Worker in Pending.values()])
+            for Pipe, Worker in list(Pending.items()):
+                if Pipe in Ready or Worker.sentinel in Ready:
+                    del Pending[Pipe]
+                    try:
+                        Success = Pipe.recv() and Success
+                    except EOFError:
+                        Dead = True
+        if Dead:
+            self.Restart()
+            raise RuntimeError('A worker died while evaluating its residual rows, the workers were restarted')
+        return Success
+
+    def Restart(self):
+        self.StopWorkers()
+        self.StartWorkers()
+
+    def Evaluate(self,x,Out=None):
+        PDE = self.PDE
+        if not all(Worker.is_alive() for Worker in self.Workers):
+            self.Restart()
+        F   = PDE.MHDPrepare(x)
+        for Shared, Field in zip(self.Fields,F):
+            Shared[:] = Field
+        self.y.fill(0)
+        if PDE.MHDPerm is None:
+            y = PDE.ResidualVector(x,Out)
+        else:
+            y = PDE.Work.Zeros('MHDy',len(x))
+        for Pipe in self.Pipes:
+            Pipe.send(True)
+        try:
+            PDE.MHDFieldRows(F,y)
+        finally:
+            #The answers are always collected, so the next evaluation starts in step
+            Success = self.Collect()
+        if not Success:
+            raise RuntimeError('A worker failed to evaluate its residual rows')
+        y += self.y
+        return PDE.MHDFromBlocked(y,Out)
+
+    def Close(self):
+        if self.InputMemory is None:
+            return
+        self.StopWorkers()
+        for Memory in (self.InputMemory,self.OutputMemory):
+            Memory.close()
+            Memory.unlink()
+        self.InputMemory, self.OutputMemory = None, None
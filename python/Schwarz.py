@@ -0,0 +1,136 @@
+import numpy as np
+import multiprocessing as mp
+from scipy.sparse import csc_matrix
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import splu
+from scipy.sparse.linalg import LinearOperator
+from scipy import linalg
+from Parallel import Decompose
+
+#Instance whose local solves are run by the process pool, see AdditiveSchwarz.SetWorkers
+ActiveSchwarz = None
+
+def LocalSolve(k,r):
+    return ActiveSchwarz.Factors[k].solve(r)
+
+def GrowPatch(Mesh,Elements,Layers):
+    #Adds Layers layers of neighbouring elements (sharing a node) to Elements
+    Patch = set(np.asarray(Elements,dtype=int).tolist())
+    for Layer in range(Layers):
+        Nodes = np.unique(np.concatenate([Mesh.FlatStart[Mesh.ElementPtr[c]:Mesh.ElementPtr[c+1]] for c in Patch]))
+        for Node in Nodes:
+            Patch.update(Mesh.NodestoCells[Node])
+    return np.array(sorted(Patch),dtype=int)
+
+def LayoutDofs(Mesh,Layout,Elements):
+    #Positions in the vectors of Layout of the unknowns living on the nodes, edges and cells of Elements
+    Flat = np.concatenate([np.arange(Mesh.ElementPtr[c],Mesh.ElementPtr[c+1]) for c in Elements])
+    Dofs = []
+    for k in range(len(Layout.Kinds)):
+        Kind     = Layout.Kinds[k]
+        Entities = {'Node':Mesh.FlatStart[Flat],'AllNode':Mesh.FlatStart[Flat],\
+                    'Mid':Mesh.FlatEdges[Flat],'Edge':Mesh.FlatEdges[Flat],'Cell':np.asarray(Elements)}[Kind]
+        Dof           = -np.ones(Layout.Sizes[k],dtype=int)
+        Dof[Layout.Interior[k]] = Layout.Positions[k]
+        Dof           = Dof[np.unique(Entities)]
+        Dofs.append(Dof[Dof >= 0])
+    return np.unique(np.concatenate(Dofs))
+
+def MeshPatches(Mesh,Layout,NumParts,Overlap=1):
+    #Overlapping patches of unknowns: the RCB subdomains of Decompose grown by Overlap layers of
+    #elements. Also returns the cores, a partition of the unknowns in which every unknown belongs
+    #to the first subdomain (without overlap) touching it.
+    Patches, Owner = [], -np.ones(Layout.NumDOF,dtype=int)
+    for k, Sub in enumerate(Decompose(Mesh,NumParts)):
+        Patches.append(LayoutDofs(Mesh,Layout,GrowPatch(Mesh,Sub.Elements,Overlap)))
+        Core        = LayoutDofs(Mesh,Layout,Sub.Elements)
+        Core        = Core[Owner[Core] < 0]
+        Owner[Core] = k
+    return Patches,[np.nonzero(Owner == k)[0] for k in range(NumParts)]
+
+def ConstantModes(Layout,Cores):
+    #Coarse space with, for every core and every field, the indicator of the unknowns of the field
+    #in the core: piecewise constant velocities, fields and the subdomain averages of p.
+    Field = np.zeros(Layout.NumDOF,dtype=int)
+    for k in range(len(Layout.Kinds)):
+        Field[Layout.Positions[k]] = k
+    rows, cols = [], []
+    for Core in Cores:
+        for k in range(len(Layout.Kinds)):
+            Dofs = Core[Field[Core] == k]
+            if len(Dofs) > 0:
+                rows.append(Dofs)
+                cols.append(np.full(len(Dofs),len(cols)))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return coo_matrix((np.ones(len(rows)),(rows,cols)),shape=(Layout.NumDOF,cols[-1]+1)).tocsc()
+
+class AdditiveSchwarz:
+    #Additive Schwarz preconditioner for the matrix A (dense or sparse):
+    #M^-1 r = sum_i R_i^T A_i^-1 R_i r (+ R_0 A_0^-1 R_0^T r if Coarse is given)
+    #where R_i restricts to the unknowns of patch i, A_i = R_i A R_i^T and A_0 = R_0^T A R_0 for
+    #the columns R_0 of Coarse. The local matrices are factorized once. The local solves can be
+    #run on a pool of Workers processes.
+    def __init__(self,A,Patches,Coarse=None,Workers=1):
+        A            = csc_matrix(A)
+        self.shape   = A.shape
+        self.Patches = [np.asarray(Patch,dtype=int) for Patch in Patches]
+        self.Factors = [splu(A[Patch][:,Patch].tocsc()) for Patch in self.Patches]
+        self.Coarse, self.CoarseLU = Coarse, None
+        if Coarse is not None:
+            self.CoarseLU = linalg.lu_factor((Coarse.T@(A@Coarse)).toarray())
+        self.Pool = None
+        self.SetWorkers(Workers)
+
+    def SetWorkers(self,Workers):
+        #The pool is forked after the factorizations, the workers find them in ActiveSchwarz
+        global ActiveSchwarz
+        self.Close()
+        if Workers > 1:
+            ActiveSchwarz = self
+            self.Pool     = mp.get_context('fork').Pool(Workers)
+
+    def Apply(self,r):
+        r = np.asarray(r,dtype=float).ravel()
+        z = np.zeros(len(r),dtype=float)
+        if self.Pool is None:
+            Local = [Factor.solve(r[Patch]) for Factor,Patch in zip(self.Factors,self.Patches)]
+        else:
+            Local = self.Pool.starmap(LocalSolve,[(k,r[Patch]) for k,Patch in enumerate(self.Patches)])
+        for Patch, zk in zip(self.Patches,Local):
+            z[Patch] += zk
+        if self.Coarse is not None:
+            z += self.Coarse@linalg.lu_solve(self.CoarseLU,self.Coarse.T@r)
+        return z
+
+    def Operator(self):
+        #As a LinearOperator, e.g. for the M argument of gmres
+        return LinearOperator(self.shape,matvec=self.Apply)
+
+    def Close(self):
+        if getattr(self,'Pool',None) is not None:
+            self.Pool.terminate()
+        self.Pool = None
+
+    def __del__(self):
+        self.Close()
+
+class SchwarzPreconditioner:
+    #Maps a matrix to its additive Schwarz preconditioner, to be used as
+    #InexactNewtonTimeInt.Preconditioner. The patches (and coarse space) are built once and reused
+    #for every Jacobian. Only the last AdditiveSchwarz is kept, the previous one is closed when a
+    #new one is built and the last one by Close (FlowSolve calls it before returning).
+    def __init__(self,Mesh,Layout,NumParts,Overlap=1,TwoLevel=False,Workers=1):
+        self.Patches, Cores = MeshPatches(Mesh,Layout,NumParts,Overlap)
+        self.Coarse         = ConstantModes(Layout,Cores) if TwoLevel else None
+        self.Workers        = Workers
+        self.Current        = None
+
+    def __call__(self,A):
+        self.Close()
+        self.Current = AdditiveSchwarz(A,self.Patches,self.Coarse,self.Workers)
+        return self.Current.Operator()
+
+    def Close(self):
+        if self.Current is not None:
+            self.Current.Close()
+        self.Current = None
@@ -23,6 +23,12 @@ class InexactNewtonTimeInt(object):
         self.alpha  = 1.5
         self.gamma  = 0.9
         self.epsr   = 1E-4
+        #Number of Jacobian columns computed with one batched residual evaluation
+        self.BatchSize = 64
+        #If set, the Newton systems of FlowSolve are solved with GMRES preconditioned by
+        #Preconditioner(J) (e.g. built by SchwarzPreconditioner in Schwarz.py) instead of LU
+        self.Preconditioner = None
+        self.KrylovTol      = 1E-10
         #self.pool   = mp.Pool(12)
     def J(self,cols):
         ndof = len(cols[0])
@@ -32,11 +38,50 @@ class InexactNewtonTimeInt(object):
         return J
 
     def ithCol(self,G,Gxm,xm,ndof,i):
-        unitnormal = np.zeros(ndof,dtype=float)
-        unitnormal[i] = 1
-        return (G(xm+self.eps*unitnormal)-Gxm)/self.eps
+        return self.Cols(G,Gxm,xm,ndof,[i])[0]
+
+    def Cols(self,G,Gxm,xm,ndof,Indices):
+        #Finite difference approximations of the columns of the Jacobian listed in Indices,
+        #returned as the rows of an array. If G accepts a 2-D array of states (see Batched and
+        #BatchedByLoop in PDEClass) all the perturbed states are evaluated with a single call.
+        X = np.tile(xm,(len(Indices),1))
+        X[np.arange(len(Indices)),Indices] += self.eps
+        if getattr(G,'Batched',False):
+            GX = G(X)
+        else:
+            GX = np.array([G(Xk) for Xk in X])
+        GX -= Gxm
+        GX /= self.eps
+        return GX
+
+    def FDJacobian(self,G,Gxm,xm,ndof):
+        #The dense finite difference Jacobian, computed BatchSize columns at a time
+        J = np.zeros((ndof,ndof),dtype = float)
+        for Start in range(0,ndof,self.BatchSize):
+            Indices      = np.arange(Start,min(Start+self.BatchSize,ndof))
+            J[:,Indices] = self.Cols(G,Gxm,xm,ndof,Indices).T
+        return J
+
+    def LinearSolve(self,J,b,x0=None):
+        if self.Preconditioner is None:
+            return linalg.solve(J,b)
+        x, exitcode = gmres(J,b,x0=x0,M=self.Preconditioner(J),rtol=self.KrylovTol,atol=0)
+        if exitcode != 0:
+            raise RuntimeError('GMRES did not reach the tolerance, exit code '+str(exitcode))
+        return x
+
+    def ClosePreconditioner(self):
+        #Releases the resources (e.g. the process pool of SchwarzPreconditioner) held by the last preconditioner
+        if hasattr(self.Preconditioner,'Close'):
+            self.Preconditioner.Close()
 
     def FlowSolve(self,G,x0,ndof,maxiter,tol):
+        try:
+            return self.FlowIterations(G,x0,ndof,maxiter,tol)
+        finally:
+            self.ClosePreconditioner()
+
+    def FlowIterations(self,G,x0,ndof,maxiter,tol):
         xm     = x0
         delxm = 0.0 * xm
         Gxm    = G(x0)
@@ -46,12 +91,7 @@ class InexactNewtonTimeInt(object):
 
         while nGxm>tol and j<maxiter:
             #print('ngxm='+str(nGxm))
-            Cols   = []
-            for i in range(ndof):
-               col = self.ithCol(G,Gxm,xm,ndof,i)
-               #print(f'norm of{i}-th Node={n2(col)}')
-               Cols.append(col)
-            J    = self.J(Cols)
+            J    = self.FDJacobian(G,Gxm,xm,ndof)
             #for i in range(ndof):
             #    col = J[i,:]
             #    print(f'norm of{i}-th row={n2(col)}')
@@ -64,7 +104,7 @@ class InexactNewtonTimeInt(object):
 
             #delxm = spsolve(J,-Gxm)
 
-            delxm = linalg.solve(J, -Gxm)
+            delxm = self.LinearSolve(J,-Gxm,delxm)
             #def fDGxm(delx):
             #    return (G(xm+self.eps*delx)-Gxm)/(self.eps)
             #DGxm  = LinearOperator((ndof,ndof), matvec = fDGxm)
@@ -108,12 +148,7 @@ class InexactNewtonTimeInt(object):
             etamA = self.gamma*(nGxm/nGxmm1)**(self.alpha)
             etamB = min([self.etamax,max([etamA,self.gamma*etamm1**self.alpha])])
             etam  = min([self.etamax,max([etamB,self.gamma*(epst/nGxm)])])
-            Cols  = []
-            for i in range(ndof):
-               col = self.ithCol(G,Gxm,xm,ndof,i)
-               Cols.append(col)
-            
-            J               = self.J(Cols)
+            J               = self.FDJacobian(G,Gxm,xm,ndof)
             #print(J)
             #print('Number of Newton Iterations='+str(j))
             print('shape='+str(J.shape))
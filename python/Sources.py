@@ -0,0 +1,85 @@
+import numpy as np
+
+#Providers for the source terms and boundary data of PDEFullMHD (f, h, ub, Eb).
+#A plain function of (xv,t) is evaluated at every point every time step. A provider declares how the data
+#depends on time so that the values at a set of points are computed once and cached:
+#SteadyData     the data does not depend on time,
+#SeparableData  the data is g(xv)*s(t), only the scalar s(t) is computed every step,
+#TabulatedData  the data is sampled at the times Times and linearly interpolated in between.
+#The cached arrays are shared, they are marked read only.
+#Providers can still be called as Func(xv,t) or Func([x,y,t]) wherever a plain function is expected.
+class DataProvider(object):
+    def __init__(self):
+        self.Cache = {}
+
+    def __call__(self,xv,t=None):
+        if t is None:
+            xv,t = xv[0:2],xv[2]
+        return self.Eval(xv,t)
+
+    def Cached(self,Evaluate,Func,Points):
+        #The cache is keyed on the point set, which is kept alive so that its id cannot be reused.
+        Key = (id(Points),id(Func))
+        if Key not in self.Cache:
+            Values = np.asarray(Evaluate(Func,Points),dtype=float)
+            Values.flags.writeable = False
+            self.Cache[Key] = (Points,Values)
+        return self.Cache[Key][1]
+
+class SteadyData(DataProvider):
+    def __init__(self,g):
+        DataProvider.__init__(self)
+        self.g = g
+
+    def Eval(self,xv,t):
+        return self.g(xv)
+
+    def DOFs(self,Evaluate,Points,t):
+        return self.Cached(Evaluate,self.g,Points)
+
+class SeparableData(DataProvider):
+    def __init__(self,g,s):
+        DataProvider.__init__(self)
+        self.g, self.s = g, s
+
+    def Eval(self,xv,t):
+        return self.g(xv)*self.s(t)
+
+    def DOFs(self,Evaluate,Points,t):
+        return self.s(t)*self.Cached(Evaluate,self.g,Points)
+
+class TabulatedData(DataProvider):
+    #Func(xv,t) is only evaluated at the times in Times, which must be increasing.
+    #Outside of [Times[0],Times[-1]] the first or last sample is used.
+    def __init__(self,Func,Times):
+        DataProvider.__init__(self)
+        self.Func  = Func
+        self.Times = np.asarray(Times,dtype=float)
+        self.Samples = [self.Sample(t) for t in self.Times]
+
+    def Sample(self,t):
+        Func = self.Func
+        if getattr(Func,'Vectorized',False):
+            Sampled = lambda X: Func(X,t)
+            Sampled.Vectorized = True
+            return Sampled
+        return lambda xv: Func(xv,t)
+
+    def Weights(self,t):
+        k = int(np.clip(np.searchsorted(self.Times,t,side='right')-1,0,len(self.Times)-1))
+        if k == len(self.Times)-1:
+            return k,k,0.0
+        w = (t-self.Times[k])/(self.Times[k+1]-self.Times[k])
+        w = min(max(w,0.0),1.0)
+        return k,k+1,w
+
+    def Eval(self,xv,t):
+        k0,k1,w = self.Weights(t)
+        return (1-w)*np.asarray(self.Samples[k0](xv))+w*np.asarray(self.Samples[k1](xv))
+
+    def DOFs(self,Evaluate,Points,t):
+        k0,k1,w = self.Weights(t)
+        V0 = self.Cached(Evaluate,self.Samples[k0],Points)
+        if w == 0.0:
+            return V0
+        return (1-w)*V0+w*self.Cached(Evaluate,self.Samples[k1],Points)
@@ -0,0 +1,108 @@
+import numpy as np
+
+class StateLayout:
+    #Describes how a set of mesh fields is packed into the vector of unknowns used by the solvers.
+    #Each field lives on one kind of mesh entity:
+    #'Node'    - nodal values, the unknowns are the internal nodes
+    #'Mid'     - midnode values, the unknowns are the internal midnodes
+    #'Edge'    - edge values, every edge is an unknown
+    #'Cell'    - cell values, every cell but the last is an unknown (the last one is fixed by the closure)
+    #'AllNode' - nodal values, every node is an unknown
+    #The fields are stored one after the other in the order given by Kinds. If InvPerm is given,
+    #the unknown k of that ordering is stored in position InvPerm[k] of the vector.
+    #All the index arrays are computed once, so moving data between the vector and the fields
+    #is a single fancy indexing operation per field.
+    def __init__(self,Mesh,Kinds,InvPerm=None):
+        self.Kinds = list(Kinds)
+        NumNodes, NumMid = len(Mesh.Nodes), len(Mesh.EdgeNodes)
+        NumCells         = len(Mesh.ElementEdges)
+        IntNodes = np.asarray(Mesh.NumInternalNodes,   dtype=int)
+        IntMid   = np.asarray(Mesh.NumInternalMidNodes,dtype=int)
+        BNodes   = np.asarray(Mesh.NumBoundaryNodes,   dtype=int)
+        BMid     = np.asarray(Mesh.NumBMidNodes,       dtype=int)
+        Empty    = np.zeros(0,dtype=int)
+        Table    = {'Node'   : (NumNodes,IntNodes,BNodes),
+                    'Mid'    : (NumMid,IntMid,BMid),
+                    'Edge'   : (NumMid,np.arange(NumMid),Empty),
+                    'Cell'   : (NumCells,np.arange(NumCells-1),Empty),
+                    'AllNode': (NumNodes,np.arange(NumNodes),Empty)}
+        self.Sizes, self.Interior, self.Boundary = [],[],[]
+        for Kind in self.Kinds:
+            Size, Interior, Boundary = Table[Kind]
+            self.Sizes.append(Size)
+            self.Interior.append(Interior)
+            self.Boundary.append(Boundary)
+        Counts       = [len(Interior) for Interior in self.Interior]
+        self.Offsets = np.concatenate(([0],np.cumsum(Counts))).astype(int)
+        self.NumDOF  = int(self.Offsets[-1])
+        self.SetPermutation(InvPerm)
+
+    def SetPermutation(self,InvPerm):
+        #Positions[k] are the entries of the vector holding the unknowns of field k.
+        self.Positions = []
+        for k in range(len(self.Kinds)):
+            Block = np.arange(self.Offsets[k],self.Offsets[k+1])
+            if InvPerm is not None:
+                Block = np.asarray(InvPerm)[Block]
+            self.Positions.append(Block)
+
+    def Empty(self):
+        #Returns a zero array for each field
+        return tuple(np.zeros(Size,dtype=float) for Size in self.Sizes)
+
+    def Gather(self,Fields,x=None):
+        #Packs the unknowns of Fields into x, which is allocated if not given.
+        if x is None:
+            x = np.empty(self.NumDOF,dtype=float)
+        for k in range(len(self.Kinds)):
+            x[self.Positions[k]] = np.asarray(Fields[k])[self.Interior[k]]
+        return x
+
+    def Scatter(self,x,Out):
+        #Writes the unknowns stored in x into the fields in Out. Other entries are left untouched.
+        #x may be a (k,NumDOF) array of k states, the fields are then (k,n) arrays.
+        for k in range(len(self.Kinds)):
+            Out[k][...,self.Interior[k]] = x[...,self.Positions[k]]
+        return Out
+
+    def CopyBoundary(self,Fields,Out):
+        #Copies the boundary values of Fields into Out.
+        for k in range(len(self.Kinds)):
+            if len(self.Boundary[k]) > 0:
+                Out[k][self.Boundary[k]] = np.asarray(Fields[k])[self.Boundary[k]]
+        return Out
+
+    def SetBoundary(self,Values,Out):
+        #Values holds, for each field, the values at its boundary entities (or None to leave them).
+        for k in range(len(self.Kinds)):
+            if Values[k] is not None and len(self.Boundary[k]) > 0:
+                Out[k][self.Boundary[k]] = Values[k]
+        return Out
+
+class FieldState:
+    #Owns one contiguous float64 buffer holding all the fields of a layout, one after the other
+    #in the order of Layout.Kinds, and exposes each field as a named view of it.
+    #The unknowns of node and midnode fields are not a strided subset of the fields, so they are
+    #moved through the index arrays of the layout instead of being viewed.
+    def __init__(self,Layout,Names,Buffer=None):
+        self.Layout, self.Names = Layout, tuple(Names)
+        Offsets     = np.concatenate(([0],np.cumsum(Layout.Sizes))).astype(int)
+        self.Buffer = np.zeros(Offsets[-1],dtype=float) if Buffer is None else Buffer
+        self.Fields = tuple(self.Buffer[Offsets[k]:Offsets[k+1]] for k in range(len(Layout.Kinds)))
+        for Name, Field in zip(self.Names,self.Fields):
+            setattr(self,Name,Field)
+
+    def Assign(self,Fields):
+        #Copies the values of Fields into the buffer
+        for Field, Value in zip(self.Fields,Fields):
+            Field[:] = Value
+
+    def Unknowns(self,x=None):
+        return self.Layout.Gather(self.Fields,x)
+
+    def SetUnknowns(self,x):
+        self.Layout.Scatter(x,self.Fields)
+
+    def Copy(self):
+        #A state with its own buffer, e.g. for checkpointing
+        return FieldState(self.Layout,self.Names,self.Buffer.copy())
@@ -1,4 +1,8 @@
+import numpy as np
 from MeshHelios import HeliosMesh
+from MeshHelios import ReadDurhamMesh
+from MeshGen import GenerateMesh
+from Functions import MathematicaTokens, ReadMathematicaMesh, ProcessMathematicaMesh, ProcessedMesh
 
 #This is a simple test to check that we can cosntruct HeliosMeshes
 def test_MeshHeliosInit():
@@ -43,3 +47,124 @@ def test_BoundaryNodes():
 
     TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
     assert(TestMesh.NumBoundaryNodes == NumBoundaryNodes)
+
+def test_Renumber():
+    Nodes            = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes        = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges     = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]                                     
+    Orientations     = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+
+    OrigMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    for Method in ['RCM','Hilbert']:
+        TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations,Reorder=Method)
+        for e in range(len(EdgeNodes)):
+            v1,v2 = TestMesh.EdgeNodes[e]
+            w1,w2 = EdgeNodes[TestMesh.EdgePerm[e]]
+            assert (TestMesh.Nodes[v1] == Nodes[w1] and TestMesh.Nodes[v2] == Nodes[w2])
+        for c in range(len(ElementEdges)):
+            xP,yP,A,V,E = TestMesh.Centroid(TestMesh.ElementEdges[c],TestMesh.Orientations[c])
+            oc          = TestMesh.ElementPerm[c]
+            xQ,yQ,B,W,F = OrigMesh.Centroid(ElementEdges[oc],Orientations[oc])
+            assert (abs(xP-xQ)<1E-12 and abs(yP-yQ)<1E-12 and abs(A-B)<1E-12)
+        x = np.array([Node[0] for Node in TestMesh.Nodes])
+        assert (np.all(TestMesh.NodesToInput(x) == np.array([Node[0] for Node in Nodes])))
+        assert (TestMesh.NumInternalNodes == [TestMesh.NodeInvPerm[4]])
+        assert (sorted(TestMesh.BNodes) == sorted(Nodes[:4]+Nodes[5:]))
+        assert (TestMesh.BNodes == [TestMesh.Nodes[i] for i in TestMesh.NumBoundaryNodes])
+
+def test_Operators():
+    Nodes            = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes        = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges     = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]                                     
+    Orientations     = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    E    = np.array([Node[0]+2*Node[1] for Node in Nodes],dtype=float)
+    Curl = TestMesh.Operator('Curl')
+    for e in range(len(EdgeNodes)):
+        v1,v2 = EdgeNodes[e]
+        assert (abs(Curl.dot(E)[e]-(E[v2]-E[v1])) <1E-12) #Every edge has length 1
+    assert (Curl is TestMesh.Operator('Curl'))
+    #A constant field has no divergence
+    Div  = TestMesh.Operator('AreaDiv')
+    Flux = np.array([Node2[1]-Node1[1] for Node1,Node2 in ([Nodes[v1],Nodes[v2]] for v1,v2 in EdgeNodes)],dtype=float)
+    assert (np.allclose(Div.dot(Flux),0))
+    assert (np.allclose(TestMesh.Areas,1) and np.allclose(TestMesh.Centroids[0],[0.5,-0.5]))
+    assert (np.allclose((TestMesh.Operator('Div')*Curl).toarray(),0))
+
+def test_ElementColouring():
+    Nodes            = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes        = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges     = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]
+    Orientations     = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    Colours = TestMesh.ElementColouring()
+    #All the elements share the central node
+    assert (len(Colours) == 4)
+    assert (sorted(np.concatenate(Colours)) == list(range(len(ElementEdges))))
+    for Colour in Colours:
+        Used = np.concatenate([TestMesh.FlatStart[TestMesh.ElementPtr[c]:TestMesh.ElementPtr[c+1]] for c in Colour])
+        assert (len(Used) == len(set(Used)))
+    assert (Colours is TestMesh.ElementColouring())
+
+def test_ReadDurhamMesh():
+    Nodes,EdgeNodes,ElementEdges,Orientations = ReadDurhamMesh('../MarcosMeshGen/locrefs_quads_0.mesh')
+    assert (len(Nodes) == 451 and len(EdgeNodes) == 850 and len(ElementEdges) == 400)
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    TestMesh.MakeGeometry()
+    assert (TestMesh.Areas.min() > 0 and np.isclose(TestMesh.Areas.sum(),4))
+    assert (len(TestMesh.NumBoundaryNodes) == 2*41+2*9)
+    assert (TestMesh.LocatePoints(TestMesh.Centroids).tolist() == list(range(400)))
+    Inside = TestMesh.LocatePoints([[0.01,0.01],[-1,-1],[1.5,0]])
+    assert (TestMesh.ContainsPoints(Inside[0:2],np.array([[0.01,0.01],[-1,-1]])).all() and Inside[2] == -1)
+    #The file is on [0,1]^2, Normalize maps it to [-1,1]^2 by x -> 2x-1
+    Raw = ReadDurhamMesh('../MarcosMeshGen/locrefs_quads_0.mesh',Normalize=False)
+    assert (np.min(Raw[0]) == 0 and np.max(Raw[0]) == 1 and Raw[1:] == (EdgeNodes,ElementEdges,Orientations))
+    assert np.allclose(2*np.array(Raw[0])-1,Nodes)
+
+def test_GenerateMesh():
+    for Family, Sizes in [('Trig',[3]),('Quad',[4]),('Vor',[4,5,6,7,8])]:
+        Nodes,EdgeNodes,ElementEdges,Orientations = GenerateMesh(Family,0.2)
+        TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+        TestMesh.MakeGeometry()
+        assert (TestMesh.Areas.min() > 0 and np.isclose(TestMesh.Areas.sum(),4))
+        assert set(np.diff(TestMesh.ElementPtr).tolist()).issubset(Sizes)
+        #Every edge is shared by two elements, or lies on the boundary
+        Cells    = np.array([len(c) for c in TestMesh.EdgestoCells])
+        Boundary = np.isin(np.arange(len(EdgeNodes)),TestMesh.NumBMidNodes)
+        assert (Cells[Boundary] == 1).all() and (Cells[~Boundary] == 2).all()
+        assert np.allclose((TestMesh.Operator('Div')@TestMesh.Operator('Curl')).toarray(),0)
+        assert (len(ElementEdges) >= 100)
+    #Lloyd iterations give rounder cells
+    Ratio = []
+    for Lloyd in [0,5]:
+        TestMesh = HeliosMesh(*GenerateMesh('Vor',0.2,Lloyd=Lloyd,Seed=1))
+        TestMesh.MakeGeometry()
+        Ratio.append(np.min(TestMesh.EdgeLengths)/np.sqrt(np.mean(TestMesh.Areas)))
+    assert (Ratio[1] > Ratio[0])
+
+def test_ReadMathematicaMesh(tmp_path):
+    #A quadrilateral and two triangles on [-1,1]^2, the reals carry Mathematica exponents
+    Export = ('{{-1.*^0,-1.},{0.,-1.},{1.0*^0,-1.},{10.*^-1,1.},{-1.,1.},{0.,10.*^-1}}\n'
+              '{Line[{1,2}],Line[{2,3}],Line[{3,4}],Line[{4,6}],Line[{6,5}],Line[{5,1}],Line[{2,6}],Line[{2,4}]}\n'
+              '{Polygon[{1,2,6,5}],Polygon[{2,3,4}],Polygon[{2,4,6}]}\n')
+    File = tmp_path/'Mesh.txt'
+    File.write_text(Export)
+    Nodes        = [[-1,-1],[0,-1],[1,-1],[1,1],[-1,1],[0,1]]
+    EdgeNodes    = [[0,1],[1,2],[2,3],[3,5],[5,4],[4,0],[1,5],[1,3]]
+    ElementEdges = [[0,6,4,5],[1,2,7],[7,3,6]]
+    Orientations = [[1,1,1,1,1],[1,1,-1,1],[1,1,-1,1]] #Orientation repeats the first edge at the end
+
+    #Every chunk size splits some token, e.g. '10.*^-1' or 'Polygon[', across the chunks
+    Tokens = list(MathematicaTokens(File))
+    assert (Tokens[0:4] == ['{','{','-1.*^0','-1.'] and Tokens.count('Polygon[') == 3)
+    for chunksize in range(1,len(Export)+1):
+        assert (list(MathematicaTokens(File,chunksize)) == Tokens)
+        N,E,Ptr,ElementNodes = ReadMathematicaMesh(File,chunksize)
+        assert (np.all(N == np.array(Nodes)) and np.all(E == np.array(EdgeNodes)))
+        assert (np.all(Ptr == [0,4,7,10]) and np.all(ElementNodes == [0,1,5,4,1,2,3,1,3,5]))
+
+    N,E,EE,B,O = ProcessMathematicaMesh(File,tmp_path/'Mesh.p')
+    assert (N == Nodes and E == EdgeNodes and EE == ElementEdges and B == [0,1,2,3,4,5] and O == Orientations)
+    assert (ProcessedMesh(tmp_path/'Mesh.p') == (N,E,EE,B,O))
@@ -1,7 +1,23 @@
 from PDEClass import PDEFullMHD
+from PDEClass import Vectorized
+from Sources import SteadyData,SeparableData,TabulatedData
+from StateLayout import StateLayout
+from Workspace import TraceAllocations
+import Kernels
+from Parallel import RCBPartition,Decompose
+from Schwarz import MeshPatches,ConstantModes,AdditiveSchwarz,SchwarzPreconditioner
+from Multigrid import MeshHierarchy,PointProlongation,Prolongations,Multigrid
+from Transfer import MeshSequence
+from Adapt import ResidualIndicators,JumpIndicators,DorflerMarking,RefineMesh,TransferState,AdaptiveLoop,ErrorIndicators
+from Solver import InexactNewtonTimeInt
 from Functions import *
+import Functions
 from MeshHelios import HeliosMesh
+from scipy.sparse.linalg import gmres
+from scipy.sparse.linalg import cg
 import pickle
+import multiprocessing as mp
+import os
 import numpy as np
 import math
 def ProcessedMesh(Pfile):
@@ -9,6 +25,21 @@ def ProcessedMesh(Pfile):
         N,E,EE,B,O = pickle.load(fp)
     return N,E,EE,B,O
 
+def PerturbedQuadMesh():
+    #The 2x2 squares of [-1,1]^2 with the central node moved to (0.2,0.1)
+    Nodes         = [[-1,-1],[0,-1],[1,-1],[-1,0],[0.2,0.1],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes     = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges  = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]
+    Orientations  = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    return HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+def PerturbedQuadPDE():
+    #PDEFullMHD on PerturbedQuadMesh with u = B = (1,1), Re = Rm = 1, dt = theta = 0.5
+    def Inu(xv):
+        return np.array([1,1])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    return PDEFullMHD(PerturbedQuadMesh(),Re,Rm,Inu,Inu,dt,theta)
+
 def RetrieveAMRMesh(Pfile):
     with open(Pfile, "rb") as fp:   # Unpickling
         N,E,EE,B,O,BT,LR,C = pickle.load(fp)
@@ -145,6 +176,30 @@ def test_EhVhInProd():
 
     assert( abs(A1-2)<1E-5 and abs(A2-1)<1E-5 and abs(A3-5)<1E-5 and abs(A4-1/2)<1E-5)
 
+def test_MHDInterleave():
+    Nodes         = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes     = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges  = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]                                     
+    Orientations  = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    TestMesh      = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    def Inu(xv):
+        return np.array([xv[0],xv[1]+2])
+    def InB(xv):
+        return np.array([1,xv[0]])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,InB,dt,theta)
+    TestPDE.E = np.arange(len(Nodes),dtype=float)
+    TestPDE.p = np.array([1.,2.,3.,-6.])
+    xb = TestPDE.MHDConcatenate(TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy,TestPDE.B,TestPDE.E,TestPDE.p)
+    TestPDE.SetMHDInterleave(True)
+    xi = TestPDE.MHDConcatenate(TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy,TestPDE.B,TestPDE.E,TestPDE.p)
+    #The only internal node is 4, its unknowns come first
+    assert (np.all(xi[0:3] == np.array([0,2,4])))
+    assert (np.all(np.sort(xi) == np.sort(xb)))
+    unx,uny,umx,umy,B,E,p = TestPDE.MHDUpdateInt(xi,TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy,TestPDE.B,TestPDE.E,TestPDE.p)
+    assert (np.all(unx == TestPDE.unx) and np.all(umy == TestPDE.umy) and np.all(B == TestPDE.B) and np.all(E == TestPDE.E))
+
 # def test_TVSGandH():
 #     Nodes         = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
 #     EdgeNodes     = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
@@ -724,7 +779,7 @@ def test_parallelG():
             dx = [0.12803687993289598, 0.06772854614785964, 0.03450327796711771, 0.017476749542968805,\
         0.008787156237382746]
         i = 0
-        for Pfile in ProcessedFiles:
+        for Pfile in ProcessedFiles[0:1]: #The serial residual is too slow on the finer meshes
             Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh(Pfile)
             #Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,BottomToTop,LeftToRight,Corners = RetrieveAMRMesh("AMRmesh.txt")
             Mesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
@@ -749,4 +804,802 @@ def test_parallelG():
             xB        = PDE.MagDOFs(Bt)
             xE        = PDE.NodalDOFs(Et,Mesh.Nodes)
             xp        = PDE.PhDOF(pt)
-            yp        = PDE.pMHDG(PDE.MHDConcatenate(xunx,xuny,xumx,xumy,xB,xE,xp),Gunx)
\ No newline at end of file
+            x         = PDE.MHDConcatenate(xunx,xuny,xumx,xumy,xB,xE,xp)
+            PDE.StartParallel(3)
+            yp        = PDE.pMHDG(x)
+            PDE.StopParallel()
+            assert np.allclose(yp,PDE.MHDG(x),rtol=1E-12,atol=1E-12)
+
+def test_DivDiagnostics():
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PVh=0.128037.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    def Inu(xv):
+        return np.array([xv[0]**2+xv[1],xv[0]*xv[1]])
+    def InB(xv):
+        return np.array([xv[0]**2,xv[1]])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,InB,dt,theta)
+    Masserr = 0
+    for j in range(len(ElementEdges)):
+        lunx,luny,lumx,lumy = TestPDE.GetLocalTVhDOF(j,TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy)
+        divu, A = TestPDE.DIVu(j,lunx,luny,lumx,lumy)
+        Masserr = Masserr+TestPDE.PhInProd(j,divu*A,divu*A)
+    assert (abs(TestPDE.Diagnostics.uDivSquared(TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy)-Masserr)<1E-10)
+    divB, L2divB = 0, 0
+    for j in range(len(ElementEdges)):
+        LocB  = TestPDE.GetLocalEhDOF(j,TestPDE.B)
+        A,V,E = TestMesh.Area(ElementEdges[j],Orientations[j])
+        Flux  = 0
+        for k in range(len(ElementEdges[j])):
+            v1,v2 = EdgeNodes[ElementEdges[j][k]]
+            Flux  = Flux+Orientations[j][k]*LocB[k]*math.dist(Nodes[v1],Nodes[v2])
+        divB   = divB+A*Flux**2
+        L2divB = L2divB+Flux**2/A
+    assert (abs(TestPDE.BDivSquared(TestPDE.B)-divB)<1E-10)
+    assert (abs(TestPDE.BDivL2Squared(TestPDE.B)-L2divB)<1E-10)
+    #B = (x,y) has div B = 2, so the square of the L2 norm over [-1,1]^2 is 16, and the fluxes are exact.
+    #The flux out of each element is 2A, so the sum of A*flux^2 is 4 times the sum of A^3
+    @Vectorized
+    def Bxy(X):
+        return X
+    assert (abs(TestPDE.BDivL2Squared(TestPDE.MagDOFs(Bxy))-16)<1E-10)
+    assert (abs(TestPDE.Diagnostics.BDivL2Norm(TestPDE.MagDOFs(Bxy))-4)<1E-10)
+    assert (abs(TestPDE.BDivSquared(TestPDE.MagDOFs(Bxy))-4*np.sum(TestMesh.Areas**3))<1E-10)
+    #div u = 3x, the cellwise averages approach its L2 norm
+    assert (abs(Masserr-12)<0.5)
+
+def test_ErrorNorms():
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PTh=0.2.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    def Inu(xv):
+        return np.array([xv[1]**2,xv[0]**2])
+    def InB(xv):
+        return np.array([1,1])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,InB,dt,theta)
+    u       = TestPDE.TVhVector(TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy)
+    E       = np.array([Node[0] for Node in Nodes])
+    Norms   = TestPDE.ErrorNorms({'u':('TVh',np.stack((u,2*u)),None),'E':('Vh',E,0*E),'B':('Eh',TestPDE.B,None)})
+    assert (np.allclose(Norms['u']**2,[8/5,32/5]))
+    assert (abs(TestPDE.TVhH1Norm(TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy)**2-32/3)<1E-8)
+    #The nodal mass matrix integrates constants exactly and E = x up to the consistency error
+    assert (abs(TestPDE.VhL2Norm(np.ones(len(Nodes)))**2-4)<1E-12)
+    assert (abs(Norms['E']**2-4/3)<3E-2 and abs(Norms['B']**2-8)<1E-8)
+    assert (abs(TestPDE.PhL2Norm(TestMesh.Areas)**2-4)<1E-12)
+
+def test_ErrorNormsReference():
+    #The norms from the assembled mass matrices against the sums of the local norms, element by
+    #element, on a Voronoi mesh with general polygons
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PVh=0.128037.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    def Inu(xv):
+        return np.array([math.sin(2*xv[1])+xv[0],xv[0]**3-xv[1]])
+    def InB(xv):
+        return np.array([math.cos(xv[0]*xv[1]),xv[0]**2])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,InB,dt,theta)
+    E       = np.array([math.exp(Node[0])*Node[1] for Node in Nodes])
+    VNorm, ENorm, TVNorm, H1Norm = 0, 0, 0, 0
+    for i in range(len(ElementEdges)):
+        LocE   = TestPDE.GetLocalVhDOF(i,E)
+        LocB   = TestPDE.GetLocalEhDOF(i,TestPDE.B)
+        VNorm  = VNorm+LocE.dot(TestPDE.MVList[i].dot(LocE))
+        ENorm  = ENorm+LocB.dot(TestPDE.MEList[i].dot(LocB))
+        lunx,luny,lumx,lumy = TestPDE.GetLocalTVhDOF(i,TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy)
+        TVNorm = TVNorm+TestPDE.TVhInProd(i,lunx,luny,lumx,lumy,lunx,luny,lumx,lumy)
+        H1Norm = H1Norm+TestPDE.TVhSemiInProd(i,lunx,luny,lumx,lumy,lunx,luny,lumx,lumy)
+    assert (abs(TestPDE.VhL2Norm(E)-math.sqrt(VNorm))<1E-12*math.sqrt(VNorm))
+    assert (abs(TestPDE.EhL2Norm(TestPDE.B)-math.sqrt(ENorm))<1E-12*math.sqrt(ENorm))
+    assert (abs(TestPDE.TVhL2Norm(TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy)-math.sqrt(TVNorm))<1E-12*math.sqrt(TVNorm))
+    assert (abs(TestPDE.TVhH1Norm(TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy)-math.sqrt(H1Norm))<1E-12*math.sqrt(H1Norm))
+
+def test_VectorizedDOFs():
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PTh=0.2.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    def Inu(xv):
+        return np.array([math.sin(xv[1]),xv[0]**2])
+    def InB(xv):
+        return np.array([math.cos(xv[0]),xv[0]*xv[1]])
+    @Vectorized
+    def vInu(X):
+        return np.stack((np.sin(X[:,1]),X[:,0]**2),axis=1)
+    @Vectorized
+    def vInB(X):
+        return np.stack((np.cos(X[:,0]),X[:,0]*X[:,1]),axis=1)
+    def ub(xv,t):
+        return np.array([t*xv[0],t])
+    @Vectorized
+    def vub(X,t):
+        return np.stack((t*X[:,0],t+0*X[:,0]),axis=1)
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    PDE1 = PDEFullMHD(TestMesh,Re,Rm,Inu,InB,dt,theta)
+    PDE2 = PDEFullMHD(TestMesh,Re,Rm,vInu,vInB,dt,theta)
+    assert (np.allclose(PDE1.unx,PDE2.unx) and np.allclose(PDE1.umy,PDE2.umy) and np.allclose(PDE1.B,PDE2.B))
+    assert (np.allclose(PDE1.PhDOF(lambda xv: xv[0]),PDE2.PhDOF(Vectorized(lambda X: X[:,0]))))
+    PDE1.SetMHDBCandSource(ub,lambda xv,t: t,ub,lambda xv,t: 0)
+    PDE2.SetMHDBCandSource(vub,Vectorized(lambda X,t: t+0*X[:,0]),vub,Vectorized(lambda X,t: 0*X[:,0]))
+    PDE1.MHDComputeBC(1)
+    PDE2.MHDComputeBC(1)
+    assert (np.allclose(PDE1.ubnx,PDE2.ubnx) and np.allclose(PDE1.ubmy,PDE2.ubmy) and np.allclose(PDE1.Ebarr,PDE2.Ebarr))
+
+def test_SourceProviders():
+    Nodes         = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes     = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges  = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]                                     
+    Orientations  = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    TestMesh      = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    def Inu(xv):
+        return np.array([1,1])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,Inu,dt,theta)
+    Calls   = [0]
+    def g(xv):
+        Calls[0] = Calls[0]+1
+        return np.array([xv[0],xv[1]])
+    def f(xv,t):
+        return g(xv)*math.exp(t)
+    def h(xv,t):
+        return xv[0]*t
+    TestPDE.SetMHDBCandSource(SteadyData(g),SteadyData(lambda xv: 0),SeparableData(g,math.exp),TabulatedData(h,[0,1,2]))
+    for t in [0,0.25,1.3]:
+        TestPDE.MHDComputeBC(t)
+        TestPDE.MHDComputeSources(t)
+        assert (np.allclose(TestPDE.fnx,[f(Node,t+theta*dt)[0] for Node in Nodes]))
+        assert (np.allclose(TestPDE.hdof,[h(Node,t+theta*dt) for Node in Nodes]))
+        assert (np.allclose(TestPDE.ubmy,[g(Node)[1] for Node in TestMesh.BMidNodes]))
+    #g is evaluated once on each set of points, plus the direct calls above
+    assert (Calls[0] == len(Nodes)+len(TestMesh.BNodes)+len(TestMesh.BMidNodes)+len(TestMesh.MidNodes)+3*len(TestMesh.BMidNodes)+3*len(Nodes))
+
+def test_StateLayout():
+    Nodes         = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes     = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges  = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]                                     
+    Orientations  = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    TestMesh      = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    Layout = StateLayout(TestMesh,('Node','Mid','Edge','Cell'))
+    assert (Layout.NumDOF == 1+4+12+3)
+    unx, umx, B, p = np.arange(9.), np.arange(12.)+10, np.arange(12.)+30, np.array([1.,2.,3.,-6.])
+    x = Layout.Gather((unx,umx,B,p))
+    assert (np.all(x == np.concatenate(([4.],umx[TestMesh.NumInternalMidNodes],B,p[0:3]))))
+    Out = Layout.CopyBoundary((unx,umx,B,p),Layout.Empty())
+    Layout.Scatter(2*x,Out)
+    assert (np.all(Out[0] == np.where(np.arange(9) == 4,8.,unx)))
+    assert (np.all(Out[2] == 2*B) and np.all(Out[3] == np.array([2.,4.,6.,0.])))
+    #A permuted layout reverses the order of the unknowns
+    Layout.SetPermutation(np.arange(Layout.NumDOF)[::-1])
+    assert (np.all(Layout.Gather((unx,umx,B,p)) == x[::-1]))
+    Layout.Scatter(x[::-1],Out)
+    assert (np.all(Out[1] == umx) and np.all(Out[3][0:3] == p[0:3]))
+
+def test_StateSwap():
+    Nodes         = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes     = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges  = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]                                     
+    Orientations  = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    TestMesh      = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    def Inu(xv):
+        return np.array([xv[0]+0.5,xv[1]])
+    def ub(xv,t):
+        return np.array([t,xv[0]])
+    def Eb(xv,t):
+        return xv[1]
+    def f(xv,t):
+        return np.array([0,0])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,Inu,dt,theta)
+    TestPDE.SetMHDBCandSource(ub,Eb,f,Eb)
+    TestPDE.MHDComputeBC(0)
+    assert (np.shares_memory(TestPDE.unx,TestPDE.State.Buffer) and np.shares_memory(TestPDE.p,TestPDE.State.Buffer))
+    x   = np.linspace(1,2,TestPDE.SetNumMHDDof())
+    Old = TestPDE.State.Copy()
+    unx,uny,umx,umy,B,E,p = TestPDE.MHDUpdateInt(x,TestPDE.unx,TestPDE.uny,TestPDE.umx,TestPDE.umy,TestPDE.B,TestPDE.E,TestPDE.p)
+    unx,uny,umx,umy,E     = TestPDE.MHDUpdateBC(unx,uny,umx,umy,E)
+    Buffers = TestPDE.State.Buffer, TestPDE.NextState.Buffer
+    TestPDE.MHDAdvance(x)
+    #The states are swapped, not copied
+    assert (TestPDE.State.Buffer is Buffers[1] and TestPDE.NextState.Buffer is Buffers[0])
+    assert (np.all(TestPDE.unx == unx) and np.all(TestPDE.E == E) and np.all(TestPDE.B == B) and np.all(TestPDE.p == p))
+    assert (np.all(TestPDE.State.Unknowns() == x) and np.all(Old.unx == TestPDE.NextState.unx))
+
+def test_ResidualWorkspace():
+    Nodes         = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes     = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges  = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]                                     
+    Orientations  = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    TestMesh      = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    def Inu(xv):
+        return np.array([xv[0]+0.5,xv[1]])
+    def ub(xv,t):
+        return np.array([t,xv[0]])
+    def Eb(xv,t):
+        return xv[1]
+    def f(xv,t):
+        return np.array([xv[1],0])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,Inu,dt,theta)
+    TestPDE.SetMHDBCandSource(ub,Eb,f,Eb)
+    TestPDE.MHDComputeBC(0)
+    TestPDE.MHDComputeSources(0)
+    x  = np.linspace(1,2,TestPDE.SetNumMHDDof())
+    y  = TestPDE.MHDG(x)
+    #After the first evaluation every temporary array is reused
+    Allocations = TestPDE.Work.Allocations
+    Out = np.empty(len(x))
+    assert (TestPDE.MHDG(x+1,Out) is Out)
+    assert (TestPDE.MHDG(x,Out) is Out and np.allclose(Out,y))
+    assert (TestPDE.Work.Allocations == Allocations)
+    #No NumPy memory is kept by an evaluation into Out, the element-local temporaries are released
+    Retained, Peak = TraceAllocations(TestPDE.MHDG,x,Out)
+    assert (Retained == 0 and Peak > 0)
+    assert (TraceAllocations(TestPDE.MHDG,x)[0] >= x.nbytes)
+    TestPDE.SetMHDInterleave(True)
+    assert (np.allclose(TestPDE.MHDG(TestPDE.MHDFromBlocked(x),Out),TestPDE.MHDFromBlocked(y)))
+    assert (TestPDE.Work.Allocations == Allocations+1)
+
+def test_BatchedResiduals():
+    Nodes         = [[-1,-1],[0,-1],[1,-1],[-1,0],[0,0],[1,0],[-1,1],[0,1],[1,1]]
+    EdgeNodes     = [[0,1],[4,1],[8,5],[4,7],[7,8],[6,7],[3,6],[0,3],[5,2],[1,2],[3,4],[4,5]]
+    ElementEdges  = [[9,8,11,1],[0,1,10,7],[10,3,5,6],[11,2,4,3]]                                     
+    Orientations  = [[1,-1,-1,1],[1,-1,-1,-1],[1,1,-1,-1],[1,-1,-1,-1]]
+    TestMesh      = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    def Inu(xv):
+        return np.array([xv[0]+0.5,xv[1]])
+    def ub(xv,t):
+        return np.array([t,xv[0]])
+    def Eb(xv,t):
+        return xv[1]
+    def f(xv,t):
+        return np.array([xv[1],0])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,Inu,dt,theta)
+    TestPDE.SetMHDBCandSource(ub,Eb,f,Eb)
+    TestPDE.MHDComputeBC(0)
+    TestPDE.MHDComputeSources(0)
+    ndof = TestPDE.SetNumMHDDof()
+    X    = np.array([np.linspace(1,2,ndof)*k for k in range(3)])
+    Y    = TestPDE.MHDG(X)
+    assert (Y.shape == X.shape)
+    for k in range(3):
+        assert (np.allclose(Y[k],TestPDE.MHDG(X[k])))
+    #The momentum row of the internal node against the element by element inner products
+    F    = TestPDE.MHDPrepare(X[2])
+    nx,ny,mx,my,utx,uty,umtx,umty,Btheta,Bp1,E,p,RTnx,RTny,RTmx,RTmy,Em = F
+    i    = TestMesh.NumInternalNodes[0]
+    Ref  = 0
+    for Cell in TestMesh.NodestoCells[i]:
+        Loc     = slice(TestMesh.ElementPtr[Cell],TestMesh.ElementPtr[Cell+1])
+        v       = TestPDE.GetLocalTVhDOF(Cell,*TestPDE.Work.TestFunction(0,i))
+        u       = TestPDE.GetLocalTVhDOF(Cell,utx,uty,umtx,umty)
+        Jn      = TestPDE.GetLocalVhDOF(Cell,E)+TestPDE.Cross2Dto1D(u[0],u[1],RTnx[Loc],RTny[Loc])
+        Jm      = Em[Loc]+TestPDE.Cross2Dto1D(u[2],u[3],RTmx[Loc],RTmy[Loc])
+        JxB     = TestPDE.Cross1Dto2D(Jn,RTnx[Loc],RTny[Loc])+TestPDE.Cross1Dto2D(Jm,RTmx[Loc],RTmy[Loc])
+        divv, A = TestPDE.DIVu(Cell,*v)
+        Ref     = Ref+TestPDE.TVhInProd(Cell,*TestPDE.GetLocalTVhDOF(Cell,nx,ny,mx,my),*v)\
+                  +(1/Re)*TestPDE.TVhSemiInProd(Cell,*u,*v)-TestPDE.TVhInProd(Cell,*JxB,*v)-p[Cell]*divv
+    assert (np.isclose(TestPDE.MHDMomentumRows(F,np.zeros(ndof))[0],Ref,rtol=1E-10,atol=1E-12))
+    TestPDE.SetMHDInterleave(True)
+    Out = np.zeros(X.shape)
+    assert (TestPDE.MHDG(TestPDE.MHDFromBlocked(X),Out) is Out and np.allclose(Out,TestPDE.MHDFromBlocked(Y)))
+    TestPDE.SetMHDInterleave(False)
+    #The batched Jacobian columns agree with one evaluation per column
+    Solver = InexactNewtonTimeInt()
+    Solver.BatchSize = 7
+    Gx = TestPDE.MHDG(X[1])
+    J  = Solver.FDJacobian(TestPDE.MHDG,Gx,X[1],ndof)
+    for i in [0,5,ndof-1]:
+        e    = np.zeros(ndof)
+        e[i] = Solver.eps
+        assert (np.allclose(J[:,i],(TestPDE.MHDG(X[1]+e)-Gx)/Solver.eps))
+
+def test_RTOperators():
+    TestPDE  = PerturbedQuadPDE()
+    TestMesh = TestPDE.Mesh
+    Nodes,EdgeNodes,ElementEdges,Orientations = TestMesh.Nodes,TestMesh.EdgeNodes,TestMesh.ElementEdges,TestMesh.Orientations
+    B        = np.linspace(-1,2,len(EdgeNodes))
+    nx,ny,mx,my = TestPDE.PiRT(B)
+    for Cell in range(len(ElementEdges)):
+        V,E    = TestMesh.StandardElement(ElementEdges[Cell],Orientations[Cell])
+        LocB   = TestPDE.GetLocalEhDOF(Cell,B)
+        coeffs = TestPDE.RTKIList[Cell].dot(TestPDE.PiRTBB(LocB,ElementEdges[Cell],Cell,E))
+        Loc    = slice(TestMesh.ElementPtr[Cell],TestMesh.ElementPtr[Cell+1])
+        for i in range(len(ElementEdges[Cell])):
+            x1,y1 = Nodes[E[i][0]]
+            x2,y2 = Nodes[E[i][1]]
+            assert (abs(nx[Loc][i]-coeffs[0]-coeffs[2]*x1) < 1E-12 and abs(ny[Loc][i]-coeffs[1]-coeffs[2]*y1) < 1E-12)
+            assert (abs(mx[Loc][i]-coeffs[0]-coeffs[2]*(x1+x2)/2) < 1E-12 and abs(my[Loc][i]-coeffs[1]-coeffs[2]*(y1+y2)/2) < 1E-12)
+
+def test_TVhInnerPreComputeAll():
+    def Inu(xv):
+        return np.array([1,1])
+    #The Voronoi mesh has elements of 4 to 6 sides, whose blocks are computed by separate batches
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PVh=0.333333.txt')
+    Voronoi = PDEFullMHD(HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations),1,1,Inu,Inu,0.5,0.5)
+    for TestPDE in [PerturbedQuadPDE(),Voronoi]:
+        TestMesh = TestPDE.Mesh
+        Batched  = TestPDE.TVhInnerPreComputeAll()
+        for Cell in range(len(TestMesh.ElementEdges)):
+            Single = TestPDE.TVhInnerPreCompute(Cell)
+            for k in range(5):
+                assert np.allclose(Batched[k][Cell],Single[k],rtol=1E-10,atol=1E-12)
+
+def test_FastElementPaths():
+    #Triangles and quads use the batched closed form kernels, they must match the general polygon path
+    def Inu(xv):
+        return np.array([1,1])
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    Meshes = []
+    Nodes         = [[0,0],[1,0],[1,1],[0,1],[0.4,0.6]]
+    EdgeNodes     = [[0,1],[1,2],[2,3],[3,0],[0,4],[1,4],[2,4],[3,4]]
+    ElementEdges  = [[0,5,4],[1,6,5],[2,7,6],[3,4,7]]
+    Orientations  = [[1,1,-1],[1,1,-1],[1,1,-1],[1,1,-1]]
+    Meshes.append(HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations))
+    Meshes.append(PerturbedQuadMesh())
+    for TestMesh in Meshes:
+        TestPDE = PDEFullMHD(TestMesh,Re,Rm,Inu,Inu,dt,theta)
+        Fast    = TestPDE.TVhInnerPreComputeAll()
+        TestPDE.FastElementSizes = ()
+        ME,MV   = TestPDE.ElecMagMassMatrices()
+        General = TestPDE.TVhInnerPreComputeAll()
+        for Cell in range(len(TestMesh.ElementEdges)):
+            assert np.allclose(TestPDE.MEList[Cell],ME[Cell],rtol=1E-12,atol=1E-14)
+            assert np.allclose(TestPDE.MVList[Cell],MV[Cell],rtol=1E-12,atol=1E-14)
+            for k in range(5):
+                assert np.allclose(Fast[k][Cell],General[k][Cell],rtol=1E-10,atol=1E-12)
+
+def test_KernelBackends():
+    TestPDE  = PerturbedQuadPDE()
+    TestMesh = TestPDE.Mesh
+    Nodes,EdgeNodes,ElementEdges,Orientations = TestMesh.Nodes,TestMesh.EdgeNodes,TestMesh.ElementEdges,TestMesh.Orientations
+    rng      = np.random.default_rng(1)
+    unx, uny = rng.random(len(Nodes)), rng.random(len(Nodes))
+    umx, umy = rng.random(len(EdgeNodes)), rng.random(len(EdgeNodes))
+    B        = rng.random(len(EdgeNodes))
+    #Reference values, element by element
+    Div, Col, BB = [], [], []
+    for Cell in range(len(ElementEdges)):
+        lunx,luny,lumx,lumy = TestPDE.GetLocalTVhDOF(Cell,unx,uny,umx,umy)
+        xP,yP,A,V,E         = TestMesh.Centroid(ElementEdges[Cell],Orientations[Cell])
+        Div.append(TestPDE.DIVu(Cell,lunx,luny,lumx,lumy)[0])
+        Col.append(TestPDE.TVhSemiInProdColumn(ElementEdges[Cell],Cell,lunx,luny,lumx,lumy,xP,yP,A,E))
+        BB.append(TestPDE.PiRTBB(TestPDE.GetLocalEhDOF(Cell,B),ElementEdges[Cell],Cell,E))
+    Default = Kernels.GetBackend()
+    try:
+        for Backend in Kernels.AvailableBackends():
+            Kernels.SetBackend(Backend)
+            assert np.allclose(TestPDE.CellDivergence(unx,uny,umx,umy),Div,rtol=1E-12,atol=1E-12)
+            assert np.allclose(TestPDE.TVhColumns(unx,uny,umx,umy),Col,rtol=1E-12,atol=1E-12)
+            assert np.allclose(TestPDE.RTMoments(B),BB,rtol=1E-12,atol=1E-12)
+            TestPDE.MassMatrices = {}
+            ME = TestPDE.MassMatrix('Eh').toarray()
+            for Cell in range(len(ElementEdges)):
+                Loc = ElementEdges[Cell]
+                ME[np.ix_(Loc,Loc)] -= TestPDE.MEList[Cell]
+            assert np.allclose(ME,0,atol=1E-12)
+    finally:
+        Kernels.SetBackend(Default)
+
+def test_KernelLocalMatrices():
+    #The TVh local matrices and the Pi_RT coefficients built with the kernels on the local copies
+    #of the elements match the element by element construction, here on polygons with 5+ sides
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PVh=0.333333.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    def Inu(xv):
+        return np.array([1,1])
+    TestPDE  = PDEFullMHD(TestMesh,1,1,Inu,Inu,0.5,0.5)
+    Ptr      = TestMesh.ElementPtr
+    Default  = Kernels.GetBackend()
+    try:
+        for Backend in Kernels.AvailableBackends():
+            Kernels.SetBackend(Backend)
+            TestPDE.TVhBlocks = None
+            BlockPtr = np.concatenate(([0],np.cumsum(16*np.diff(Ptr)**2)))
+            for Cell in range(len(ElementEdges)):
+                for Blocks, Local in zip(TestPDE.TVhLocalBlocks(),TestPDE.LocalTVhMatrices(Cell)):
+                    assert np.allclose(Blocks[BlockPtr[Cell]:BlockPtr[Cell+1]],np.ravel(Local),rtol=1E-10,atol=1E-12)
+            Coeffs = TestPDE.RTCoeffs.copy()
+            TestPDE.MakeRTOperators()
+            assert np.allclose(TestPDE.RTCoeffs,Coeffs,rtol=1E-12,atol=1E-12)
+            for Cell in range(len(ElementEdges)):
+                V,E = TestMesh.StandardElement(ElementEdges[Cell],Orientations[Cell])
+                for k in range(len(ElementEdges[Cell])):
+                    Unit = np.zeros(len(ElementEdges[Cell]))
+                    Unit[k] = 1
+                    BB = TestPDE.PiRTBB(Unit,ElementEdges[Cell],Cell,E)
+                    assert np.allclose(TestPDE.RTCoeffs[Ptr[Cell]+k],TestPDE.RTKIList[Cell].dot(BB),rtol=1E-10,atol=1E-12)
+    finally:
+        Kernels.SetBackend(Default)
+
+def test_ThreadedAssembly():
+    #On PTh=0.2 the colours have up to 5 elements, so with 4 threads they are split in chunks run by the pool
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PTh=0.2.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+
+    def Inu(xv):
+        return np.array([1,1])
+    def h(x):
+        return x[1]
+    def Eb(x):
+        return x[0]*x[1]+x[2]
+    Re, Rm, dt, theta = 1, 1, 0.5, 0.5
+    Serial   = PDEFullMHD(TestMesh,Re,Rm,Inu,Inu,dt,theta)
+    Threaded = PDEFullMHD(TestMesh,Re,Rm,Inu,Inu,dt,theta)
+    Threaded.SetThreads(4)
+    Chunks = []
+    Threaded.Assembler.Scatter(lambda Cells,Out: Chunks.append(len(Cells)),np.zeros(1))
+    assert (len(Chunks) > len(TestMesh.ElementColouring()) and sum(Chunks) == len(ElementEdges))
+    u = np.linspace(-1,1,len(Nodes))
+    assert np.allclose(Serial.LocalProduct('Vh',u[TestMesh.FlatStart]),Serial.MassMatrix('Vh').T.dot(u))
+    #LocalProduct is a sparse operator, check it on values that jump across the elements
+    Ptr = TestMesh.ElementPtr
+    v   = np.sin(np.arange(Ptr[-1]))
+    for Space, Locals, Flat, n in [('Vh',Serial.MVList,TestMesh.FlatStart,len(Nodes)),('Eh',Serial.MEList,TestMesh.FlatEdges,len(EdgeNodes))]:
+        Ref = np.zeros(n)
+        for c in range(len(ElementEdges)):
+            Ref[Flat[Ptr[c]:Ptr[c+1]]] += v[Ptr[c]:Ptr[c+1]].dot(Locals[c])
+        assert np.allclose(Threaded.LocalProduct(Space,v),Ref,rtol=1E-12,atol=1E-14)
+    #The general polygon path of the local matrices is mapped on the pool
+    Threaded.FastElementSizes = ()
+    ME,MV = Threaded.ElecMagMassMatrices()
+    for Cell in range(len(ElementEdges)):
+        assert (np.allclose(ME[Cell],Serial.MEList[Cell]) and np.allclose(MV[Cell],Serial.MVList[Cell]))
+    x = np.linspace(0,1,Serial.NumElectroDOF())
+    for PDE in [Serial,Threaded]:
+        PDE.SetElectroBCAndSource(h,Eb)
+        PDE.ElectroComputeBC(0)
+        PDE.Electroupdateh(0)
+    assert np.allclose(Threaded.ElectroG(x),Serial.ElectroG(x))
+    Pool = Threaded.Assembler.Pool
+    Threaded.Assembler.Close()
+    assert (Threaded.Assembler.Pool is None and Pool._shutdown)
+    assert np.allclose(Threaded.ElectroG(x),Serial.ElectroG(x))
+
+def test_Decompose():
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PVh=0.128037.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    Subdomains = Decompose(TestMesh,3)
+    Part       = RCBPartition(TestMesh.Centroids,3)
+    assert (sorted(np.bincount(Part)) == [20,20,21])
+    assert (sorted(np.concatenate([Sub.Elements for Sub in Subdomains])) == list(range(len(ElementEdges))))
+    assert (sorted(np.concatenate([Sub.NodeRows for Sub in Subdomains])) == list(range(len(TestMesh.NumInternalNodes))))
+    assert (sorted(np.concatenate([Sub.MidRows for Sub in Subdomains])) == list(range(len(TestMesh.NumInternalMidNodes))))
+    for Sub in Subdomains:
+        Local = set(Sub.Elements.tolist()+Sub.Halo.tolist())
+        assert (len(Local) == len(Sub.Elements)+len(Sub.Halo))
+        for r in Sub.NodeRows:
+            assert (set(TestMesh.NodestoCells[TestMesh.NumInternalNodes[r]]) <= Local)
+        for r in Sub.MidRows:
+            assert (set(TestMesh.EdgestoCells[TestMesh.NumInternalMidNodes[r]]) <= Local)
+
+def test_ParallelFailures():
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PVh=0.333333.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    def Inu(xv):
+        return np.array([xv[0]+0.5,xv[1]])
+    def ub(xv,t):
+        return np.array([t,xv[0]])
+    def Eb(xv,t):
+        return xv[1]
+    TestPDE = PDEFullMHD(TestMesh,1,1,Inu,Inu,0.5,0.5)
+    TestPDE.SetMHDBCandSource(ub,Eb,ub,Eb)
+    TestPDE.MHDComputeBC(0)
+    TestPDE.MHDComputeSources(0)
+    TestPDE.SetMHDInterleave(True)
+    X = np.array([np.linspace(1,2,TestPDE.SetNumMHDDof())*k for k in range(1,3)])
+    #Set to 1 to make the workers die during their next evaluation
+    Kill      = mp.Value('i',0,lock=False)
+    RowsOf    = TestPDE.MHDMomentumRows
+    def MomentumRows(F,y,Rows=None):
+        if Kill.value:
+            os._exit(1)
+        return RowsOf(F,y,Rows)
+    TestPDE.MHDMomentumRows = MomentumRows
+    TestPDE.StartParallel(2)
+    try:
+        assert np.allclose(TestPDE.pMHDG(X),TestPDE.MHDG(X),rtol=1E-12,atol=1E-12)
+        #An error of this process during an evaluation still collects the workers
+        FieldRows = TestPDE.MHDFieldRows
+        def Fail(F,y):
+            raise ValueError('Field rows')
+        TestPDE.MHDFieldRows = Fail
+        try:
+            TestPDE.pMHDG(X[0])
+            assert False
+        except ValueError:
+            pass
+        TestPDE.MHDFieldRows = FieldRows
+        assert np.allclose(TestPDE.pMHDG(X[1]),TestPDE.MHDG(X[1]),rtol=1E-12,atol=1E-12)
+        #A worker that died between evaluations is replaced before the next one
+        Workers = list(TestPDE.Parallel.Workers)
+        Workers[0].kill()
+        Workers[0].join()
+        assert np.allclose(TestPDE.pMHDG(X[0]),TestPDE.MHDG(X[0]),rtol=1E-12,atol=1E-12)
+        assert not any(Worker in TestPDE.Parallel.Workers for Worker in Workers)
+        #Workers that die during an evaluation make it fail, and they are restarted
+        Kill.value = 1
+        try:
+            TestPDE.pMHDG(X[0])
+            assert False
+        except RuntimeError:
+            pass
+        Kill.value = 0
+        assert np.allclose(TestPDE.pMHDG(X[1]),TestPDE.MHDG(X[1]),rtol=1E-12,atol=1E-12)
+    finally:
+        TestPDE.StopParallel()
+    assert (TestPDE.Parallel is None)
+
+def test_AdditiveSchwarz():
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PTh=0.101015.txt')
+    TestMesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+    def Inu(xv):
+        return np.array([1,1])
+    def h(x):
+        return x[1]
+    def Eb(x):
+        return x[0]*x[1]+x[2]
+    PDE = PDEFullMHD(TestMesh,1,1,Inu,Inu,0.01,0.5)
+    PDE.SetElectroBCAndSource(h,Eb)
+    PDE.ElectroComputeBC(0)
+    PDE.Electroupdateh(0)
+    Layout = PDE.ElectroLayout
+    ndof   = PDE.NumElectroDOF()
+    Solver = InexactNewtonTimeInt()
+    x0     = np.zeros(ndof)
+    J      = Solver.FDJacobian(PDE.ElectroG,PDE.ElectroG(x0),x0,ndof)
+    b      = np.linspace(-1,1,ndof)
+    #A single patch without overlap is the exact inverse
+    Patches, Cores = MeshPatches(TestMesh,Layout,1,0)
+    assert (Patches[0].tolist() == list(range(ndof)))
+    assert np.allclose(AdditiveSchwarz(J,Patches).Apply(J.dot(b)),b)
+    Patches, Cores = MeshPatches(TestMesh,Layout,4,1)
+    assert (sorted(np.concatenate(Cores)) == list(range(ndof)))
+    assert (sum(len(Patch) for Patch in Patches) > ndof)
+    Coarse = ConstantModes(Layout,Cores)
+    assert (Coarse.shape == (ndof,8))
+    assert np.allclose(Coarse.sum(axis=1),1)
+    Serial = AdditiveSchwarz(J,Patches,Coarse)
+    Pooled = AdditiveSchwarz(J,Patches,Coarse,Workers=2)
+    assert np.allclose(Pooled.Apply(b),Serial.Apply(b),rtol=1E-12,atol=1E-12)
+    Pooled.Close()
+    Iterations = []
+    for M in [None,AdditiveSchwarz(J,Patches).Operator()]:
+        Count = [0]
+        def Callback(r):
+            Count[0] = Count[0]+1
+        x, exitcode = gmres(J,b,M=M,rtol=1E-10,atol=0,restart=200,callback=Callback,callback_type='pr_norm')
+        assert (exitcode == 0 and np.allclose(J.dot(x),b))
+        Iterations.append(Count[0])
+    assert (Iterations[1] < Iterations[0]/2)
+    Direct = Solver.FlowSolve(PDE.ElectroG,x0,ndof,5,1E-8)
+    Solver.Preconditioner = SchwarzPreconditioner(TestMesh,Layout,4,1,TwoLevel=True,Workers=2)
+    assert np.allclose(Solver.FlowSolve(PDE.ElectroG,x0,ndof,5,1E-8),Direct,rtol=1E-6,atol=1E-6)
+    #FlowSolve closes the pool of the last preconditioner
+    assert (Solver.Preconditioner.Current is None)
+    #GMRES that does not reach the tolerance is an error
+    Solver.Preconditioner = lambda A: None
+    Solver.KrylovTol      = 0
+    A = np.eye(10)+0.3*np.sin(np.arange(100)).reshape(10,10)
+    try:
+        Solver.LinearSolve(A,np.ones(10))
+        assert False
+    except RuntimeError:
+        pass
+
+def test_Multigrid():
+    Meshes = MeshHierarchy(['../MarcosMeshGen/locrefs_quads_0.mesh','../MarcosMeshGen/locrefs_quads_1.mesh'])
+    def Linear(X):
+        return 1+2*X[:,0]-3*X[:,1]
+    Coarse, Fine = Meshes
+    S = PointProlongation(Coarse,Fine,'Node')
+    assert np.allclose(S.dot(Linear(Coarse.NodeArray)),Linear(Fine.NodeArray))
+    S = PointProlongation(Coarse,Fine,'Mid')
+    assert np.allclose(S.dot(Linear(np.array(Coarse.MidNodes))),Linear(np.array(Fine.MidNodes)))
+    def Inu(xv):
+        return np.array([1,1])
+    PDE = PDEFullMHD(Fine,1,1,Inu,Inu,1,0.5)
+    for Space, A in [('Vh',PDE.AmpereOhmMatrix()),('TVh',PDE.VelocityMatrix())]:
+        b  = np.linspace(-1,1,A.shape[0])
+        MG = Multigrid(A,Prolongations(Meshes,Space))
+        #One level is a direct solve
+        assert np.allclose(A.dot(Multigrid(A,[]).Solve(b,tol=1E-12)),b)
+        Iterations = []
+        for M in [None,MG.Operator()]:
+            Count = [0]
+            def Callback(x):
+                Count[0] = Count[0]+1
+            x, exitcode = cg(A,b,M=M,rtol=1E-8,maxiter=5000,callback=Callback)
+            assert (exitcode == 0)
+            Iterations.append(Count[0])
+        assert (Iterations[1] < Iterations[0]/3)
+    A = PDE.AmpereOhmMatrix()
+    b = np.linspace(-1,1,A.shape[0])
+    x = Multigrid(A,Prolongations(Meshes,'Vh')).Solve(b)
+    assert (np.linalg.norm(A.dot(x)-b) < 1E-8*np.linalg.norm(b))
+
+def test_MeshSequence():
+    @Vectorized
+    def Inu(X):
+        return np.stack((1+X[:,0]-2*X[:,1],3*X[:,0]+X[:,1]),axis=1)
+    @Vectorized
+    def InB(X):
+        return np.stack((1+0*X[:,0],-2+0*X[:,1]),axis=1)
+    @Vectorized
+    def InE(X):
+        return 2-X[:,0]+4*X[:,1]
+    PDEs = []
+    for Pfile in ['PTh=0.2.txt','PVh=0.0677285.txt']:
+        Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh(Pfile)
+        Mesh = HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)
+        PDE  = PDEFullMHD(Mesh,1,1,Inu,InB,0.1,0.5)
+        PDE.State.E[:] = PDE.NodalDOFs(InE,Mesh.Nodes)
+        PDE.State.p[:] = Mesh.Areas*(1-4/np.sum(Mesh.Areas))
+        PDEs.append(PDE)
+    Coarse, Fine = PDEs
+    Sequence = MeshSequence()
+    assert (Sequence.Guess(Fine,0) is None)
+    #Linear velocities and electric fields, constant magnetic fields and pressures are transferred exactly
+    Sequence.Record(Coarse,0)
+    Sequence.NextMesh()
+    Exact = Fine.MHDLayout.Gather(tuple(getattr(Fine,Name) for Name in Fine.MHDFieldNames))
+    assert np.allclose(Sequence.Guess(Fine,0),Exact)
+    #The guess is interpolated in time, and with Start it is the current state plus the increment
+    Sequence.Record(Coarse,0)
+    Coarse.State.Buffer[:] = 3*Coarse.State.Buffer
+    Sequence.Record(Coarse,1)
+    Sequence.NextMesh()
+    assert np.allclose(Sequence.Guess(Fine,0.5),2*Exact)
+    assert np.allclose(Sequence.Guess(Fine,1,Start=0.5),2*Exact)
+    def Residual(x):
+        return x-Exact
+    assert np.allclose(Sequence.Guess(Fine,1,Start=0.5,Residual=Residual),Exact)
+
+def test_AdaptiveRefinement(capsys):
+    @Vectorized
+    def Inu(X):
+        return np.stack((1+X[:,0]-2*X[:,1],3*X[:,0]+X[:,1]),axis=1)
+    @Vectorized
+    def InB(X):
+        return np.stack((1+0*X[:,0],-2+0*X[:,1]),axis=1)
+    @Vectorized
+    def InE(X):
+        return 2-X[:,0]+4*X[:,1]
+    def Build(Mesh):
+        return PDEFullMHD(Mesh,1,1,Inu,InB,0.1,0.5)
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PTh=0.2.txt')
+    PDE = Build(HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations))
+    #Every row of a residual is shared among the elements around its entity
+    assert np.isclose(np.sum(ResidualIndicators(PDE,np.ones(PDE.MHDLayout.NumDOF))),PDE.MHDLayout.NumDOF)
+    Eta2   = np.linspace(0,1,50)**4
+    Marked = DorflerMarking(Eta2,0.5)
+    assert (np.sum(Eta2[Marked]) >= 0.5*np.sum(Eta2)) and (np.sum(Eta2[Marked])-np.min(Eta2[Marked]) < 0.5*np.sum(Eta2))
+    #Two levels of local refinement, the second one on hanging nodes
+    for Level in range(2):
+        Mesh = PDE.Mesh
+        R    = RefineMesh(Mesh,np.arange(0,len(Mesh.ElementEdges),3),MaxVertices=7)
+        Fine = R.Mesh
+        assert (np.min(Fine.Areas) > 0) and np.isclose(np.sum(Fine.Areas),4)
+        assert np.allclose(np.bincount(R.Parent,weights=Fine.Areas),Mesh.Areas)
+        assert (np.max(np.diff(Fine.ElementPtr)) <= 7)
+        assert np.allclose((Fine.Operator('Div')@Fine.Operator('Curl')).toarray(),0)
+        #Linear u and E, constant B and the cell averages of p are transferred exactly
+        PDE.State.B[:] = PDE.MagDOFs(InB)
+        PDE.State.E[:] = PDE.NodalDOFs(InE,Mesh.Nodes)
+        PDE.State.p[:] = Mesh.Areas*np.linspace(-1,1,len(Mesh.ElementEdges))
+        New = Build(Fine)
+        TransferState(PDE,New,R)
+        assert np.allclose(New.B,New.MagDOFs(InB))
+        assert np.allclose(New.unx,New.NodalDOFs(Inu,Fine.Nodes)[:,0])
+        assert np.allclose(New.umy,New.NodalDOFs(Inu,Fine.MidNodes)[:,1])
+        assert np.allclose(New.E,New.NodalDOFs(InE,Fine.Nodes))
+        assert np.allclose(np.bincount(R.Parent,weights=New.p),PDE.p-Mesh.Areas*np.sum(PDE.p)/4)
+        #Discretely divergence free fields stay so
+        PDE.State.B[:] = PDE.MRot@PDE.NodalDOFs(Vectorized(lambda X: np.sin(3*X[:,0])*np.cos(2*X[:,1])),Mesh.Nodes)
+        TransferState(PDE,New,R)
+        assert np.allclose(Fine.Operator('Div')@New.B,0)
+        PDE = New
+    #The loop refines towards an internal layer of B
+    Layer = Vectorized(lambda X: np.tanh((X[:,0]+X[:,1])/0.05))
+    def Solve(PDE):
+        PDE.State.B[:] = PDE.MRot@PDE.NodalDOFs(Layer,PDE.Mesh.Nodes)
+    PDE, History = AdaptiveLoop(Build(HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations)),Build,Solve,MaxElements=1000)
+    assert (History[-1][0] >= 1000) and (History[-1][2] < History[0][2])
+    Mesh     = PDE.Mesh
+    Distance = np.abs(Mesh.Centroids[:,0]+Mesh.Centroids[:,1])
+    assert (np.mean(Mesh.Areas[Distance < 0.1]) < np.mean(Mesh.Areas[Distance > 0.5])/10)
+    assert (capsys.readouterr().out == '')
+    #The residual returned by Solve is added to the indicators, a residual of ones adds NumDOF to Eta2
+    Start = Build(HeliosMesh(Nodes,EdgeNodes,ElementEdges,Orientations))
+    def Solve(PDE):
+        return np.ones(PDE.MHDLayout.NumDOF)
+    Eta2         = ErrorIndicators(Start)
+    PDE, History = AdaptiveLoop(Start,Build,Solve,MaxLevels=1,Verbose=True)
+    assert np.isclose(History[0][2]**2,np.sum(Eta2)+Start.MHDLayout.NumDOF)
+    assert (len(History) == 2 and History[1][0] > History[0][0] and PDE is not Start)
+    assert (capsys.readouterr().out.count('Level') == 2)
+
+def LocalMassMatrixStandIn(N,R,n,A,nu):
+    #Functions.py calls LocalMassMatrix without defining it, the tests of its assemblies and
+    #solvers put this symmetric positive definite stand-in in the module
+    return nu*(R.dot(np.transpose(R))/A+(A/n)*np.eye(n))
+
+def test_TripletAssembly(monkeypatch):
+    monkeypatch.setattr(Functions,'LocalMassMatrix',LocalMassMatrixStandIn,raising=False)
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PVh=0.333333.txt')
+    def Jxy(x,y):
+        return 0.5*y,-0.3*x
+    Basis = [Poly1,Poly2,Poly]
+    for Assembly, Local in [(MFDAssembly,MFDMEWEMVWV),(EAssembly,NewLocalMEWEMVWV),\
+                            (LSAssembly,LeastSquaresLocalMEWEMVWV),(GIAssembly,PieceWiseLocalMEWEMVWV)]:
+        #The element by element scatter the assemblies used before the triplets
+        ME = np.zeros((len(EdgeNodes),len(EdgeNodes)))
+        MV = np.zeros((len(Nodes),len(Nodes)))
+        MJ = np.zeros((len(Nodes),len(EdgeNodes)))
+        for k in range(len(ElementEdges)):
+            Element = ElementEdges[k]
+            LocME,LocMV,LocMJ,Edges = Local(Jxy,Basis,Element,EdgeNodes,Nodes,Orientations[k])
+            ElementVertices = [Edges[i][0] for i in range(len(Edges)-1)]
+            for j in range(len(Element)):
+                ME[Element[j],Element]                 = ME[Element[j],Element]+LocME[j]
+                MV[ElementVertices[j],ElementVertices] = MV[ElementVertices[j],ElementVertices]+LocMV[j]
+                MJ[ElementVertices[j],Element]         = MJ[ElementVertices[j],Element]+LocMJ[j]
+        Triplets = Assembly(Jxy,Nodes,EdgeNodes,ElementEdges,Orientations)
+        for M, Ref in zip(Triplets,(ME,MV,MJ)):
+            assert (M.format == 'csr' and M.shape == Ref.shape)
+            assert np.allclose(M.toarray(),Ref,rtol=1E-12,atol=1E-14)
+
+def test_ThetaSolver(monkeypatch):
+    monkeypatch.setattr(Functions,'LocalMassMatrix',LocalMassMatrixStandIn,raising=False)
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PertPQh=0.166666.txt')
+    def Jxy(x,y):
+        return 0.5*y,-0.3*x
+    T, dt, theta  = 0.3, 0.1, 0.5
+    Internal      = InternalObjects(BoundaryNodes,Nodes)[0]
+    curl          = primcurl(EdgeNodes,Nodes).toarray()
+    for Solver, Assembly in [(MFDSolver,MFDAssembly),(ESolver,EAssembly),(LSSolver,LSAssembly),(GISolver,GIAssembly)]:
+        #The time loop with the internal system solved at every step
+        ME,MV,MJ = [M.toarray() for M in Assembly(Jxy,Nodes,EdgeNodes,ElementEdges,Orientations)]
+        b        = np.transpose(curl).dot(ME)+MJ
+        Aprime   = MV+theta*dt*b.dot(curl)
+        Bh       = np.transpose(HighOrder7projE(InitialCond,EdgeNodes,Nodes))[0]
+        for t in np.arange(0,T,dt):
+            Eh = np.zeros(len(Nodes))
+            for Node in BoundaryNodes:
+                Eh[Node] = EssentialBoundaryCond(Nodes[Node][0],Nodes[Node][1],t+theta*dt)
+            Eh[Internal] = np.linalg.solve(Aprime[np.ix_(Internal,Internal)],(b.dot(Bh)-Aprime.dot(Eh))[Internal])
+            Bh           = Bh-dt*curl.dot(Eh)
+        Result = Solver(Jxy,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,EssentialBoundaryCond,InitialCond,ExactE,ExactB,T,dt,theta)
+        assert np.allclose(Result[0],Bh,rtol=1E-10,atol=1E-10) and np.allclose(Result[1],Eh,rtol=1E-10,atol=1E-10)
+
+def test_HartSolver(monkeypatch):
+    monkeypatch.setattr(Functions,'LocalMassMatrix',LocalMassMatrixStandIn,raising=False)
+    Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations = ProcessedMesh('PertPQh=0.166666.txt')
+    def Jxy(x,y):
+        return 0.5*y,-0.3*x
+    #The boundary values differ from the EssentialBoundaryCond of Functions.py, HartSolver must use its argument
+    def Cond(x,y,t):
+        return x*y+(1+x)*t
+    T, dt         = 0.3, 0.1
+    Internal      = InternalObjects(BoundaryNodes,Nodes)[0]
+    curl          = primcurl(EdgeNodes,Nodes).toarray()
+    ME,MV,MJ      = [M.toarray() for M in EAssembly(Jxy,Nodes,EdgeNodes,ElementEdges,Orientations)]
+    B             = np.transpose(curl).dot(ME)-MJ
+    #RK4 with the boundary values set node by node and the internal system solved at every stage
+    def tderiv(t,Bh):
+        Eh = np.zeros(len(Nodes))
+        for Node in BoundaryNodes:
+            Eh[Node] = Cond(Nodes[Node][0],Nodes[Node][1],t)
+        Eh[Internal] = np.linalg.solve(MV[np.ix_(Internal,Internal)],(B.dot(Bh)+MV.dot(Eh))[Internal])
+        return -curl.dot(Eh)
+    Bh = np.transpose(HighOrder7projE(InitialCond,EdgeNodes,Nodes))[0]
+    for t in np.arange(0,T,dt):
+        k1 = tderiv(t,Bh)
+        k2 = tderiv(t+0.5*dt,Bh+0.5*k1)
+        k3 = tderiv(t+0.5*dt,Bh+0.5*k2)
+        k4 = tderiv(t+dt,Bh+k3)
+        Bh = Bh+(dt/6)*(k1+k2+k3+k4)
+    Result = HartSolver(Jxy,Nodes,EdgeNodes,ElementEdges,BoundaryNodes,Orientations,Cond,InitialCond,ExactE,ExactB,T,dt,0.5)
+    assert np.allclose(Result[0],Bh,rtol=1E-10,atol=1E-10)
@@ -0,0 +1,120 @@
+import numpy as np
+from PDEClass import Vectorized
+from Multigrid import EvaluationMatrix
+
+#Transfer of the fields of PDEFullMHD between meshes that need not be nested, through point
+#location in the mesh the fields live on. Every field is turned into a function of the points
+#and the dofs on the new mesh are computed from it as for an initial condition: nodal and midnode
+#values at the points, B by MagDOFs and p by PhDOF.
+
+def LocateCells(Mesh,Points):
+    #The element holding every point. Points outside the mesh (e.g. on a curved or perturbed
+    #boundary) are given the element with the nearest centroid, where the field is extrapolated.
+    Cells   = Mesh.LocatePoints(Points)
+    Outside = np.nonzero(Cells < 0)[0]
+    if len(Outside) > 0:
+        Cells[Outside] = Mesh.CentroidTree.query(Points[Outside])[1]
+    return Cells
+
+def RTCoefficients(PDE,B):
+    #Coefficients (a,b,c) of Pi_RT B = (a+c*x,b+c*y) on every element, see MakeRTOperators
+    Mesh = PDE.Mesh
+    W    = np.asarray(B,dtype=float)[Mesh.FlatEdges][:,None]*PDE.RTCoeffs
+    return np.stack([np.bincount(Mesh.FlatElement,weights=W[:,j],minlength=len(Mesh.ElementEdges)) for j in range(3)],axis=1)
+
+def FieldInterpolant(PDE,Name,Value):
+    #Vectorized function of the points giving the field Name ('u', 'B', 'E' or 'p') of PDE whose
+    #dofs are Value: (unx,uny,umx,umy) for 'u'. u and E are interpolated with mean value
+    #coordinates of the element (u on its nodes and midnodes), B is Pi_RT B and p is the cell average.
+    Mesh = PDE.Mesh
+    if Name == 'u':
+        unx, uny, umx, umy = Value
+        U = np.stack((np.concatenate((unx,umx)),np.concatenate((uny,umy))),axis=1)
+        def Func(X):
+            return EvaluationMatrix(Mesh,X,LocateCells(Mesh,X),'NodeMid').dot(U)
+    elif Name == 'E':
+        def Func(X):
+            return EvaluationMatrix(Mesh,X,LocateCells(Mesh,X),'Node').dot(Value)
+    elif Name == 'B':
+        Coeffs = RTCoefficients(PDE,Value)
+        def Func(X):
+            C = Coeffs[LocateCells(Mesh,X)]
+            return np.stack((C[:,0]+C[:,2]*X[:,0],C[:,1]+C[:,2]*X[:,1]),axis=1)
+    elif Name == 'p':
+        def Func(X):
+            return (Value/Mesh.Areas)[LocateCells(Mesh,X)]
+    else:
+        raise ValueError('Unknown field '+str(Name))
+    return Vectorized(Func)
+
+def TransferFields(Coarse,Fine,Fields):
+    #The fields of Coarse, given as a dictionary with the arrays of MHDFieldNames, as dofs of Fine.
+    #Only the fields present are transferred. p is given zero average, as imposed by the closure.
+    Out = {}
+    if 'unx' in Fields:
+        u = FieldInterpolant(Coarse,'u',(Fields['unx'],Fields['uny'],Fields['umx'],Fields['umy']))
+        Out['unx'], Out['uny'] = Fine.DecompIntoCoord(Fine.NodalDOFs(u,Fine.Mesh.Nodes))
+        Out['umx'], Out['umy'] = Fine.DecompIntoCoord(Fine.NodalDOFs(u,Fine.Mesh.MidNodes))
+    if 'B' in Fields:
+        Out['B'] = Fine.MagDOFs(FieldInterpolant(Coarse,'B',Fields['B']))
+    if 'E' in Fields:
+        Out['E'] = Fine.NodalDOFs(FieldInterpolant(Coarse,'E',Fields['E']),Fine.Mesh.Nodes)
+    if 'p' in Fields:
+        p        = Fine.PhDOF(FieldInterpolant(Coarse,'p',Fields['p']))
+        Out['p'] = p-Fine.Mesh.Areas*np.sum(p)/np.sum(Fine.Mesh.Areas)
+    return Out
+
+class MeshSequence:
+    #Nested iteration for the convergence drivers, which solve the same problem on a sequence of
+    #meshes. The states of the run on one mesh are recorded (Record) and, on the next (finer) mesh,
+    #Guess gives the Newton initial guess at time t as the recorded state at t, linearly
+    #interpolated in time between records, transferred to the new mesh. The time steps of the
+    #two runs need not agree.
+    def __init__(self,Names=('unx','uny','umx','umy','B','E','p')):
+        self.Names    = tuple(Names)
+        self.Previous = None #(PDE,Times,States) of the previous mesh
+        self.Current  = None
+
+    def Record(self,PDE,t):
+        if self.Current is None or self.Current[0] is not PDE:
+            self.Current = (PDE,[],[])
+        self.Current[1].append(t)
+        self.Current[2].append({Name:np.array(getattr(PDE,Name),dtype=float) for Name in self.Names})
+
+    def NextMesh(self):
+        #Called when the run on a mesh is finished
+        self.Previous, self.Current = self.Current, None
+
+    def Fields(self,t):
+        #The recorded fields of the previous mesh at time t
+        PDE, Times, States = self.Previous
+        k = np.searchsorted(Times,t)
+        if k == 0 or k == len(Times):
+            return States[min(k,len(Times)-1)]
+        s = (t-Times[k-1])/(Times[k]-Times[k-1])
+        return {Name:(1-s)*States[k-1][Name]+s*States[k][Name] for Name in self.Names}
+
+    def Guess(self,PDE,t,Layout=None,Start=None,Residual=None):
+        #Newton guess at time t on the mesh of PDE, as a vector of Layout (MHDLayout by default,
+        #whose fields must be those recorded). None if there is no previous mesh. If the current
+        #state of PDE is at time Start, the guess is that state plus the transferred increment of
+        #the previous run from Start to t, which is better than the transferred state itself when
+        #the time step is small next to the mesh size. If the Residual function (e.g. PDE.MHDG) is
+        #given, the current state is returned instead when its residual is smaller, as happens
+        #while the coarse run resolves an initial layer poorly.
+        if self.Previous is None:
+            return None
+        Layout = PDE.MHDLayout if Layout is None else Layout
+        Fields = self.Fields(t)
+        if Start is not None:
+            Before = self.Fields(Start)
+            Fields = {Name:Fields[Name]-Before[Name] for Name in self.Names}
+        Fields = TransferFields(self.Previous[0],PDE,Fields)
+        if Start is not None:
+            Fields = {Name:Fields[Name]+getattr(PDE,Name) for Name in self.Names}
+        x = Layout.Gather(tuple(Fields[Name] for Name in self.Names))
+        if Residual is not None:
+            Current = Layout.Gather(tuple(getattr(PDE,Name) for Name in self.Names))
+            if np.linalg.norm(Residual(Current)) < np.linalg.norm(Residual(x)):
+                return Current
+        return x
@@ -0,0 +1,106 @@
+import numpy as np
+import tracemalloc
+
+class Workspace:
+    #Owns the temporary arrays used to evaluate the residuals (G functions), so that repeated
+    #evaluations reuse the same memory. Buffers are identified by name and allocated the first
+    #time they are requested. Allocations counts how many buffers have been allocated, once all
+    #the residuals have been evaluated once it must stay constant. It only covers the named
+    #buffers: the temporaries of the residuals (products with the sparse operators, element-local
+    #arrays) are still allocated on every evaluation. TraceAllocations measures all of them.
+    def __init__(self,Mesh):
+        self.NumNodes, self.NumMid = len(Mesh.Nodes), len(Mesh.EdgeNodes)
+        self.Buffers     = {}
+        self.Allocations = 0
+        self.Set         = {} #Entries set to non-zero values in the sparse buffers, see Unit and Column
+
+    def Get(self,Name,Size):
+        #Returns the buffer Name with Size entries, or of shape Size if it is a tuple (e.g. one row
+        #per state of a batch). Its content is whatever was left there.
+        Shape  = tuple(Size) if np.ndim(Size) == 1 else (Size,)
+        Buffer = self.Buffers.get(Name)
+        if Buffer is None or Buffer.shape != Shape:
+            Buffer                = np.zeros(Shape,dtype=float)
+            self.Buffers[Name]    = Buffer
+            self.Allocations      = self.Allocations+1
+        return Buffer
+
+    def Zeros(self,Name,Size):
+        Buffer = self.Get(Name,Size)
+        Buffer.fill(0)
+        return Buffer
+
+    def Fields(self,Name,Layout,Batch=None):
+        #One buffer for each field of the layout, with Batch rows if given
+        Shapes = Layout.Sizes if Batch is None else [(Batch,Size) for Size in Layout.Sizes]
+        return tuple(self.Get(Name+str(k),Shapes[k]) for k in range(len(Shapes)))
+
+    def Clear(self,Name,Size):
+        #Returns a zero buffer, resetting only the entries set by the previous call
+        if Name not in self.Buffers or len(self.Buffers[Name]) != Size:
+            self.Set[Name] = None
+            return self.Zeros(Name,Size)
+        Buffer = self.Buffers[Name]
+        if self.Set.get(Name) is not None:
+            Buffer[self.Set[Name]] = 0
+        return Buffer
+
+    def Unit(self,Name,Size,i):
+        #The i-th vector of the canonical basis
+        Buffer         = self.Clear(Name,Size)
+        Buffer[i]      = 1
+        self.Set[Name] = i
+        return Buffer
+
+    def Column(self,Name,Matrix,i):
+        #The i-th column of a CSC matrix as a dense vector
+        Buffer         = self.Clear(Name,Matrix.shape[0])
+        Rows           = Matrix.indices[Matrix.indptr[i]:Matrix.indptr[i+1]]
+        Buffer[Rows]   = Matrix.data[Matrix.indptr[i]:Matrix.indptr[i+1]]
+        self.Set[Name] = Rows
+        return Buffer
+
+    def TestFunction(self,Component,i):
+        #The TVh basis function with a 1 in the component Component (0:nx, 1:ny, 2:mx, 3:my)
+        #of node (or midnode) i, returned as the four arrays (vnx,vny,vmx,vmy).
+        ZeroN, ZeroM = self.Get('ZeroNodes',self.NumNodes), self.Get('ZeroMid',self.NumMid)
+        Sizes        = [self.NumNodes,self.NumNodes,self.NumMid,self.NumMid]
+        v            = [ZeroN,ZeroN,ZeroM,ZeroM]
+        v[Component] = self.Unit('Test'+str(Component),Sizes[Component],i)
+        return v[0],v[1],v[2],v[3]
+
+    def Theta(self,Name,Old,New,theta):
+        #(1-theta)*Old+theta*New, New may be a (k,n) array of k states
+        Buffer = self.Get(Name,np.shape(New))
+        np.subtract(New,Old,out=Buffer)
+        Buffer *= theta
+        Buffer += Old
+        return Buffer
+
+    def Rate(self,Name,Old,New,dt,f):
+        #(New-Old)/dt-f
+        Buffer = self.Get(Name,np.shape(New))
+        np.subtract(New,Old,out=Buffer)
+        Buffer /= dt
+        Buffer -= f
+        return Buffer
+
+def TraceAllocations(Func,*Args):
+    #Debug mode: runs Func(*Args) under tracemalloc and returns (Retained,Peak), the bytes of NumPy
+    #data still allocated after the call (arrays created and kept, e.g. a new buffer or a returned
+    #array) and the peak of the NumPy and Python memory allocated during it (the temporaries).
+    Started = tracemalloc.is_tracing()
+    if not Started:
+        tracemalloc.start()
+    Domain  = tracemalloc.DomainFilter(True,np.lib.tracemalloc_domain)
+    tracemalloc.reset_peak()
+    Base    = tracemalloc.get_traced_memory()[0]
+    Before  = tracemalloc.take_snapshot().filter_traces([Domain])
+    Result  = Func(*Args)
+    Peak    = tracemalloc.get_traced_memory()[1]-Base
+    After   = tracemalloc.take_snapshot().filter_traces([Domain])
+    Retained = sum(Stat.size_diff for Stat in After.compare_to(Before,'filename'))
+    del Result
+    if not Started:
+        tracemalloc.stop()
+    return Retained,Peak